@@ -16,9 +16,11 @@ import skd_collision_tests.collision_environment.collision_data_analyser as coll
 
 # Import skd core libraries
 import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
 import skd_core.skd_core_generators.skd_kamikaze_traj_gen as skd_kamikaze_traj_gen
 import skd_core.skd_core_analysers.skd_kamikaze_data_analyser as skd_kamikaze_data_analyser
 import skd_core.skd_core_generators.skd_safe_traj_gen as skd_safe_traj_gen
+import skd_trajectories.trajectories_filters as traj_filters
 
 
 def main():
@@ -80,6 +82,12 @@ def main():
 
 	# Append generated files to kamikaze config
 	safe_traj_files = safe_traj_generator.get_generated_safe_files()
+
+	# Optionally prune the safe trajectories that cannot be used against the car before running the planner
+	if("trajectory_filter_configs" in skd_options):
+		print("============================ FILTERING SAFE TRAJECTORIES ==========================================")
+		safe_traj_files = traj_filters.filter_safe_traj_files(safe_traj_files, module_outdir + "/SafeTrajFilterDir",
+															**(skd_options["trajectory_filter_configs"] or {}))
 	kamikaze_configs_path = module_outdir + "/kamikaze_configs.yaml"
 	kamikaze_options["safe_traj_files"] = safe_traj_files
 	# Save local modified of configurations
@@ -97,6 +105,9 @@ def main():
 	print("Analysing experiments output data")
 	analyser = skd_kamikaze_data_analyser.SKDKamikazeDataAnalyser(summary_file, kamikaze_analyser_dir)
 	analyser.parse_summary_data()
+
+	# Save the timing of every stage of the aggregated pipeline
+	skd_core_profiling.save_timing_report(module_outdir + "/timing_report.json")
 	
 
 	
@@ -0,0 +1,147 @@
+import sys,os
+import numpy as np
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_collision_tests_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_collision_tests_dir)
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+# Controllers
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
+import skd_collision_tests.controllers.car_sweep_tables as car_sweep_tables
+
+# SKD Core Utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_core_stats as skd_core_stats
+import skd_trajectories.trajectories_filters as traj_filters
+
+
+""" Control variate estimates of collision probabilities. The collision experiments of a safe trajectory and
+controller multiplier are stepped with uniform noise at every step, but their outcome mostly depends on where the
+car stops, which is set by the braking rate errors of the steps it brakes before stopping. The closed form of
+batch_controllers evaluates the same experiment with the noise of every step set to a weighted mean of the noise
+of those steps (earlier steps move the car for longer), for a fraction of the cost, and its outcome is the control
+variate of the noisy outcome. The mean of the control variate is estimated from many more closed form runs, so
+the noisy runs only have to estimate the difference between the two """
+
+# Default options of the estimator
+DEFAULT_NUM_RUNS = 1000
+DEFAULT_NUM_CONTROL_SAMPLES = 20000
+COLLISION_SEGMENTS_CHECK = 5
+
+
+def get_start_batches(safe_traj, controller_multiplier, num_runs):
+    """ Pedestrian and car batches of num_runs experiments of the safe trajectory, started as in the loader """
+    pedestrian_batch = batch_controllers.BatchPedestrianController([safe_traj] * num_runs)
+    car_batch = batch_controllers.BatchCarController(num_runs, multiplier=float(controller_multiplier))
+    car_start_pos = traj_filters.get_car_starting_pos(safe_traj, car_batch)
+    car_batch.set_car_pos(car_start_pos[0], car_start_pos[1])
+    return pedestrian_batch, car_batch
+
+
+@skd_core_profiling.profiled_stage("collision_simulation")
+def get_noise_free_collisions(safe_trajs, controller_multipliers, max_num_steps=25, car_sweep_cache=None):
+    """ Screens the (N, steps, 2) safe trajectories against the noise-free car of every multiplier with the
+    sweep tables of car_sweep_tables. Returns an (N, num_multipliers) array of collision flags """
+    car_sweep_cache = car_sweep_tables.CarSweepCache(max_num_steps) if (car_sweep_cache is None) else car_sweep_cache
+    return car_sweep_cache.get_collisions(safe_trajs, controller_multipliers, COLLISION_SEGMENTS_CHECK)
+
+
+
+class CollisionControlVariateEstimator:
+    """ Estimates the collision probability of the experiments of a safe trajectory and controller multiplier """
+    def __init__(self, safe_traj, controller_multiplier, max_num_steps=25, num_runs=DEFAULT_NUM_RUNS,
+                 num_control_samples=DEFAULT_NUM_CONTROL_SAMPLES, random_state=None):
+        self.safe_traj = safe_traj
+        self.controller_multiplier = float(controller_multiplier)
+        self.max_num_steps = max_num_steps
+        self.num_runs = int(num_runs)
+        self.num_control_samples = int(num_control_samples)
+        self.random_state = np.random.RandomState() if (random_state is None) else random_state
+
+
+    @skd_core_profiling.profiled_stage("collision_simulation")
+    def simulate_noise(self, noise):
+        """ Stepped collision flags of the (N, max_num_steps) noise arrays, as run by the loader in batch mode """
+        pedestrian_batch, car_batch = get_start_batches(self.safe_traj, self.controller_multiplier, len(noise))
+        return batch_controllers.run_batch_collision_experiments(pedestrian_batch, car_batch, self.max_num_steps,
+                                            COLLISION_SEGMENTS_CHECK, np.ascontiguousarray(noise.T))
+
+
+    def simulate_constant_noise(self, constant_noise):
+        """ Closed form collision flags of the runs whose noise is constant_noise at every step """
+        pedestrian_batch, car_batch = get_start_batches(self.safe_traj, self.controller_multiplier, len(constant_noise))
+        return batch_controllers.run_closed_form_collision_experiments(pedestrian_batch, car_batch, self.max_num_steps,
+                                            COLLISION_SEGMENTS_CHECK, constant_noise)
+
+
+    def get_noise_free_run(self):
+        """ Stepped and closed form collision flags of the noise-free experiment, and the weights of the noise of
+        every step in the control noise """
+        state_log = np.empty((1, self.max_num_steps + 1, batch_controllers.STATE_LOG_SIZE))
+        pedestrian_batch, car_batch = get_start_batches(self.safe_traj, self.controller_multiplier, 1)
+        collided = batch_controllers.run_batch_collision_experiments(pedestrian_batch, car_batch, self.max_num_steps,
+                                            COLLISION_SEGMENTS_CHECK, np.full((self.max_num_steps, 1), 0.5), state_log)
+
+        # The braking flag and velocity logged at step i + 1 are the result of the step i, which draws the noise i.
+        # The weighted steps are the first braking phase until the car stops, weighted by the remaining steps
+        braking_steps = state_log[0, 1:, batch_controllers.STATE_LOG_BRAKING_INDEX].astype(bool)
+        stopped_steps = state_log[0, 1:, 4] <= 0
+        noise_weights = np.zeros(self.max_num_steps)
+        if(np.any(braking_steps)):
+            first_step = int(np.argmax(braking_steps))
+            phase_ended = ~braking_steps[first_step:] | stopped_steps[first_step:]
+            phase_end = first_step + (int(np.argmax(phase_ended)) if np.any(phase_ended) else len(phase_ended))
+            noise_weights[first_step:phase_end] = phase_end - np.arange(first_step, phase_end) - 0.5
+        if(not np.any(noise_weights > 0)):
+            noise_weights[:] = 1.0
+
+        return (bool(collided[0]), bool(self.simulate_constant_noise(np.full(1, 0.5))[0]),
+                noise_weights / noise_weights.sum())
+
+
+    @skd_core_profiling.profiled_stage("control_variate_estimation")
+    def run(self):
+        """ Estimates the collision probability with num_runs noisy runs and their closed form control variates.
+        Returns a summary with the plain and control variate estimates, their standard errors, the variance
+        reduction and the noise-free outcome """
+        noise_free_collided, closed_form_collided, noise_weights = self.get_noise_free_run()
+
+        noise = self.random_state.random_sample((self.num_runs, self.max_num_steps))
+        collided = self.simulate_noise(noise).astype(float)
+        control_collided = self.simulate_constant_noise(noise.dot(noise_weights)).astype(float)
+
+        # Mean of the control variate, from the control noise of many more runs
+        control_steps = noise_weights > 0
+        control_noise = self.random_state.random_sample((self.num_control_samples, int(control_steps.sum()))).dot(
+                                                                                        noise_weights[control_steps])
+        control_mean = float(self.simulate_constant_noise(control_noise).mean())
+
+        collided_var = float(collided.var(ddof=1))
+        control_var = float(control_collided.var(ddof=1))
+        coefficient = (float(np.cov(collided, control_collided)[0, 1]) / control_var) if (control_var > 0) else 0.0
+        residual_var = float((collided - coefficient * control_collided).var(ddof=1))
+
+        probability = float(collided.mean())
+        cv_probability = float(np.clip(probability - coefficient * (control_collided.mean() - control_mean), 0.0, 1.0))
+        std_error = float(np.sqrt(collided_var / self.num_runs))
+        cv_std_error = float(np.sqrt(residual_var / self.num_runs + coefficient ** 2 * control_mean * (1 - control_mean) /
+                                     self.num_control_samples))
+
+        return {"CONTROLLER_MULTIPLIER" : self.controller_multiplier,
+                "COLLISION_PROBABILITY" : probability,
+                "COLLISION_PROBABILITY_STD_ERR" : std_error,
+                "CV_COLLISION_PROBABILITY" : cv_probability,
+                "CV_COLLISION_PROBABILITY_STD_ERR" : cv_std_error,
+                "CV_COLLISION_PROBABILITY_CI" : [max(cv_probability - skd_core_stats.NORMAL_95_Z * cv_std_error, 0.0),
+                                                 min(cv_probability + skd_core_stats.NORMAL_95_Z * cv_std_error, 1.0)],
+                "CV_COEFFICIENT" : coefficient,
+                "CONTROL_MEAN" : control_mean,
+                "VARIANCE_RATIO" : (collided_var / residual_var) if (residual_var > 0) else np.nan,
+                "NOISE_FREE_COLLIDED" : noise_free_collided,
+                "NOISE_FREE_CLOSED_FORM_AGREES" : noise_free_collided == closed_form_collided,
+                "NUM_CONTROL_STEPS" : int(control_steps.sum()),
+                "NUM_RUNS" : self.num_runs,
+                "NUM_CONTROL_SAMPLES" : self.num_control_samples}
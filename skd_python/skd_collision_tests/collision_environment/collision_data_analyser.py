@@ -1,6 +1,5 @@
 import sys,os
 import numpy as np
-import scipy.stats as st
 
 # Add parent dir to package
 source_path = os.path.abspath(__file__)
@@ -12,6 +11,11 @@ import skd_collision_tests.controllers.car_controllers as car_controllers
 import skd_collision_tests.controllers.pedestrian_controllers as pedestrian_controllers
 import skd_collision_tests.collision_environment.collision_env_utils as collision_utils
 import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_plot_renderer as skd_plot_renderer
+import skd_core.skd_core_utils.skd_core_stats as skd_core_stats
+import skd_core.skd_core_utils.skd_results_db as skd_results_db
+import skd_trajectories.trajectories_filters as traj_filters
 
 import copy
 import json
@@ -19,21 +23,192 @@ import time
 import glob
 
 
+# Environment variable for the default number of analysis processes
+ANALYSIS_WORKERS_ENV_VAR = "SKD_ANALYSIS_WORKERS"
+
+# Cache of the results of the analysed directories, kept in the output directory of the analyser
+ANALYSIS_CACHE_FILENAME = "collision_analysis_cache.json"
+
+
+def get_default_analysis_workers():
+    return int(os.getenv(ANALYSIS_WORKERS_ENV_VAR, "1"))
+
+
+def get_run_files_key(safe_traj_dir):
+    """ Returns [num_run_files, latest_mtime_ns] of the run logs and the collision flags index of a directory.
+    Results stored under this key are stale once a run is added or written again """
+    num_run_files = 0
+    latest_mtime = 0
+    if(not os.path.isdir(safe_traj_dir)):
+        return [num_run_files, latest_mtime]
+
+    for dir_entry in os.scandir(safe_traj_dir):
+        is_run_file = dir_entry.name.endswith(".yaml")
+        if(is_run_file or dir_entry.name == collision_utils.COLLISION_FLAGS_FILENAME):
+            num_run_files += int(is_run_file)
+            latest_mtime = max(latest_mtime, dir_entry.stat().st_mtime_ns)
+
+    return [num_run_files, latest_mtime]
+
+
+def load_safe_traj_dir_runs(safe_traj_dir, num_run_files, load_states=False):
+    """ Returns the collision flags and the state logs (None when load_states is False) of the runs of a
+    directory. Without the states, the flags come from the collision flags index and only the runs missing
+    from it are parsed. Each log is parsed at most once """
+    indexed_flags = {} if load_states else collision_utils.load_collision_flags(safe_traj_dir)
+    runs_collided = []
+    runs_states = [] if load_states else None
+
+    for run_num in range(num_run_files):
+        if(run_num in indexed_flags):
+            runs_collided.append(indexed_flags[run_num])
+            continue
+
+        run_data = skd_core_utils.load_dict_from_yaml(safe_traj_dir + "/run_%d.yaml" % (run_num), safe=True)
+        runs_collided.append(bool(run_data["COLLIDED"]))
+        if(load_states):
+            runs_states.append(run_data["DATA_LOG"])
+
+    return runs_collided, runs_states
+
+
+def plot_safe_traj_dir_runs(runs_collided, runs_states, safe_traj_plotdir, controller_id, safe_traj_index, max_plots=-1,
+                            plot_sampling="first", plot_workers=None):
+    """ Plots the (capped) runs of a safe trajectory and an overview of all its runs """
+    # Make directory
+    try:
+        os.makedirs(safe_traj_plotdir)
+    except OSError as error:
+        print(error)
+
+    num_run_files = len(runs_collided)
+    # Set cap on number of plots
+    plot_run_nums = set(skd_plot_renderer.select_plot_indices(num_run_files, max_plots, plot_sampling))
+
+    # Collect the runs to plot as a batch and every run for the overview
+    plot_jobs = []
+    overview_trajs = []
+    overview_colors = []
+    for run_num in range(num_run_files):
+        states_data = runs_states[run_num]
+        collided = runs_collided[run_num]
+
+        # Pedestrian paths are red when they collided, car paths in gray
+        np_states = np.array(states_data, dtype=float).reshape(len(states_data), -1)
+        overview_trajs.append(skd_plot_renderer.get_scene_points(np_states[:, 0:2]))
+        overview_colors.append((1.0, 0.0, 0.0, 0.5) if collided else (0.0, 0.0, 1.0, 0.5))
+        overview_trajs.append(skd_plot_renderer.get_scene_points(np_states[:, 2:4]))
+        overview_colors.append((0.5, 0.5, 0.5, 0.3))
+
+        if(run_num in plot_run_nums):
+            plot_jobs.append(skd_core_utils.get_run_plot_job(run_num, states_data, safe_traj_plotdir, collided))
+
+    skd_plot_renderer.render_plot_jobs(plot_jobs, plot_workers)
+
+    # Single image with all the runs of the safe trajectory
+    if(num_run_files > 0):
+        skd_plot_renderer.render_overview_plot(overview_trajs, overview_colors,
+                    "Controller %s, ST_%d: %d runs, %d collided" % (str(controller_id), safe_traj_index, num_run_files,
+                                                                   np.count_nonzero(runs_collided)),
+                    os.path.dirname(safe_traj_plotdir) + "/overview.png")
+
+
+def analyse_safe_traj_dir(analysis_job):
+    """ Reads the collision flags of the runs of a safe trajectory directory, and plots them when the job has a
+    plot directory. Jobs are built by CollisionExperimentDataAnalyser.get_analysis_job and may run in worker processes """
+    safe_traj_dir = analysis_job["SAFE_TRAJ_DIR"]
+    safe_traj_plotdir = analysis_job["PLOT_DIR"]
+    run_files_key = get_run_files_key(safe_traj_dir)
+    runs_collided, runs_states = load_safe_traj_dir_runs(safe_traj_dir, run_files_key[0],
+                                                         load_states=(safe_traj_plotdir is not None))
+
+    if(safe_traj_plotdir is not None):
+        max_plots, plot_sampling = analysis_job["PLOT_OPTIONS"]
+        plot_safe_traj_dir_runs(runs_collided, runs_states, safe_traj_plotdir, analysis_job["CONTROLLER_ID"],
+                                analysis_job["SAFE_TRAJ_INDEX"], max_plots, plot_sampling, analysis_job["PLOT_WORKERS"])
+
+    return {"SAFE_TRAJ_DIR" : safe_traj_dir,
+            "RUN_FILES_KEY" : run_files_key,
+            "RUNS_COLLIDED" : runs_collided,
+            "PLOT_OPTIONS" : analysis_job["PLOT_OPTIONS"]}
+
+
+
+def get_weighted_mean_var(values, weights, effective_size):
+    """ Weighted mean of values, and their variance corrected with the effective sample size """
+    mean = np.average(values, weights=weights)
+    return mean, np.average((values - mean) ** 2, weights=weights) * effective_size / (effective_size - 1)
+
+
+def get_paired_difference_stats(runs_a, runs_b, weights=None):
+    """ Statistics of the collision rate difference (b - a) of paired runs: [num_pairs, rate_a, rate_b, difference,
+    paired std error, paired 95% interval, unpaired std error, unpaired / paired variance ratio, and the number
+    of pairs where only a or only b collided]. Pairs can be weighted (e.g by the weights of their deduplicated
+    safe trajectories), the std errors then use the effective (Kish) number of pairs """
+    num_pairs = len(runs_a)
+    if(num_pairs < 2):
+        return [num_pairs] + [np.nan] * 10
+
+    weights = np.ones(num_pairs) if (weights is None) else np.asarray(weights, dtype=float)
+    effective_pairs = weights.sum() ** 2 / np.sum(weights * weights)
+    differences = runs_b - runs_a
+    rate_a, var_a = get_weighted_mean_var(runs_a, weights, effective_pairs)
+    rate_b, var_b = get_weighted_mean_var(runs_b, weights, effective_pairs)
+    difference, var_difference = get_weighted_mean_var(differences, weights, effective_pairs)
+    paired_std_err = np.sqrt(var_difference / effective_pairs)
+    unpaired_std_err = np.sqrt((var_a + var_b) / effective_pairs)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance_ratio = (unpaired_std_err / paired_std_err) ** 2
+
+    return [num_pairs, rate_a, rate_b, difference, paired_std_err,
+            difference - skd_core_stats.NORMAL_95_Z * paired_std_err, difference + skd_core_stats.NORMAL_95_Z * paired_std_err,
+            unpaired_std_err, variance_ratio, np.count_nonzero(differences < 0), np.count_nonzero(differences > 0)]
+
+
+
 class CollisionExperimentDataAnalyser:
     """ Class to analyse and plot the output info of the collision environments """
-    def __init__(self, parsing_summary_file, outputdir):
+    def __init__(self, parsing_summary_file, outputdir, plot_workers=None, plot_sampling="first", rate_ci_target_width=0.1,
+                 analysis_workers=None, save_plots=True, max_plots=10, use_cache=True, results_db_path=None):
         # Save the top level dir where parsing occurs
         self.parsin_summary_file = parsing_summary_file
 
         # Location where the analyser outputs
         self.outputdir = outputdir
 
+        # Number of plotting processes and policy used to pick the plotted runs
+        self.plot_workers = plot_workers
+        self.plot_sampling = plot_sampling
+        self.save_plots = save_plots
+        self.max_plots = max_plots
+
+        # Number of processes the safe trajectory directories are analysed with
+        self.analysis_workers = analysis_workers
+
+        # Results of the analysed directories, and whether they are kept across analyses of the same outputdir
+        self.safe_traj_dir_results = {}
+        self.use_cache = use_cache
+        self.analysis_cache_path = "%s/%s" % (self.outputdir, ANALYSIS_CACHE_FILENAME)
+
+        # Optional results database where the analysed runs are recorded (see skd_results_db)
+        self.results_db_path = skd_results_db.get_results_db_path(results_db_path)
+
+        # Collision counts per safe trajectory of every controller, for the rate intervals
+        self.rate_ci_target_width = rate_ci_target_width
+        self.collision_counts = []
+
+        # Weights of the trajectories of the safe traj files (cluster sizes when the files were deduplicated)
+        self.safe_traj_weights = {}
+
         # Load the simmary data
         self.parsing_summary_data  = skd_core_utils.load_dict_from_yaml(self.parsin_summary_file)
 
         # Output directory is created at an outer level to avoid errors of recreating the dir inside 
 
     def get_analyzer_summary_statistics(self):
+        # Analyse every safe trajectory directory of the summary up front, so they can be spread over the workers
+        self.analyse_safe_traj_dirs(self.get_summary_safe_traj_dirs())
+
         # Database to store data
         summary_data_db = []
 
@@ -68,6 +243,206 @@ class CollisionExperimentDataAnalyser:
 
         # Save data to a csv file
         np.savetxt("%s/experiments_statistics.csv" % (self.outputdir), np_summary_data_db, delimiter=",", header=header, comments='')
+        self.save_collision_rate_intervals()
+        self.save_paired_differences()
+        skd_core_profiling.save_timing_report("%s/timing_report.json" % (self.outputdir))
+        self.record_results()
+
+
+
+    def record_results(self):
+        """ Records the job and the collision flags of the analysed runs in the results database, when there is one """
+        results_db = skd_results_db.open_results_db(self.results_db_path)
+        if(results_db is None):
+            return
+
+        job_id = results_db.add_job(skd_results_db.JOB_COLLISION_ANALYSIS, self.parsin_summary_file, self.outputdir)
+        for controller_id in self.parsing_summary_data:
+            for safe_traj_file_summary in self.parsing_summary_data[str(controller_id)]["safe_traj_file_summaries"]:
+                for safe_traj_dir in safe_traj_file_summary["safe_traj_file_log_dirs"]:
+                    results_db.replace_runs(job_id, skd_results_db.RUN_COLLISION, controller_id,
+                                            safe_traj_file_summary["safe_traj_filepath"],
+                                            int(os.path.basename(safe_traj_dir).split("_")[-1]),
+                                            collided=self.safe_traj_dir_results[safe_traj_dir]["RUNS_COLLIDED"],
+                                            log_path=safe_traj_dir)
+        results_db.close()
+
+
+
+    def get_summary_safe_traj_dirs(self):
+        """ Returns the (controller_id, safe_traj_dir) of every safe trajectory directory in the summary """
+        controller_dirs = []
+        for controller_id in self.parsing_summary_data:
+            controller_summary = self.parsing_summary_data[str(controller_id)]
+            for safe_traj_file_summary in controller_summary["safe_traj_file_summaries"]:
+                for safe_traj_dir in safe_traj_file_summary["safe_traj_file_log_dirs"]:
+                    controller_dirs.append((controller_id, safe_traj_dir))
+
+        return controller_dirs
+
+
+
+    def get_plot_options(self):
+        """ Plot options the cached results were produced with (None when not plotting) """
+        return [self.max_plots, self.plot_sampling] if self.save_plots else None
+
+
+
+    def get_analysis_job(self, controller_id, safe_traj_dir, plot_workers=None):
+        """ Returns the analyse_safe_traj_dir job of a safe trajectory directory """
+        safe_traj_index = int(os.path.basename(safe_traj_dir).split("_")[-1])
+        safe_traj_plotdir = None
+        if(self.save_plots):
+            safe_traj_file_keyname = os.path.basename(os.path.dirname(safe_traj_dir))
+            safe_traj_plotdir = self.outputdir + "/%s/plots" % (skd_core_utils.get_kamikaze_config_suffix(
+                                                    controller_id, safe_traj_file_keyname, safe_traj_index))
+
+        return {"SAFE_TRAJ_DIR" : safe_traj_dir,
+                "CONTROLLER_ID" : controller_id,
+                "SAFE_TRAJ_INDEX" : safe_traj_index,
+                "PLOT_DIR" : safe_traj_plotdir,
+                "PLOT_OPTIONS" : self.get_plot_options(),
+                "PLOT_WORKERS" : plot_workers}
+
+
+
+    def load_analysis_cache(self):
+        """ Returns the cached directory results of a previous analysis into the same outputdir """
+        if(not self.use_cache or not os.path.isfile(self.analysis_cache_path)):
+            return {}
+        try:
+            return skd_core_utils.load_dict_from_json(self.analysis_cache_path)
+        except ValueError:
+            # Unreadable (e.g partially written) caches are rebuilt
+            return {}
+
+
+
+    @skd_core_profiling.profiled_stage("collision_analysis")
+    def analyse_safe_traj_dirs(self, controller_dirs):
+        """ Analyses the (controller_id, safe_traj_dir) directories with a pool of analysis_workers processes.
+        Directories whose runs did not change since they were cached (with the same plot options) are not read again """
+        analysis_cache = self.load_analysis_cache()
+        num_workers = get_default_analysis_workers() if (self.analysis_workers is None) else self.analysis_workers
+
+        analysis_jobs = []
+        for controller_id, safe_traj_dir in controller_dirs:
+            cached_result = analysis_cache.get(safe_traj_dir)
+            if(cached_result is not None and cached_result["RUN_FILES_KEY"] == get_run_files_key(safe_traj_dir)
+                    and cached_result["PLOT_OPTIONS"] == self.get_plot_options()):
+                self.safe_traj_dir_results[safe_traj_dir] = cached_result
+            else:
+                # The plots are rendered in the analysis processes when there is more than one
+                analysis_jobs.append(self.get_analysis_job(controller_id, safe_traj_dir,
+                                                           self.plot_workers if (num_workers <= 1) else 1))
+
+        if(num_workers <= 1 or len(analysis_jobs) <= 1):
+            analysis_results = [analyse_safe_traj_dir(analysis_job) for analysis_job in analysis_jobs]
+        else:
+            import multiprocessing
+            chunksize = max(1, len(analysis_jobs) // (4 * num_workers))
+            with multiprocessing.Pool(min(num_workers, len(analysis_jobs))) as pool:
+                analysis_results = pool.map(analyse_safe_traj_dir, analysis_jobs, chunksize)
+
+        for analysis_result in analysis_results:
+            self.safe_traj_dir_results[analysis_result["SAFE_TRAJ_DIR"]] = analysis_result
+            analysis_cache[analysis_result["SAFE_TRAJ_DIR"]] = analysis_result
+
+        if(self.use_cache and len(analysis_results) > 0):
+            skd_core_utils.save_dict_to_json(analysis_cache, self.analysis_cache_path)
+
+
+
+    def get_safe_traj_weight(self, safe_traj_filepath, safe_traj_index):
+        """ Weight of a safe trajectory, the number of trajectories it stands for when its file was deduplicated
+        (see trajectories_clustering). Trajectories of files that are no longer there weigh one """
+        if(safe_traj_filepath not in self.safe_traj_weights):
+            self.safe_traj_weights[safe_traj_filepath] = (traj_filters.get_safe_traj_weights(safe_traj_filepath)
+                                                          if os.path.isfile(safe_traj_filepath) else [])
+        safe_traj_weights = self.safe_traj_weights[safe_traj_filepath]
+        return safe_traj_weights[safe_traj_index] if (safe_traj_index < len(safe_traj_weights)) else 1
+
+
+
+    def save_collision_rate_intervals(self):
+        """ Saves the Wilson and Clopper-Pearson intervals of the collision rate of every safe trajectory
+        (ST) and of every controller (all its runs pooled, ST = -1), with the number of runs needed
+        for the Wilson interval to be rate_ci_target_width wide. The pooled runs are weighted by the
+        weights of their safe trajectories, and their counts are the effective counts of the weights """
+        np_counts = np.array(self.collision_counts, dtype=float).reshape(-1, 5)
+        controller_ids = np.unique(np_counts[:, 0])
+        pooled_counts = []
+        for controller_id in controller_ids:
+            controller_counts = np_counts[np_counts[:, 0] == controller_id]
+            pooled_collided, pooled_attempts = skd_core_stats.get_weighted_rate_counts(controller_counts[:, 2],
+                                                                controller_counts[:, 3], controller_counts[:, 4])
+            pooled_counts.append([controller_id, -1, pooled_collided, pooled_attempts, controller_counts[:, 4].sum()])
+        np_counts = np.concatenate([np_counts, np.array(pooled_counts).reshape(-1, 5)])
+
+        # Every interval is computed in a single call
+        collided = np_counts[:, 2]
+        attempts = np_counts[:, 3]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = collided / attempts
+        wilson_low, wilson_high = skd_core_stats.get_wilson_intervals(collided, attempts)
+        exact_low, exact_high = skd_core_stats.get_clopper_pearson_intervals(collided, attempts)
+        runs_needed = skd_core_stats.get_runs_for_rate_ci_width(rates, self.rate_ci_target_width)
+
+        np_intervals = np.column_stack([np_counts[:, 0:4], rates, wilson_low, wilson_high, exact_low, exact_high, runs_needed,
+                                        np_counts[:, 4]])
+        header = "controller_id,ST,total_collided,total_attempts,collision_rate,wilson_ci_low,wilson_ci_high"
+        header += ",clopper_pearson_ci_low,clopper_pearson_ci_high,runs_for_ci_width_%g,weight" % (self.rate_ci_target_width)
+        np.savetxt("%s/collision_rate_intervals.csv" % (self.outputdir), np_intervals, delimiter=",", header=header, comments='')
+
+
+
+    def get_controller_cell_runs(self, controller_id):
+        """ Returns the {(safe traj file keyname, ST_n dirname) : runs collided} of the cells of a controller,
+        in the order of the summary, and the {cell key : weight} of their safe trajectories """
+        cell_runs = {}
+        cell_weights = {}
+        for safe_traj_file_summary in self.parsing_summary_data[str(controller_id)]["safe_traj_file_summaries"]:
+            for safe_traj_dir in safe_traj_file_summary["safe_traj_file_log_dirs"]:
+                cell_key = (os.path.basename(os.path.dirname(safe_traj_dir)), os.path.basename(safe_traj_dir))
+                cell_runs[cell_key] = self.safe_traj_dir_results[safe_traj_dir]["RUNS_COLLIDED"]
+                cell_weights[cell_key] = self.get_safe_traj_weight(safe_traj_file_summary["safe_traj_filepath"],
+                                                                   int(os.path.basename(safe_traj_dir).split("_")[-1]))
+        return cell_runs, cell_weights
+
+
+
+    def save_paired_differences(self):
+        """ Saves the collision rate differences between adjacent controller multipliers, computed on the runs
+        with the same run number in every safe trajectory (ST) and pooled over all of them (ST = -1). With the
+        common random numbers mode of the loader the paired runs share their car noise, and the paired
+        interval is much narrower than the unpaired one. Discordant pairs are the ones where only one of the
+        controllers collided. The pooled pairs are weighted by the weights of their safe trajectories """
+        controller_ids = sorted(self.parsing_summary_data, key=float)
+        paired_rows = []
+        for controller_a, controller_b in zip(controller_ids[:-1], controller_ids[1:]):
+            cell_runs_a, cell_weights = self.get_controller_cell_runs(controller_a)
+            cell_runs_b, _ = self.get_controller_cell_runs(controller_b)
+            pooled_a, pooled_b, pooled_weights = [], [], []
+            for cell_index, cell_key in enumerate(cell_runs_a):
+                if(cell_key not in cell_runs_b):
+                    continue
+                num_pairs = min(len(cell_runs_a[cell_key]), len(cell_runs_b[cell_key]))
+                runs_a = np.array(cell_runs_a[cell_key][:num_pairs], dtype=float)
+                runs_b = np.array(cell_runs_b[cell_key][:num_pairs], dtype=float)
+                paired_rows.append([float(controller_a), float(controller_b), cell_index] + get_paired_difference_stats(runs_a, runs_b))
+                pooled_a.append(runs_a)
+                pooled_b.append(runs_b)
+                pooled_weights.append(np.full(num_pairs, cell_weights[cell_key], dtype=float))
+
+            if(len(pooled_a) > 0):
+                paired_rows.append([float(controller_a), float(controller_b), -1] +
+                                   get_paired_difference_stats(np.concatenate(pooled_a), np.concatenate(pooled_b),
+                                                               np.concatenate(pooled_weights)))
+
+        header = "controller_id_a,controller_id_b,ST,num_pairs,collision_rate_a,collision_rate_b,rate_difference"
+        header += ",paired_std_err,paired_ci_low,paired_ci_high,unpaired_std_err,variance_ratio,discordant_a,discordant_b"
+        np.savetxt("%s/paired_differences.csv" % (self.outputdir), np.array(paired_rows, dtype=float).reshape(-1, 14),
+                   delimiter=",", header=header, comments='')
 
 
 
@@ -93,6 +468,7 @@ class CollisionExperimentDataAnalyser:
         # Append extra data
         safe_traj_file_collision_rates = []
         safe_traj_file_collision_dirs = []
+        safe_traj_file_weights = []
 
         for safe_traj_file_data in controller_id_data:
             for safe_traj_file_collision_dir in safe_traj_file_data: 
@@ -100,6 +476,10 @@ class CollisionExperimentDataAnalyser:
                 single_safe_traj_data = safe_traj_file_data[safe_traj_file_collision_dir]
                 safe_traj_file_collision_rates.append(single_safe_traj_data["COLLISION_RATE"])
                 safe_traj_file_collision_dirs.append(safe_traj_file_collision_dir)
+                safe_traj_file_weights.append(single_safe_traj_data["TRAJ_WEIGHT"])
+                self.collision_counts.append([float(controller_id), len(safe_traj_file_collision_dirs) - 1,
+                                single_safe_traj_data["TOTAL_COLLIDED"], single_safe_traj_data["TOTAL_ATTEMPTS"],
+                                single_safe_traj_data["TRAJ_WEIGHT"]])
 
 
 
@@ -107,8 +487,9 @@ class CollisionExperimentDataAnalyser:
         # start with id tag
         controller_row_entry = [float(controller_id)]
         controller_row_entry.extend(safe_traj_file_collision_rates)
-        # Append statistics for collision rates
-        controller_row_entry.extend(skd_core_utils.process_general_stats_array(safe_traj_file_collision_rates))
+        # Append statistics for collision rates, where every rate counts for the trajectories it stands for
+        controller_row_entry.extend(skd_core_utils.process_general_stats_array(
+                                        np.repeat(safe_traj_file_collision_rates, safe_traj_file_weights)))
 
         # Pack headers 
 
@@ -136,13 +517,10 @@ class CollisionExperimentDataAnalyser:
             # Grab safe trajectory index from dirname
             safe_traj_index = int(safe_traj_dirname.split("_")[-1])
 
-            # Process single safe_trajectory dir
+            # Process single safe_trajectory dir (plotted when it was analysed)
             single_traj_data = self.process_single_safe_trajectory(
                 safe_traj_dir, safe_traj_filepath, controller_id, safe_traj_index)
 
-            # Plot as well
-            self.plot_single_safe_trajectory(safe_traj_dir, controller_id, safe_traj_index, max_plots = 10)
-
             # Save stats
             safe_traj_file_data[safe_traj_dir] = copy.deepcopy(single_traj_data)
 
@@ -154,22 +532,11 @@ class CollisionExperimentDataAnalyser:
     def process_single_safe_trajectory(self, safe_traj_dir, safe_traj_filepath,
          controller_id, safe_traj_index): 
 
-        # Parse data from all the data files in the single safe trajectory
-        runs_suffix = ".yaml"
-        traj_run_files = glob.glob(safe_traj_dir + "/*%s" % (runs_suffix))
-        num_run_files = len(traj_run_files)
-
-        # Storeage for collided flags
-        safe_traj_runs_collided = []
-        
-        # Parse all the statistics per run
-        for run_num in range(num_run_files):
-            # Read from each data and save
-            run_file = safe_traj_dir + "/run_%d.yaml" % (run_num)
-            data = skd_core_utils.load_dict_from_yaml(run_file)
-            collided = data["COLLIDED"]
-            # Append run collision status
-            safe_traj_runs_collided.append(collided)
+        # Collided flags of all the runs in the single safe trajectory
+        if(safe_traj_dir not in self.safe_traj_dir_results):
+            self.analyse_safe_traj_dirs([(controller_id, safe_traj_dir)])
+        safe_traj_runs_collided = self.safe_traj_dir_results[safe_traj_dir]["RUNS_COLLIDED"]
+        num_run_files = len(safe_traj_runs_collided)
 
         # Pack the single safe traj results in a summary
         total_collided = np.count_nonzero(safe_traj_runs_collided)
@@ -179,6 +546,7 @@ class CollisionExperimentDataAnalyser:
                                     "COLLISION_RATE" : collision_rate,
                                     "SAFE_TRAJ_FILENAME" : safe_traj_filepath,
                                     "SAFE_TRAJ_INDEX" : safe_traj_index,
+                                    "TRAJ_WEIGHT" : self.get_safe_traj_weight(safe_traj_filepath, safe_traj_index),
                                     "CONTROLLER_ID" : controller_id}
 
 
@@ -194,33 +562,8 @@ class CollisionExperimentDataAnalyser:
         safe_traj_plotdir = self.outputdir + "/%s/plots" % (skd_core_utils.get_kamikaze_config_suffix(
                                                     controller_id, safe_traj_file_keyname, safe_traj_index))
 
-        # Make directory
-        try:
-            os.makedirs(safe_traj_plotdir)
-        except OSError as error:
-            print(error)
-
         # Parse data from all the data files in the single safe trajectory
-        runs_suffix = ".yaml"
-        traj_run_files = glob.glob(safe_traj_dir + "/*%s" % (runs_suffix))
-        num_run_files = len(traj_run_files)
-
-    
-
-        # Set cap on number of plots
-        NUM_PLOTS = min(max_plots, num_run_files)
-        if(NUM_PLOTS < 0):
-            NUM_PLOTS = num_run_files
-        
-        # Parse all the statistics per run
-        for run_num in range(NUM_PLOTS):
-            # Read from each data and save
-            run_file = safe_traj_dir +  "/run_%d.yaml" % (run_num)
-            run_data = skd_core_utils.load_dict_from_yaml(run_file)
-            states_data = run_data["DATA_LOG"]
-            collided = run_data["COLLIDED"]
-
-            # Append run collision status
-            skd_core_utils.save_plot_number(run_num, states_data, safe_traj_plotdir, collided)
-
-       
\ No newline at end of file
+        runs_collided, runs_states = load_safe_traj_dir_runs(safe_traj_dir, get_run_files_key(safe_traj_dir)[0],
+                                                             load_states=True)
+        plot_safe_traj_dir_runs(runs_collided, runs_states, safe_traj_plotdir, controller_id, safe_traj_index,
+                                max_plots, self.plot_sampling, self.plot_workers)
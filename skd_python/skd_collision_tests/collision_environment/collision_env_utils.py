@@ -3,9 +3,6 @@ import subprocess
 import os
 import copy
 import json
-import tkinter as tk
-import tkinter.filedialog as fd
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -36,7 +33,7 @@ def get_all_safe_trajs_json(safe_traj_file_path):
 
 ####################################### Collision experiment configuration file generation methods ################################
 def gen_collision_experiments_config(output_path, safe_traj_files = [], num_runs=25, max_num_steps=25, max_trajs_per_file=-1,
-	car_controller_type="basic", multiplier_ids=[0.5, 0.625, 0.75, 0.875, 1, 1.05, 1.10, 1.125, 1.15]):
+	car_controller_type="basic", multiplier_ids=[0.5, 0.625, 0.75, 0.875, 1, 1.05, 1.10, 1.125, 1.15], adaptive_options=None):
     
     # Ask for files 
     if(len(safe_traj_files) < 1):
@@ -50,6 +47,11 @@ def gen_collision_experiments_config(output_path, safe_traj_files = [], num_runs
                             "safe_trajectory_files" : safe_traj_files,
                             "max_trajs_per_file" : max_trajs_per_file}
 
+    # Optional adaptive sampling options (adaptive_sampling, batch_size, min_runs_per_cell, max_runs_per_cell,
+    # ci_target_width, run_budget_per_cell) read by the CollisionExperimentLoader
+    if(adaptive_options is not None):
+        experiments_config.update(adaptive_options)
+
     # Ensure output dir exist
     outputdir = os.path.dirname(output_path)
 
@@ -67,10 +69,46 @@ def gen_collision_experiments_config(output_path, safe_traj_files = [], num_runs
 
 
 
+####################################### Collision flags index of the run logs ################################
+# Index of the collision flags of the runs of an experiment directory, written next to the run_%d.yaml logs so
+# that the analysers can read the flags without parsing the logs. Each line is "run_number,collided"
+COLLISION_FLAGS_FILENAME = "collision_flags.csv"
+
+
+def append_collision_flags(outdir, run_numbers, collision_flags):
+    """ Appends the collision flags of the runs to the index of outdir """
+    with open(os.path.join(outdir, COLLISION_FLAGS_FILENAME), "a") as flags_file:
+        flags_file.write("".join(["%d,%d\n" % (run_number, int(bool(collided)))
+                                  for run_number, collided in zip(run_numbers, collision_flags)]))
+
+
+def load_collision_flags(outdir):
+    """ Returns the {run_number : collided} flags indexed in outdir (empty when there is no index). The last
+    entry of a run wins, as runs that are executed again are appended again """
+    collision_flags = {}
+    flags_path = os.path.join(outdir, COLLISION_FLAGS_FILENAME)
+    if(not os.path.isfile(flags_path)):
+        return collision_flags
+
+    with open(flags_path) as flags_file:
+        for flags_line in flags_file:
+            line_values = flags_line.strip().split(",")
+            # Skip lines cut short by an interrupted write
+            if(len(line_values) == 2 and line_values[0].isdigit() and line_values[1] in ("0", "1")):
+                collision_flags[int(line_values[0])] = (line_values[1] == "1")
+
+    return collision_flags
+
+
+
+
 ####################################### HELPER METHODS FOR UTILITIES ##############################################
 def ask_for_files(message):
     """ Uses a GUI selection of experiment directories to be considered by an instance 
     of this class """
+    # Only load tkinter when the file picker is used, it needs a display
+    import tkinter as tk
+    import tkinter.filedialog as fd
     root = tk.Tk()
     files = []
     
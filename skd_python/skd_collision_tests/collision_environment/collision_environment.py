@@ -16,6 +16,8 @@ if(skd_python_dir not in sys.path):
 # Utils
 import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
 import skd_trajectories.trajectories_filters as trajs_filters
+import skd_collision_tests.collision_environment.collision_env_utils as collision_utils
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
 
 
 
@@ -126,31 +128,83 @@ class CollisionEnvironment:
         self.serialize_run(copy.deepcopy(step_entries), run_number, experiment_out_dir, 
             collision_flag, run_car_controller.get_car_dimensions())
 
+        return collision_flag
+
+
+
+    # Start a batch of experiments of the environment simulation
+    def run_batch_collision_experiment(self, controller_id, pedestrian_batch, car_batch, experiment_out_dir,
+                                       first_run_number, max_num_steps=25, noise=None):
+        """ Runs the experiments of a BatchPedestrianController and BatchCarController pair with the struct of
+        arrays simulation. Each experiment is logged and serialized as in run_single_collision_experiment,
+        numbered from first_run_number. Returns the array of collision flags """
+        collision_flags, state_log = self.simulate_batch(pedestrian_batch, car_batch, max_num_steps, noise)
+        self.record_batch_runs(controller_id, state_log, collision_flags, car_batch.get_car_dimensions(),
+                               experiment_out_dir, first_run_number)
+        return collision_flags
+
+
+    def simulate_batch(self, pedestrian_batch, car_batch, max_num_steps=25, noise=None):
+        """ Simulates a batch of experiments without recording them. Returns the collision flags and the
+        (N, max_num_steps + 1, STATE_LOG_SIZE) state log of the runs """
+        COLLISION_SEGMENTS_CHECK = 5
+
+        state_log = np.empty((car_batch.get_num_controllers(), max_num_steps + 1, batch_controllers.STATE_LOG_SIZE))
+        collision_flags = batch_controllers.run_batch_collision_experiments(pedestrian_batch, car_batch,
+                                    max_num_steps, COLLISION_SEGMENTS_CHECK, noise, state_log)
+        return collision_flags, state_log
+
+
+    def record_batch_runs(self, controller_id, state_log, collision_flags, car_dimensions, experiment_out_dir,
+                          first_run_number, run_logs=None):
+        """ Logs and serializes the runs of a batch from their state log and collision flags. The yaml texts of
+        the run logs are rendered unless they are given (e.g by a result cache). Returns the run log texts """
+        rendered_run_logs = []
+        for run_index in range(len(collision_flags)):
+            collision_flag = bool(collision_flags[run_index])
+            step_entries = batch_controllers.get_state_log_entries(state_log[run_index])
+
+            # Append collision flags and multiplier
+            self.run_success_log.append(collision_flag)
+            self.multiplier_log.append(controller_id)
+
+            # Save entry
+            self.run_entries.append(step_entries)
+            if(run_logs is None):
+                rendered_run_logs.append(self.serialize_run(step_entries, first_run_number + run_index, experiment_out_dir,
+                    collision_flag, car_dimensions))
+            else:
+                rendered_run_logs.append(self.write_run_log(run_logs[run_index], first_run_number + run_index,
+                    experiment_out_dir, collision_flag))
+
+        return rendered_run_logs
+
 
 
 
     """ Function for checking collisions occuring in the discretized movement in between steps from the agents """
     def check_intermediate_collision(self, ped_step_start_pos, ped_step_end_pos, 
         car_step_start_pos, car_step_end_pos, car_controller, ped_controller, num_steps_check):
-        # Interpolate intermediate positions between start and stop
-        ped_positions = np.linspace(ped_step_start_pos, ped_step_end_pos, num_steps_check).tolist()
-        car_positions = np.linspace(car_step_start_pos, car_step_end_pos, num_steps_check).tolist()
-
-        # Deep copy controllers to use as collision check actors only ("Dont want to actually move them")
-        collision_car_controller = copy.deepcopy(car_controller)
-        collision_ped_controller = copy.deepcopy(ped_controller)
-
+        # Interpolate intermediate positions between start and stop (same points as np.linspace). The
+        # positions are checked directly, so the controllers are neither copied nor moved
+        interp_div = max(num_steps_check - 1, 1)
+        ped_step_longit = (ped_step_end_pos[0] - ped_step_start_pos[0]) / interp_div
+        ped_step_hoz = (ped_step_end_pos[1] - ped_step_start_pos[1]) / interp_div
+        car_step_longit = (car_step_end_pos[0] - car_step_start_pos[0]) / interp_div
+        car_step_hoz = (car_step_end_pos[1] - car_step_start_pos[1]) / interp_div
 
-        # # Test that the controllers are independent after collision check
         for discretized_step in range(num_steps_check):
-            step_ped_pos = ped_positions[discretized_step]
-            step_car_pos = car_positions[discretized_step]
-            
-            # Set agents to positions
-            collision_car_controller.set_car_pos(step_car_pos[0], step_car_pos[1])
-            collision_ped_controller.set_ped_position(step_ped_pos[0], step_ped_pos[1])
-
-            if(collision_car_controller.collides(collision_ped_controller)):
+            if(discretized_step == num_steps_check - 1):
+                step_ped_pos = ped_step_end_pos
+                step_car_pos = car_step_end_pos
+            else:
+                step_ped_pos = (ped_step_start_pos[0] + discretized_step * ped_step_longit,
+                                ped_step_start_pos[1] + discretized_step * ped_step_hoz)
+                step_car_pos = (car_step_start_pos[0] + discretized_step * car_step_longit,
+                                car_step_start_pos[1] + discretized_step * car_step_hoz)
+
+            if(car_controller.collides_at(step_car_pos[0], step_car_pos[1], step_ped_pos[0], step_ped_pos[1],
+                                          ped_controller.radius)):
                 """ Return true if there was a collision in between """
                 return True
      
@@ -199,9 +253,17 @@ class CollisionEnvironment:
 
     # Log the outout into a yaml
     def serialize_run(self, run_entry, run_number, outdir, status, dimensions):
-        outfile = outdir + "/run_%d.yaml" % (run_number)
         output_map = {"DATA_LOG" : run_entry, "COLLIDED" : status, "CAR_DIMENSIONS" : copy.deepcopy(dimensions)}
-        skd_core_utils.save_dict_to_yaml(output_map, outfile)
+        return self.write_run_log(skd_core_utils.dump_dict_to_yaml(output_map), run_number, outdir, status)
+
+
+    def write_run_log(self, run_log, run_number, outdir, status):
+        """ Writes the yaml text of a run log and indexes its flag. Returns the text """
+        with open(outdir + "/run_%d.yaml" % (run_number), "w") as run_log_file:
+            run_log_file.write(run_log)
+        # Index the flag once the log is written, so the analysers do not need to parse the log
+        collision_utils.append_collision_flags(outdir, [run_number], [status])
+        return run_log
 
 
 
@@ -1,10 +1,10 @@
 import sys,os
 import numpy as np
-import scipy.stats as st
 import copy
 import json
 import time
 import glob
+import zlib
 
 # Add parent dir to package
 source_path = os.path.abspath(__file__)
@@ -16,14 +16,29 @@ if(skd_python_dir not in sys.path):
 # Controllers
 import skd_collision_tests.controllers.car_controllers as car_controllers
 import skd_collision_tests.controllers.pedestrian_controllers as pedestrian_controllers
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
 import skd_collision_tests.collision_environment.collision_env_utils as collision_utils
 import skd_collision_tests.collision_environment.collision_environment as collision_environment
+import skd_collision_tests.collision_environment.collision_rare_events as collision_rare_events
+import skd_collision_tests.collision_environment.collision_control_variates as collision_control_variates
 
 # SKD Core Utils
 import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_core_stats as skd_core_stats
+import skd_core.skd_core_utils.skd_results_db as skd_results_db
+import skd_core.skd_core_utils.skd_multiplier_search as skd_multiplier_search
+import skd_core.skd_core_utils.skd_result_cache as skd_result_cache
 import skd_trajectories.trajectories_filters as traj_filters
 
 
+# Steps of the car noise streams of the common random numbers mode, as run by the collision environment
+CRN_NOISE_STEPS = 25
+
+# Version of the batch simulation in the keys of the result cache. Changes of the simulation that change its
+# results must bump it, so the entries of the previous version are not used
+RESULT_CACHE_VERSION = "batch_collision_v1"
+
 """"" Scenario classes to organize the different groups of simulations used """
 class CollisionExperimentLoader:
     """ Object containing the necessary information to initialize an experiment """
@@ -33,6 +48,7 @@ class CollisionExperimentLoader:
         self.output_dir = output_dir
 
         # Load experiments info from config file
+        self.config_file = config_file
         self.config_file_info = collision_utils.load_yaml_file(config_file)
         
         # Experiment info 
@@ -47,6 +63,57 @@ class CollisionExperimentLoader:
         self.car_controller_type = self.config_file_info["car_controller_type"]
         # Safe trajectories for scenario
         self.safe_trajectories = []
+        # SafeTrajectory lookups of the (safe traj file, index) pairs, loaded once for all their runs
+        self.safe_trajectory_cache = {}
+
+        # Adaptive sampling options. Runs are executed in batches and each safe trajectory (ST_n) cell stops once
+        # the Wilson interval of its collision rate is ci_target_width wide, or it reaches max_runs_per_cell.
+        # Defaults keep the total budget of the fixed num_runs mode
+        self.adaptive_sampling = self.config_file_info.get("adaptive_sampling", False)
+        self.batch_size = self.config_file_info.get("batch_size", 10)
+        self.min_runs_per_cell = self.config_file_info.get("min_runs_per_cell", self.batch_size)
+        self.max_runs_per_cell = self.config_file_info.get("max_runs_per_cell", 4 * self.num_runs)
+        self.ci_target_width = self.config_file_info.get("ci_target_width", 0.1)
+        self.run_budget_per_cell = self.config_file_info.get("run_budget_per_cell", self.num_runs)
+
+        # Runs of the same safe trajectory are simulated together with the struct of arrays controllers
+        self.batch_simulation = self.config_file_info.get("batch_simulation", False)
+
+        # Common random numbers mode. Run k of a safe trajectory draws the same car noise stream for every
+        # controller multiplier, so the multipliers are compared on paired runs (see get_run_seed)
+        self.common_random_numbers = self.config_file_info.get("common_random_numbers", False)
+        self.crn_seed = self.config_file_info.get("crn_seed", 0)
+
+        # Optional on-disk cache of the outcomes of the batch experiments (see skd_result_cache), shared by the
+        # sweeps that use the same result_cache_dir. Only the seeded runs of the common random numbers mode
+        # are reproducible, so the cache is only consulted in that mode
+        self.result_cache = None
+        result_cache_dir = self.config_file_info.get("result_cache_dir")
+        if(result_cache_dir is not None):
+            if(self.batch_simulation and self.common_random_numbers):
+                self.result_cache = skd_result_cache.ResultCache(result_cache_dir, self.config_file_info.get(
+                                        "result_cache_max_bytes", skd_result_cache.DEFAULT_MAX_BYTES))
+            else:
+                print("The result cache needs batch_simulation and common_random_numbers, it is not used")
+
+        # Optional importance sampling estimates of the collision probability of every ST_n cell, for the rare
+        # collisions of high multipliers (options of collision_rare_events.CollisionRareEventEstimator, plus
+        # max_levels, num_estimate_samples and seed)
+        self.rare_event_options = self.config_file_info.get("rare_event_estimation")
+
+        # Optional control variate estimates of the collision probability of every ST_n cell, from noisy runs and
+        # their closed form noise-free counterparts (options of collision_control_variates.CollisionControlVariateEstimator,
+        # plus seed)
+        self.control_variate_options = self.config_file_info.get("control_variate_estimation")
+
+        # Optional search of the critical multiplier of every ST_n cell and of all the cells pooled (options of
+        # skd_multiplier_search.CriticalMultiplierSearch). The search runs are logged under critical_multiplier_search
+        self.critical_search_options = self.config_file_info.get("critical_multiplier_search")
+        self.critical_search_dir = self.output_dir + "/critical_multiplier_search"
+        self.critical_search_run_counts = {}
+
+        # Optional results database where the runs are recorded (see skd_results_db)
+        self.results_db_path = skd_results_db.get_results_db_path(self.config_file_info.get("results_db"))
 
         # Create an environment for running experiments
         self.collision_env = collision_environment.CollisionEnvironment(output_dir)
@@ -74,11 +141,25 @@ class CollisionExperimentLoader:
             # Iterate over all safe_ped_traj_files
             for safe_traj_filename in self.safe_ped_traj_files:
 
-                safe_traj_file_summary = self.get_safe_traj_file_summary(controller_id, safe_traj_filename)
+                if(self.adaptive_sampling):
+                    # Only create the cells, their runs are scheduled with the rest of the controller cells
+                    safe_traj_file_summary = self.get_safe_traj_file_summary(controller_id, safe_traj_filename, num_runs=0)
+                else:
+                    safe_traj_file_summary = self.get_safe_traj_file_summary(controller_id, safe_traj_filename)
 
                 # Store 
                 controller_safe_traj_file_summaries.append(copy.deepcopy(safe_traj_file_summary))
 
+            # Budget of the controller is shared between all its cells
+            if(self.adaptive_sampling):
+                self.run_adaptive_experiments(controller_id, controller_safe_traj_file_summaries)
+
+            if(self.rare_event_options is not None):
+                self.run_rare_event_estimation(controller_id, controller_safe_traj_file_summaries)
+
+            if(self.control_variate_options is not None):
+                self.run_control_variate_estimation(controller_id, controller_safe_traj_file_summaries)
+
 
             # Save a summary of experiments per controller multiplier
             controller_multiplier_summary = {"controller_multiplier" : controller_id, 
@@ -87,12 +168,191 @@ class CollisionExperimentLoader:
             # Store controller summary
             experiments_summary[str(controller_id)] = copy.deepcopy(controller_multiplier_summary)
             
+        if(self.critical_search_options is not None):
+            self.run_critical_multiplier_search()
+
         # Save experiments summary and return summary
         skd_core_utils.save_dict_to_yaml(experiments_summary, self.loader_summary_path)
-
-
-
-    def get_safe_traj_file_summary(self, controller_id, safe_traj_filename):
+        skd_core_profiling.save_timing_report(self.loader_summary_dir + "/timing_report.json")
+        if(self.result_cache is not None):
+            skd_core_utils.save_dict_to_yaml(self.result_cache.get_stats(), self.loader_summary_dir + "/result_cache_stats.yaml")
+        self.record_results(experiments_summary)
+
+
+
+    def record_results(self, experiments_summary):
+        """ Records the job and the collision flags of its runs (from the collision flags index of every ST_n dir)
+        in the results database, when there is one """
+        results_db = skd_results_db.open_results_db(self.results_db_path)
+        if(results_db is None):
+            return
+
+        job_id = results_db.add_job(skd_results_db.JOB_COLLISION_EXPERIMENTS, self.config_file, self.output_dir)
+        for controller_id in experiments_summary:
+            for safe_traj_file_summary in experiments_summary[controller_id]["safe_traj_file_summaries"]:
+                for safe_traj_dir in safe_traj_file_summary["safe_traj_file_log_dirs"]:
+                    safe_traj_index = int(os.path.basename(safe_traj_dir).split("_")[-1])
+                    collision_flags = collision_utils.load_collision_flags(safe_traj_dir)
+                    results_db.replace_runs(job_id, skd_results_db.RUN_COLLISION, controller_id,
+                                            safe_traj_file_summary["safe_traj_filepath"], safe_traj_index,
+                                            collided=[collision_flags[run_num] for run_num in sorted(collision_flags)],
+                                            log_path=safe_traj_dir)
+        results_db.close()
+
+
+
+    def run_adaptive_experiments(self, controller_id, safe_traj_file_summaries):
+        """ Runs the experiments of every ST_n cell of the controller in batches. Each round, the unfinished cells
+        with the widest collision rate intervals (the ones near the decision boundary of the controller) get
+        another batch, until every cell is finished or the run budget of the controller is spent """
+        cells = get_summary_cells(safe_traj_file_summaries)
+        num_cells = len(cells)
+        cell_runs = np.zeros(num_cells, dtype=int)
+        cell_collisions = np.zeros(num_cells, dtype=int)
+        remaining_budget = self.run_budget_per_cell * num_cells
+
+        # Every cell starts with min_runs_per_cell runs
+        next_batches = np.full(num_cells, min(self.min_runs_per_cell, self.max_runs_per_cell), dtype=int)
+        while(np.any(next_batches > 0)):
+            for cell_index in np.flatnonzero(next_batches):
+                safe_traj_filename, safe_traj_index, safe_traj_dir = cells[cell_index]
+                if(self.batch_simulation):
+                    collided = self.run_batch_experiments(controller_id, safe_traj_filename, safe_traj_index,
+                                        int(cell_runs[cell_index]), int(next_batches[cell_index]), safe_traj_dir)
+                    cell_runs[cell_index] += len(collided)
+                    cell_collisions[cell_index] += int(np.count_nonzero(collided))
+                    remaining_budget -= len(collided)
+                    continue
+
+                for batch_run in range(next_batches[cell_index]):
+                    collided = self.run_single_experiment(controller_id, safe_traj_filename,
+                                        safe_traj_index, int(cell_runs[cell_index]), safe_traj_dir)
+                    cell_runs[cell_index] += 1
+                    cell_collisions[cell_index] += int(collided)
+                    remaining_budget -= 1
+
+            # Cells that still need runs, ordered by the width of their intervals
+            ci_low, ci_high = skd_core_stats.get_wilson_intervals(cell_collisions, cell_runs)
+            ci_widths = ci_high - ci_low
+            unfinished = (ci_widths > self.ci_target_width) & (cell_runs < self.max_runs_per_cell)
+            next_batches = np.zeros(num_cells, dtype=int)
+            unallocated_budget = remaining_budget
+            for cell_index in np.argsort(-ci_widths, kind="mergesort"):
+                if(not unfinished[cell_index] or unallocated_budget <= 0):
+                    continue
+                next_batches[cell_index] = min(self.batch_size, self.max_runs_per_cell - cell_runs[cell_index], unallocated_budget)
+                unallocated_budget -= next_batches[cell_index]
+
+        # Keep a record of the runs spent per cell
+        ci_low, ci_high = skd_core_stats.get_wilson_intervals(cell_collisions, cell_runs)
+        sampling_summary = {"CONTROLLER_ID" : controller_id,
+                            "TOTAL_RUNS" : int(cell_runs.sum()),
+                            "CELLS" : [{"SAFE_TRAJ_DIR" : cells[cell_index][2],
+                                        "RUNS" : int(cell_runs[cell_index]),
+                                        "TOTAL_COLLIDED" : int(cell_collisions[cell_index]),
+                                        "WILSON_CI_LOW" : float(ci_low[cell_index]),
+                                        "WILSON_CI_HIGH" : float(ci_high[cell_index])} for cell_index in range(num_cells)]}
+        skd_core_utils.save_dict_to_yaml(sampling_summary,
+                    self.loader_summary_dir + "/adaptive_sampling_controller_m_%s.yaml" % (controller_id))
+
+
+
+    def run_rare_event_estimation(self, controller_id, safe_traj_file_summaries):
+        """ Estimates the collision probability of every ST_n cell of the controller by importance sampling
+        of the car noise, and saves the estimates with their standard errors next to the experiments summary """
+        estimator_options = dict(self.rare_event_options)
+        run_options = {"max_levels" : estimator_options.pop("max_levels", collision_rare_events.DEFAULT_MAX_LEVELS),
+                       "num_estimate_samples" : estimator_options.pop("num_estimate_samples", None)}
+        random_state = np.random.RandomState(estimator_options.pop("seed", None))
+
+        cell_estimates = []
+        for safe_traj_filename, safe_traj_index, safe_traj_dir in get_summary_cells(safe_traj_file_summaries):
+            estimator = collision_rare_events.CollisionRareEventEstimator(
+                                self.get_safe_trajectory(safe_traj_filename, safe_traj_index).get_points(), controller_id,
+                                self.max_num_steps, random_state=random_state, **estimator_options)
+            cell_estimate = estimator.run(**run_options)
+            cell_estimate["SAFE_TRAJ_DIR"] = safe_traj_dir
+            cell_estimates.append(cell_estimate)
+
+        rare_event_summary = {"CONTROLLER_ID" : controller_id,
+                              "TOTAL_RUNS" : int(sum(cell_estimate["NUM_SIMULATIONS"] for cell_estimate in cell_estimates)),
+                              "CELLS" : cell_estimates}
+        skd_core_utils.save_dict_to_yaml(rare_event_summary,
+                    self.loader_summary_dir + "/rare_event_estimates_controller_m_%s.yaml" % (controller_id))
+
+
+
+    def run_control_variate_estimation(self, controller_id, safe_traj_file_summaries):
+        """ Estimates the collision probability of every ST_n cell of the controller with the closed form
+        control variates, and saves the estimates with their standard errors next to the experiments summary """
+        estimator_options = dict(self.control_variate_options)
+        random_state = np.random.RandomState(estimator_options.pop("seed", None))
+
+        cell_estimates = []
+        for safe_traj_filename, safe_traj_index, safe_traj_dir in get_summary_cells(safe_traj_file_summaries):
+            estimator = collision_control_variates.CollisionControlVariateEstimator(
+                                self.get_safe_trajectory(safe_traj_filename, safe_traj_index).get_points(), controller_id,
+                                self.max_num_steps, random_state=random_state, **estimator_options)
+            cell_estimate = estimator.run()
+            cell_estimate["SAFE_TRAJ_DIR"] = safe_traj_dir
+            cell_estimates.append(cell_estimate)
+
+        control_variate_summary = {"CONTROLLER_ID" : controller_id,
+                                   "TOTAL_RUNS" : int(sum(cell_estimate["NUM_RUNS"] for cell_estimate in cell_estimates)),
+                                   "NOISE_FREE_CLOSED_FORM_MISMATCHES" : int(sum(not cell_estimate["NOISE_FREE_CLOSED_FORM_AGREES"]
+                                                                                 for cell_estimate in cell_estimates)),
+                                   "CELLS" : cell_estimates}
+        skd_core_utils.save_dict_to_yaml(control_variate_summary,
+                    self.loader_summary_dir + "/control_variate_estimates_controller_m_%s.yaml" % (controller_id))
+
+
+
+    def run_critical_multiplier_search(self):
+        """ Searches the critical multiplier of every ST_n cell of the safe traj files, and of all of them pooled,
+        and saves the results next to the experiments summary. Cells are the ones of the grid experiments """
+        cells = []
+        cell_weights = []
+        for safe_traj_filename in self.safe_ped_traj_files:
+            num_trajs = min(self.max_num_steps, skd_core_utils.get_num_safe_trajs(safe_traj_filename))
+            cells.extend([(safe_traj_filename, safe_traj_index) for safe_traj_index in range(num_trajs)])
+            # Deduplicated trajectories weigh their cluster sizes in the pooled search
+            cell_weights.extend(traj_filters.get_safe_traj_weights(safe_traj_filename)[0:num_trajs])
+
+        critical_search_summary = skd_multiplier_search.search_critical_multipliers(self.evaluate_critical_search_cell,
+                                                                    cells, cell_weights, **self.critical_search_options)
+        for cell, cell_summary in zip(cells, critical_search_summary["CELLS"]):
+            cell_summary["SAFE_TRAJ_FILENAME"] = cell[0]
+            cell_summary["SAFE_TRAJ_INDEX"] = cell[1]
+        skd_core_utils.save_dict_to_yaml(critical_search_summary, self.loader_summary_dir + "/critical_multipliers.yaml")
+
+
+    def evaluate_critical_search_cell(self, cell, controller_multiplier, num_runs):
+        """ Runs num_runs experiments of a (safe traj file, index) cell at a multiplier of the critical search.
+        Runs of the same cell and multiplier are numbered on from the previous ones, so the common random numbers
+        mode pairs them across multipliers. Returns the number of runs and collisions """
+        safe_traj_filename, safe_traj_index = cell
+        safe_filename = os.path.basename(safe_traj_filename).split(".")[0]
+        exp_outdir = self.critical_search_dir + "/controller_m_%s/%s/ST_%d" % (controller_multiplier, safe_filename, safe_traj_index)
+        if(exp_outdir not in self.critical_search_run_counts):
+            os.makedirs(exp_outdir, exist_ok=True)
+            self.critical_search_run_counts[exp_outdir] = len(collision_utils.load_collision_flags(exp_outdir))
+        first_run_number = self.critical_search_run_counts[exp_outdir]
+
+        if(self.batch_simulation):
+            collided = self.run_batch_experiments(controller_multiplier, safe_traj_filename, safe_traj_index,
+                                                  first_run_number, num_runs, exp_outdir)
+        else:
+            collided = [self.run_single_experiment(controller_multiplier, safe_traj_filename, safe_traj_index,
+                                                   first_run_number + run_index, exp_outdir) for run_index in range(num_runs)]
+
+        self.critical_search_run_counts[exp_outdir] += num_runs
+        return num_runs, int(np.count_nonzero(collided))
+
+
+
+    def get_safe_traj_file_summary(self, controller_id, safe_traj_filename, num_runs=None):
+        # Runs per safe trajectory
+        num_runs = self.num_runs if (num_runs is None) else num_runs
         # Store the output directories
         safe_traj_filename_log_dirs = []
 
@@ -118,10 +378,14 @@ class CollisionExperimentLoader:
             except:
                 pass
 
-            # Perform collision experiments for self.num_runs tries
-            for run_num in range(self.num_runs):
-                self.run_single_experiment(controller_id, safe_traj_filename, 
-                        safe_traj_index, run_num, experiments_out_dir)
+            # Perform collision experiments for num_runs tries
+            if(self.batch_simulation and num_runs > 0):
+                self.run_batch_experiments(controller_id, safe_traj_filename, safe_traj_index, 0,
+                        num_runs, experiments_out_dir)
+            else:
+                for run_num in range(num_runs):
+                    self.run_single_experiment(controller_id, safe_traj_filename, 
+                            safe_traj_index, run_num, experiments_out_dir)
 
             safe_traj_filename_log_dirs.append(experiments_out_dir)
 
@@ -134,6 +398,7 @@ class CollisionExperimentLoader:
 
     
 
+    @skd_core_profiling.profiled_stage("collision_simulation")
     def run_single_experiment(self, controller_id, safe_traj_filename, safe_traj_index, run_number, exp_outdir):
         """ Runs a single colllision experiment using the 
         collision env associated with the loader """
@@ -142,21 +407,87 @@ class CollisionExperimentLoader:
         HOZ_INDEX = 1
 
         # Create a starting ped_controller
-        run_safe_traj = skd_core_utils.get_safe_traj_from_file(safe_traj_filename, safe_traj_index)
-        run_pedestrian = pedestrian_controllers.PedestrianController(run_safe_traj)
+        run_safe_traj = self.get_safe_trajectory(safe_traj_filename, safe_traj_index)
+        run_pedestrian = pedestrian_controllers.PedestrianController(run_safe_traj.get_points())
         
-        # Create a default basic car controller
-        run_car_controller = car_controllers.BasicCarController(controller_id, multiplier=float(controller_id))
+        # Create a default basic car controller. In the common random numbers mode it draws its errors (one
+        # sample per step) from its own stream of the run
+        random_state = None
+        if(self.common_random_numbers):
+            random_state = np.random.RandomState(self.get_run_seed(safe_traj_filename, safe_traj_index, run_number))
+        run_car_controller = car_controllers.BasicCarController(controller_id, multiplier=float(controller_id),
+                                                                random_state=random_state)
 
         # Change starting position according to safe traj
         car_start_pos = traj_filters.get_car_starting_pos(run_safe_traj, run_car_controller)
         run_car_controller.set_car_pos(car_start_pos[LONGIT_INDEX], car_start_pos[HOZ_INDEX])
 
-        # Run the experiment 
-        self.collision_env.run_single_collision_experiment(controller_id, run_pedestrian, run_car_controller, 
+        # Run the experiment and return its collision status
+        return self.collision_env.run_single_collision_experiment(controller_id, run_pedestrian, run_car_controller, 
                                     exp_outdir, run_number)
 
 
+    @skd_core_profiling.profiled_stage("collision_simulation")
+    def run_batch_experiments(self, controller_id, safe_traj_filename, safe_traj_index, first_run_number,
+                              num_runs, exp_outdir):
+        """ Runs num_runs collision experiments of a safe trajectory at once with the batch controllers.
+        Returns the array of collision flags """
+        LONGIT_INDEX = 0
+        HOZ_INDEX = 1
+
+        run_safe_traj = self.get_safe_trajectory(safe_traj_filename, safe_traj_index)
+        pedestrian_batch = batch_controllers.BatchPedestrianController([run_safe_traj] * num_runs)
+        car_batch = batch_controllers.BatchCarController(num_runs, multiplier=float(controller_id))
+
+        # Every car starts where the single experiments start
+        car_start_pos = traj_filters.get_car_starting_pos(run_safe_traj, car_batch)
+        car_batch.set_car_pos(car_start_pos[LONGIT_INDEX], car_start_pos[HOZ_INDEX])
+
+        noise = None
+        if(self.common_random_numbers):
+            noise = np.column_stack([np.random.RandomState(self.get_run_seed(safe_traj_filename, safe_traj_index,
+                                        run_number)).random_sample(CRN_NOISE_STEPS)
+                                     for run_number in range(first_run_number, first_run_number + num_runs)])
+
+        if(self.result_cache is None):
+            return self.collision_env.run_batch_collision_experiment(controller_id, pedestrian_batch, car_batch,
+                                        exp_outdir, first_run_number, noise=noise)
+
+        # Cached batches are recorded as if they were simulated, from their cached run logs
+        cache_key = get_batch_cache_key(pedestrian_batch, car_batch, noise)
+        cached_result = self.result_cache.get(cache_key)
+        if(cached_result is not None):
+            self.collision_env.record_batch_runs(controller_id, cached_result["state_log"], cached_result["collided"],
+                                        car_batch.get_car_dimensions(), exp_outdir, first_run_number,
+                                        run_logs=skd_result_cache.unpack_strings(cached_result["run_logs"]))
+            return cached_result["collided"]
+
+        collided, state_log = self.collision_env.simulate_batch(pedestrian_batch, car_batch, CRN_NOISE_STEPS, noise)
+        run_logs = self.collision_env.record_batch_runs(controller_id, state_log, collided, car_batch.get_car_dimensions(),
+                                    exp_outdir, first_run_number)
+        self.result_cache.put(cache_key, {"state_log" : state_log, "collided" : collided,
+                                          "run_logs" : skd_result_cache.pack_strings(run_logs)})
+        return collided
+
+
+    def get_run_seed(self, safe_traj_filename, safe_traj_index, run_number):
+        """ Seed of the car noise of a run in the common random numbers mode. It only depends on the safe
+        trajectory and the run number, so the single and batch experiments of every controller multiplier draw
+        the same stream. Safe traj files are identified by their goal directory and file name, as the files of
+        every goal share the same name """
+        return [int(self.crn_seed), zlib.crc32(get_safe_traj_file_key(safe_traj_filename).encode()),
+                int(safe_traj_index), int(run_number)]
+
+
+    def get_safe_trajectory(self, safe_traj_filename, safe_traj_index):
+        """ Returns the SafeTrajectory of a safe traj file index, loading the file on first use """
+        cache_key = (safe_traj_filename, safe_traj_index)
+        if(cache_key not in self.safe_trajectory_cache):
+            run_safe_traj = skd_core_utils.get_safe_traj_from_file(safe_traj_filename, safe_traj_index)
+            self.safe_trajectory_cache[cache_key] = traj_filters.SafeTrajectory(run_safe_traj)
+        return self.safe_trajectory_cache[cache_key]
+
+
     def get_experiment_max_num_steps(self):
         """ Max number of steps per each collision experiment run """
         return self.max_num_steps
@@ -174,6 +505,32 @@ class CollisionExperimentLoader:
 
 
 
+def get_batch_cache_key(pedestrian_batch, car_batch, noise):
+    """ Result cache key of a batch of experiments, from the pedestrian trajectories, the parameters and
+    starting state of the cars, and the noise of the runs (which covers their seeds and number of steps) """
+    return skd_result_cache.get_cache_key(RESULT_CACHE_VERSION, pedestrian_batch.safe_ped_trajs,
+                [pedestrian_batch.radius, pedestrian_batch.height], car_batch.multiplier,
+                [car_batch.car_max_speed, car_batch.braking_rate, car_batch.car_length, car_batch.car_width],
+                car_batch.state, car_batch.braking, noise)
+
+
+def get_safe_traj_file_key(safe_traj_filename):
+    """ Goal directory and file name of a safe traj file (e.g goal_119_121_-4_-4/safe_trajs.json) """
+    safe_traj_path = os.path.abspath(safe_traj_filename)
+    return "%s/%s" % (os.path.basename(os.path.dirname(safe_traj_path)), os.path.basename(safe_traj_path))
+
+
+def get_summary_cells(safe_traj_file_summaries):
+    """ Returns the ST_n cells of safe traj file summaries as (safe traj file, safe traj index, output dir) rows """
+    cells = []
+    for safe_traj_file_summary in safe_traj_file_summaries:
+        for safe_traj_dir in safe_traj_file_summary["safe_traj_file_log_dirs"]:
+            safe_traj_index = int(os.path.basename(safe_traj_dir).split("_")[-1])
+            cells.append((safe_traj_file_summary["safe_traj_filepath"], safe_traj_index, safe_traj_dir))
+    return cells
+
+
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+import sys,os
+import numpy as np
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_collision_tests_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_collision_tests_dir)
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+# Controllers
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
+
+# SKD Core Utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_core_stats as skd_core_stats
+import skd_trajectories.trajectories_filters as traj_filters
+
+
+""" Importance sampling estimates of rare collision probabilities. The only randomness of a collision experiment
+is the uniform noise that sets the braking rate or speed error of the car at every step (see BatchCarController).
+The noise of each step is sampled from a Beta distribution instead, refitted with the cross-entropy method to the
+runs that get closest to the pedestrian until the collisions are the elites, and every run is weighted by the
+ratio between the uniform and Beta densities of its noise. The weighted collision rate is an unbiased estimate
+of the collision probability of the experiments, with a standard error from the spread of the weights """
+
+# Default options of the estimator
+DEFAULT_POPULATION_SIZE = 1000
+DEFAULT_ELITE_FRACTION = 0.1
+DEFAULT_MIN_FAILURE_FRACTION = 0.05
+DEFAULT_SMOOTHING = 0.7
+DEFAULT_MAX_LEVELS = 15
+# Bounds of the Beta parameters, which keep the proposals from collapsing on the elites
+MIN_BETA_PARAM = 0.2
+MAX_BETA_PARAM = 50.0
+COLLISION_SEGMENTS_CHECK = 5
+
+
+def fit_beta_params(samples, weights):
+    """ Weighted method of moments fit of the Beta parameters of every column of (N, D) samples in [0, 1] """
+    means = np.average(samples, axis=0, weights=weights).clip(1e-3, 1 - 1e-3)
+    variances = np.average((samples - means) ** 2, axis=0, weights=weights)
+    variances = np.clip(variances, 1e-6, means * (1 - means) * 0.99)
+    concentrations = means * (1 - means) / variances - 1
+    return (np.clip(means * concentrations, MIN_BETA_PARAM, MAX_BETA_PARAM),
+            np.clip((1 - means) * concentrations, MIN_BETA_PARAM, MAX_BETA_PARAM))
+
+
+
+class CollisionRareEventEstimator:
+    """ Estimates the collision probability of the experiments of a safe trajectory and controller multiplier """
+    def __init__(self, safe_traj, controller_multiplier, max_num_steps=25, population_size=DEFAULT_POPULATION_SIZE,
+                 elite_fraction=DEFAULT_ELITE_FRACTION, min_failure_fraction=DEFAULT_MIN_FAILURE_FRACTION,
+                 smoothing=DEFAULT_SMOOTHING, random_state=None):
+        self.safe_traj = safe_traj
+        self.controller_multiplier = float(controller_multiplier)
+        self.max_num_steps = max_num_steps
+        self.population_size = int(population_size)
+        self.elite_fraction = elite_fraction
+        self.min_failures = max(1, int(min_failure_fraction * self.population_size))
+        self.smoothing = smoothing
+        self.random_state = np.random.RandomState() if (random_state is None) else random_state
+
+        self.num_simulations = 0
+
+
+    def get_num_simulations(self):
+        return self.num_simulations
+
+
+    @skd_core_profiling.profiled_stage("collision_simulation")
+    def simulate_noise(self, noise):
+        """ Runs the experiments of the (N, max_num_steps) noise arrays, as run by the loader in batch mode.
+        Returns their scores (see batch_controllers.get_collision_scores) and collision flags """
+        num_runs = len(noise)
+        pedestrian_batch = batch_controllers.BatchPedestrianController([self.safe_traj] * num_runs)
+        car_batch = batch_controllers.BatchCarController(num_runs, multiplier=self.controller_multiplier)
+        car_start_pos = traj_filters.get_car_starting_pos(self.safe_traj, car_batch)
+        car_batch.set_car_pos(car_start_pos[0], car_start_pos[1])
+
+        state_log = np.empty((num_runs, self.max_num_steps + 1, batch_controllers.STATE_LOG_SIZE))
+        collided = batch_controllers.run_batch_collision_experiments(pedestrian_batch, car_batch, self.max_num_steps,
+                                        COLLISION_SEGMENTS_CHECK, np.ascontiguousarray(noise.T), state_log)
+        self.num_simulations += num_runs
+
+        return batch_controllers.get_collision_scores(state_log, collided, car_batch.get_car_dimensions(),
+                                                      pedestrian_batch.radius), collided
+
+
+    def sample_noise(self, alphas, betas, num_samples):
+        """ Samples (num_samples, max_num_steps) noise arrays, uniform when alphas is None """
+        if(alphas is None):
+            return self.random_state.random_sample((num_samples, self.max_num_steps))
+        # Samples are kept inside [0, 1) as the uniform noise
+        return np.minimum(self.random_state.beta(alphas, betas, (num_samples, self.max_num_steps)), np.nextafter(1.0, 0.0))
+
+
+    def get_likelihood_ratios(self, noise, alphas, betas):
+        """ Ratios between the uniform density and the sampling density of the noise arrays """
+        if(alphas is None):
+            return np.ones(len(noise))
+        # Only load scipy when the estimates are run, the loader imports this module on every run
+        import scipy.stats
+        return np.exp(-scipy.stats.beta.logpdf(noise, alphas, betas).sum(axis=1))
+
+
+    @skd_core_profiling.profiled_stage("rare_event_estimation")
+    def run(self, max_levels=DEFAULT_MAX_LEVELS, num_estimate_samples=None):
+        """ Fits the noise distribution for up to max_levels, and estimates the collision probability with
+        num_estimate_samples (population_size by default) runs of the fitted distribution. The fit converges when
+        the collisions are the elites. When it does not (it runs out of levels, or a level does not lower the score
+        level), the estimate runs have no collisions, or the collisions are not rare (the uniform first level already
+        has min_failures of them), the probability is the plain collision rate of the uniform runs (the first level
+        and num_estimate_samples more) with its Wilson interval. Returns a summary with the estimate, its standard
+        error and 95% interval, whether the fit converged and the number of simulated runs """
+        num_estimate_samples = self.population_size if (num_estimate_samples is None) else int(num_estimate_samples)
+        alphas, betas = None, None
+        levels = []
+        converged = False
+        rare_event = True
+
+        for level in range(max_levels):
+            noise = self.sample_noise(alphas, betas, self.population_size)
+            scores, collided = self.simulate_noise(noise)
+            if(alphas is None):
+                # The first level is sampled from the uniform noise, its runs are part of the plain estimate
+                uniform_collisions = int(collided.sum())
+                if(uniform_collisions >= self.min_failures):
+                    # Not a rare event, the uniform runs estimate it directly
+                    levels.append({"LEVEL" : 0.0, "COLLISIONS" : uniform_collisions})
+                    rare_event = False
+                    break
+
+            # The score level stops at the collisions, which are the elites once there are min_failures of them
+            score_level = max(float(np.quantile(scores, self.elite_fraction)), 0.0)
+            if(collided.sum() >= self.min_failures):
+                score_level = 0.0
+            elites = scores <= score_level
+            stalled = (len(levels) > 0) and (score_level >= levels[-1]["LEVEL"])
+            levels.append({"LEVEL" : score_level, "COLLISIONS" : int(collided.sum())})
+
+            fit_alphas, fit_betas = fit_beta_params(noise[elites], self.get_likelihood_ratios(noise[elites], alphas, betas))
+            previous_alphas = np.ones(self.max_num_steps) if (alphas is None) else alphas
+            previous_betas = np.ones(self.max_num_steps) if (betas is None) else betas
+            alphas = self.smoothing * fit_alphas + (1 - self.smoothing) * previous_alphas
+            betas = self.smoothing * fit_betas + (1 - self.smoothing) * previous_betas
+
+            if(score_level <= 0.0):
+                converged = True
+                break
+            if(stalled):
+                # The elites are stuck on runs with the same score (e.g the car always stops at the same clearance)
+                break
+
+        num_collisions = 0
+        if(converged):
+            noise = self.sample_noise(alphas, betas, num_estimate_samples)
+            scores, collided = self.simulate_noise(noise)
+            num_collisions = int(collided.sum())
+
+        if(num_collisions > 0):
+            collision_weights = np.where(collided, self.get_likelihood_ratios(noise, alphas, betas), 0.0)
+            probability = min(float(collision_weights.mean()), 1.0)
+            std_error = float(collision_weights.std(ddof=1) / np.sqrt(len(collision_weights))) if (len(collision_weights) > 1) else np.nan
+            ci = [max(probability - skd_core_stats.NORMAL_95_Z * std_error, 0.0),
+                  min(probability + skd_core_stats.NORMAL_95_Z * std_error, 1.0)]
+            estimator = "IMPORTANCE_SAMPLING"
+        else:
+            scores, collided = self.simulate_noise(self.sample_noise(None, None, num_estimate_samples))
+            num_collisions = int(collided.sum())
+            num_runs = self.population_size + num_estimate_samples
+            probability = (uniform_collisions + num_collisions) / num_runs
+            std_error = float(np.sqrt(probability * (1 - probability) / num_runs))
+            ci = [float(ci_bound) for ci_bound in skd_core_stats.get_wilson_intervals(uniform_collisions + num_collisions, num_runs)]
+            estimator = "MONTE_CARLO"
+
+        return {"CONTROLLER_MULTIPLIER" : self.controller_multiplier,
+                "COLLISION_PROBABILITY" : probability,
+                "COLLISION_PROBABILITY_STD_ERR" : std_error,
+                "COLLISION_PROBABILITY_CI" : ci,
+                "RELATIVE_STD_ERR" : (std_error / probability) if (probability > 0) else np.nan,
+                "ESTIMATOR" : estimator,
+                "CONVERGED" : converged,
+                "RARE_EVENT" : rare_event,
+                "NUM_LEVELS" : len(levels),
+                "NUM_ESTIMATE_COLLISIONS" : num_collisions,
+                "NUM_SIMULATIONS" : self.num_simulations,
+                "LEVELS" : levels}
@@ -0,0 +1,493 @@
+import os, sys
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_collision_tests_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_collision_tests_dir)
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+# Import local libraries
+import skd_collision_tests.controllers.car_controllers as car_controllers
+import skd_trajectories.trajectories_filters as traj_filters
+
+# Import third party libs
+import numpy as np
+
+
+""" Struct of arrays versions of the car and pedestrian controllers. A batch holds the state of N controllers
+in preallocated float arrays (one array per state variable) and advances all of them at once, following the
+same rules as BasicCarController and PedestrianController. The work arrays of each step are also allocated
+once, so that running a batch of collision experiments does not allocate memory per step """
+
+
+###################################### CLASS DEFINITIONS ####################################
+class BatchPedestrianController:
+    SAFE_LONGIT_POS = 0
+    SAFE_HOZ_POS = 1
+
+    """ Constructor. safe_ped_trajs is a list of N safe trajectories (lists of [longit, hoz] points or
+    SafeTrajectory objects) or an array of shape (N, steps, 2). Shorter trajectories are padded with their
+    last point, which is where the single controller stays once its trajectory is over """
+    def __init__(self, safe_ped_trajs, radius=0.34, height=1.86):
+        assert(len(safe_ped_trajs) > 0), "No safe pedestrian trajectories associated"
+        self.safe_ped_trajs = traj_filters.get_padded_trajectories(safe_ped_trajs)
+        self.num_peds = len(self.safe_ped_trajs)
+
+        # Pedestrian internals
+        self.radius = radius
+        self.height = height
+
+        # Record of the controller simulation_time_step initialize to 0
+        self.time_step = 0
+
+        # Current positions. longit_pos and hoz_pos are views of the positions array
+        self.positions = self.safe_ped_trajs[:, 0, :].copy()
+        self.longit_pos = self.positions[:, self.SAFE_LONGIT_POS]
+        self.hoz_pos = self.positions[:, self.SAFE_HOZ_POS]
+
+
+    """ Overwrites the position of the pedestrians (scalars or arrays of N values) """
+    def set_ped_positions(self, ped_longit, ped_hoz):
+        self.longit_pos[:] = ped_longit
+        self.hoz_pos[:] = ped_hoz
+
+
+    """ Updates one step of all the pedestrians """
+    def advance_step(self):
+        self.time_step += 1
+        traj_step = min(self.time_step, self.safe_ped_trajs.shape[1] - 1)
+        np.copyto(self.positions, self.safe_ped_trajs[:, traj_step, :])
+
+
+    """ Get current positions as an (N, 2) array of [longit, hoz] points. The array is updated in place """
+    def get_current_pos(self):
+        return self.positions
+
+
+    """ Get dimensions info """
+    def get_dimensions(self):
+        return [self.radius, self.height]
+
+
+    def get_num_controllers(self):
+        return self.num_peds
+
+
+
+class BatchCarController:
+    # CAR STATE INDICES (rows of the state array)
+    LONGIT_INDEX = 0
+    HOZ_INDEX = 1
+    CAR_SPEED_INDEX = 2
+    CAR_ACC_INDEX = 3
+
+    # Relative errors of the braking rate and driving speed (as in BasicCarController)
+    BRAKING_RATE_ERROR = 0.1
+    SPEED_ERROR = 0.05
+    SIMULATION_STEP_TIME = car_controllers.BasicCarController.SIMULATION_STEP_TIME
+
+    """ Constructor of a batch of num_cars basic car controllers. The multiplier (and starting positions)
+    can be given per car as arrays of num_cars values """
+    def __init__(self, num_cars, car_longit_start=100.0, car_horizontal_start=-2.0, max_speed=8.33,
+        braking_rate=-3.5, multiplier=1.0, car_dims = [4.68, 1.68]):
+        # The stopping distance is computed by the single controller so that both always agree
+        unit_controller = car_controllers.BasicCarController(max_speed=max_speed, braking_rate=braking_rate,
+                                                             multiplier=1.0, car_dims=car_dims)
+        self.num_cars = num_cars
+        self.car_length = unit_controller.car_length
+        self.car_width = unit_controller.car_width
+        self.car_max_speed = max_speed
+        self.braking_rate = braking_rate
+        self.stop_time = unit_controller.stop_time
+        self.car_stop_dist = unit_controller.car_stop_dist
+
+        # Per car multipliers and braking thresholds
+        self.multiplier = np.empty(num_cars, dtype=float)
+        self.multiplier[:] = multiplier
+        self.start_brake_dist = self.car_stop_dist * self.multiplier
+
+        # State of the cars, one row per state variable. The named attributes are views of its rows
+        self.state = np.empty((4, num_cars), dtype=float)
+        self.longit_pos = self.state[self.LONGIT_INDEX]
+        self.hoz_pos = self.state[self.HOZ_INDEX]
+        self.car_vel = self.state[self.CAR_SPEED_INDEX]
+        self.car_acc = self.state[self.CAR_ACC_INDEX]
+        self.braking = np.zeros(num_cars, dtype=bool)
+
+        # Initialize cars to driving and constant velocity
+        self.longit_pos[:] = car_longit_start
+        self.hoz_pos[:] = car_horizontal_start
+        self.car_vel[:] = max_speed
+        self.car_acc[:] = 0.0
+
+        # Uniform errors as computed by np.random.uniform (low + range * u)
+        self.braking_error_low = -self.BRAKING_RATE_ERROR * braking_rate
+        self.braking_error_range = (self.BRAKING_RATE_ERROR * braking_rate) - self.braking_error_low
+        self.speed_error_low = -self.SPEED_ERROR * max_speed
+        self.speed_error_range = (self.SPEED_ERROR * max_speed) - self.speed_error_low
+
+        # Work arrays reused by every step
+        self.start_car_vel = np.empty(num_cars, dtype=float)
+        self.braking_values = np.empty(num_cars, dtype=float)
+        self.driving_values = np.empty(num_cars, dtype=float)
+        self.driving = np.empty(num_cars, dtype=bool)
+        self.stopped = np.empty(num_cars, dtype=bool)
+        self.longit_work = np.empty(num_cars, dtype=float)
+        self.hoz_work = np.empty(num_cars, dtype=float)
+        self.bound_work = np.empty((2, num_cars), dtype=float)
+
+
+    """ Builds a batch with the parameters and state of a list of BasicCarControllers (which should
+    share their speed, braking rate and dimensions) """
+    @classmethod
+    def from_controllers(cls, car_controller_list):
+        reference = car_controller_list[0]
+        batch = cls(len(car_controller_list), max_speed=reference.car_max_speed, braking_rate=reference.braking_rate,
+                    multiplier=[controller.multiplier for controller in car_controller_list],
+                    car_dims=reference.get_car_dimensions())
+        for car_index in range(len(car_controller_list)):
+            controller = car_controller_list[car_index]
+            batch.state[:, car_index] = [controller.longit_pos, controller.hoz_pos, controller.car_vel, controller.car_acc]
+            batch.braking[car_index] = controller.braking
+        return batch
+
+
+    """ get dimensions """
+    def get_car_dimensions(self):
+        return [self.car_length, self.car_width]
+
+
+    def get_current_pos(self):
+        """ Returns the (2, N) array of [longit, hoz] rows. The array is updated in place """
+        return self.state[0:2]
+
+
+    def get_car_stop_dist(self):
+        """ Returns the unitary stopping distance of the basic controller """
+        return self.car_stop_dist
+
+
+    def get_car_start_brake_dist(self):
+        """ Returns the braking thresholds of the cars """
+        return self.start_brake_dist
+
+
+    def get_num_controllers(self):
+        return self.num_cars
+
+
+    def set_car_pos(self, start_pos_longit, start_pos_hoz):
+        """ Sets the cars to a position (scalars or arrays of N values) """
+        self.longit_pos[:] = start_pos_longit
+        self.hoz_pos[:] = start_pos_hoz
+
+
+    """ Advances every car one step against the pedestrians of a BatchPedestrianController. noise holds
+    N uniform samples in [0, 1) used for the braking rate or speed error of each car. They are drawn from
+    np.random when not given """
+    def advance_car_state(self, pedestrian_batch, noise=None):
+        if(noise is None):
+            noise = np.random.random_sample(self.num_cars)
+
+        np.copyto(self.start_car_vel, self.car_vel)
+
+        # Check is brakes are to be applied
+        np.subtract(pedestrian_batch.longit_pos, self.longit_pos, out=self.longit_work)
+        np.less_equal(self.longit_work, self.start_brake_dist, out=self.braking)
+        np.logical_not(self.braking, out=self.driving)
+
+        # Braking cars: acc = braking rate + error, vel = clamp(vel + acc * dt)
+        np.multiply(noise, self.braking_error_range, out=self.braking_values)
+        self.braking_values += self.braking_error_low
+        self.braking_values += self.braking_rate
+        np.copyto(self.car_acc, self.braking_values, where=self.braking)
+        self.braking_values *= self.SIMULATION_STEP_TIME
+        self.braking_values += self.car_vel
+
+        # Driving cars: acc = 0, vel = clamp(max speed + error)
+        np.multiply(noise, self.speed_error_range, out=self.driving_values)
+        self.driving_values += self.speed_error_low
+        self.driving_values += self.car_max_speed
+        np.copyto(self.car_acc, 0.0, where=self.driving)
+
+        np.copyto(self.car_vel, self.braking_values, where=self.braking)
+        np.copyto(self.car_vel, self.driving_values, where=self.driving)
+        np.clip(self.car_vel, 0, self.car_max_speed, out=self.car_vel)
+
+        # If velocity is down to zero, stop decelerating
+        np.less_equal(self.car_vel, 0, out=self.stopped)
+        np.copyto(self.car_acc, 0.0, where=self.stopped)
+
+        # Update longitudinal position with the speed at the start of the step
+        np.multiply(self.start_car_vel, self.SIMULATION_STEP_TIME, out=self.longit_work)
+        np.clip(self.longit_work, 0, self.car_max_speed * self.SIMULATION_STEP_TIME, out=self.longit_work)
+        self.longit_pos += self.longit_work
+
+
+    """ Checks which cars collide with their pedestrian. Results are written to out (bool array of N values) """
+    def collides(self, pedestrian_batch, out=None):
+        return self.collides_at(self.longit_pos, self.hoz_pos, pedestrian_batch.longit_pos,
+                                pedestrian_batch.hoz_pos, pedestrian_batch.radius, out)
+
+
+    def collides_at(self, car_longit, car_hoz, ped_longit, ped_hoz, ped_radius, out=None):
+        """ Vectorized car_controllers.car_collides_at for cars and pedestrians placed at the given positions """
+        if(out is None):
+            out = np.empty(self.num_cars, dtype=bool)
+
+        # Closest point of the car rectangle to the center of the pedestrian circle
+        np.subtract(ped_longit, car_longit, out=self.longit_work)
+        self.longit_work += car_longit
+        np.subtract(car_longit, self.car_length / 2.0, out=self.bound_work[0])
+        np.add(car_longit, self.car_length / 2.0, out=self.bound_work[1])
+        np.clip(self.longit_work, self.bound_work[0], self.bound_work[1], out=self.longit_work)
+        self.longit_work -= ped_longit
+
+        np.subtract(ped_hoz, car_hoz, out=self.hoz_work)
+        self.hoz_work += car_hoz
+        np.subtract(car_hoz, self.car_width / 2.0, out=self.bound_work[0])
+        np.add(car_hoz, self.car_width / 2.0, out=self.bound_work[1])
+        np.clip(self.hoz_work, self.bound_work[0], self.bound_work[1], out=self.hoz_work)
+        self.hoz_work -= ped_hoz
+
+        # Check if distance between closest point and center of circle is within the radius
+        np.hypot(self.longit_work, self.hoz_work, out=self.longit_work)
+        return np.less_equal(self.longit_work, ped_radius, out=out)
+
+
+
+###################################### BATCH SIMULATION ####################################
+# Columns of the state log, in the same order as CollisionEnvironment.get_env_state
+STATE_LOG_SIZE = 8
+STATE_LOG_BRAKING_INDEX = 6
+STATE_LOG_COLLIDED_INDEX = 7
+
+# Margin of the steps skipped by the collision checks of the closed form, which covers the rounding of the
+# interpolated points
+CLOSED_FORM_CHECK_MARGIN = 1e-6
+
+
+def run_batch_collision_experiments(pedestrian_batch, car_batch, max_num_steps=25, num_steps_check=5,
+                                    noise=None, state_log=None):
+    """ Runs one collision experiment per (pedestrian, car) pair of the batches, with the same steps
+    and intermediate collision checks as CollisionEnvironment.run_single_collision_experiment.
+    noise is an optional (max_num_steps, N) array of uniform [0, 1) samples for the car errors.
+    state_log is an optional (N, max_num_steps + 1, STATE_LOG_SIZE) array that is filled with the
+    environment state of every step. Returns the collision flag of each experiment """
+    num_runs = car_batch.get_num_controllers()
+    assert (pedestrian_batch.get_num_controllers() == num_runs), "Batches of different sizes"
+
+    # Buffers of the step
+    collided = car_batch.collides(pedestrian_batch)
+    step_collided = np.empty(num_runs, dtype=bool)
+    ped_start = np.empty((2, num_runs), dtype=float)
+    car_start = np.empty((2, num_runs), dtype=float)
+    ped_delta = np.empty((2, num_runs), dtype=float)
+    car_delta = np.empty((2, num_runs), dtype=float)
+    ped_check = np.empty((2, num_runs), dtype=float)
+    car_check = np.empty((2, num_runs), dtype=float)
+    interp_div = max(num_steps_check - 1, 1)
+
+    for step_count in range(max_num_steps):
+        # Step starting states
+        np.copyto(ped_start, pedestrian_batch.get_current_pos().T)
+        np.copyto(car_start, car_batch.get_current_pos())
+
+        if(state_log is not None):
+            log_batch_state(state_log, step_count, pedestrian_batch, car_batch, collided)
+
+        car_batch.advance_car_state(pedestrian_batch, None if (noise is None) else noise[step_count])
+        pedestrian_batch.advance_step()
+
+        # Intermediate positions between start and stop (same points as np.linspace)
+        np.subtract(pedestrian_batch.get_current_pos().T, ped_start, out=ped_delta)
+        ped_delta /= interp_div
+        np.subtract(car_batch.get_current_pos(), car_start, out=car_delta)
+        car_delta /= interp_div
+        for discretized_step in range(num_steps_check):
+            if(discretized_step == num_steps_check - 1):
+                np.copyto(ped_check, pedestrian_batch.get_current_pos().T)
+                np.copyto(car_check, car_batch.get_current_pos())
+            else:
+                np.multiply(ped_delta, discretized_step, out=ped_check)
+                ped_check += ped_start
+                np.multiply(car_delta, discretized_step, out=car_check)
+                car_check += car_start
+
+            car_batch.collides_at(car_check[0], car_check[1], ped_check[0], ped_check[1],
+                                  pedestrian_batch.radius, out=step_collided)
+            collided |= step_collided
+
+    if(state_log is not None):
+        log_batch_state(state_log, max_num_steps, pedestrian_batch, car_batch, collided)
+
+    return collided
+
+
+def run_closed_form_collision_experiments(pedestrian_batch, car_batch, max_num_steps=25, num_steps_check=5,
+                                          constant_noise=None, state_log=None):
+    """ Piecewise closed form of run_batch_collision_experiments when the noise of every run is constant over
+    its steps (constant_noise holds N uniform samples, None for the noise-free runs where the errors are zero).
+    The car then drives at a constant speed until it brakes at a constant rate, and is back to driving if the
+    pedestrian gets further than the braking distance. Each of these phases is computed for all the steps at
+    once, and the cumulative sums follow the order of the stepped additions so the states are the same.
+    The batches are not advanced. Returns the collision flag of each experiment and fills state_log as
+    run_batch_collision_experiments does """
+    num_runs = car_batch.get_num_controllers()
+    steps = np.arange(max_num_steps + 1)
+    step_time = car_batch.SIMULATION_STEP_TIME
+    if(constant_noise is None):
+        constant_noise = np.full(num_runs, 0.5)
+
+    # Positions of the pedestrians at every step, which stay at the end of their trajectories
+    traj_steps = np.minimum(pedestrian_batch.time_step + steps, pedestrian_batch.safe_ped_trajs.shape[1] - 1)
+    ped_longit = pedestrian_batch.safe_ped_trajs[:, traj_steps, pedestrian_batch.SAFE_LONGIT_POS]
+    ped_hoz = pedestrian_batch.safe_ped_trajs[:, traj_steps, pedestrian_batch.SAFE_HOZ_POS]
+
+    # Velocity changes of the braking steps and speeds of the driving steps, as in advance_car_state
+    braking_acc = constant_noise * car_batch.braking_error_range + car_batch.braking_error_low + car_batch.braking_rate
+    braking_delta = braking_acc * step_time
+    driving_vel = np.clip(constant_noise * car_batch.speed_error_range + car_batch.speed_error_low + car_batch.car_max_speed,
+                          0, car_batch.car_max_speed)
+
+    car_longit = np.empty((num_runs, max_num_steps + 1))
+    car_vel = np.empty((num_runs, max_num_steps + 1))
+    braking = np.zeros((num_runs, max_num_steps + 1), dtype=bool)
+
+    # Every run starts a phase at its first step, in the mode of the braking decision of that step
+    phase_start = np.zeros(num_runs, dtype=int)
+    phase_longit = car_batch.longit_pos.copy()
+    phase_vel = car_batch.car_vel.copy()
+    phase_braking = (ped_longit[:, 0] - phase_longit) <= car_batch.start_brake_dist
+    pending = np.ones(num_runs, dtype=bool)
+    while(np.any(pending)):
+        runs = np.flatnonzero(pending)
+        phase_steps = steps - phase_start[runs, None]
+
+        # Velocities of the phase: braking steps add braking_delta until the car stops, driving steps are at the
+        # driving speed. Positions add the displacement of the velocity at the start of each step
+        vel_increments = np.where(phase_steps > 0, braking_delta[runs, None], 0.0)
+        vel_increments[phase_steps == 0] = phase_vel[runs]
+        vel = np.where(phase_braking[runs, None], np.clip(np.cumsum(vel_increments, axis=1), 0, car_batch.car_max_speed),
+                       np.where(phase_steps > 0, driving_vel[runs, None], phase_vel[runs, None]))
+        longit_increments = np.zeros(phase_steps.shape)
+        longit_increments[:, 1:] = np.clip(vel[:, :-1] * step_time, 0, car_batch.car_max_speed * step_time)
+        longit_increments[phase_steps <= 0] = 0.0
+        longit_increments[phase_steps == 0] = phase_longit[runs]
+        longit = np.cumsum(longit_increments, axis=1)
+
+        # The phase lasts until the first step whose braking decision is the opposite mode
+        decisions = (ped_longit[runs] - longit) <= car_batch.start_brake_dist[runs, None]
+        switches = (decisions != phase_braking[runs, None]) & (phase_steps > 0) & (steps < max_num_steps)
+        switched = np.any(switches, axis=1)
+        phase_end = np.where(switched, np.argmax(switches, axis=1), max_num_steps)
+
+        in_phase = (phase_steps >= 0) & (steps <= phase_end[:, None])
+        car_longit[runs] = np.where(in_phase, longit, car_longit[runs])
+        car_vel[runs] = np.where(in_phase, vel, car_vel[runs])
+        braking[runs] = np.where(in_phase & (steps < phase_end[:, None]), phase_braking[runs, None], braking[runs])
+
+        switched_runs = runs[switched]
+        phase_start[switched_runs] = phase_end[switched]
+        phase_longit[switched_runs] = longit[switched, phase_end[switched]]
+        phase_vel[switched_runs] = vel[switched, phase_end[switched]]
+        phase_braking[switched_runs] = ~phase_braking[switched_runs]
+        pending[runs[~switched]] = False
+
+    car_hoz = np.broadcast_to(car_batch.hoz_pos[:, None], car_longit.shape)
+    collided_at_steps = get_collided_at_steps(car_longit, car_hoz, car_batch.car_length, car_batch.car_width,
+                                              ped_longit, ped_hoz, pedestrian_batch.radius, num_steps_check)
+
+    if(state_log is not None):
+        # The logged acceleration and braking flag of a step are the ones set by the previous step
+        car_acc = np.where(braking[:, :-1] & (car_vel[:, 1:] > 0), braking_acc[:, None], 0.0)
+        state_log[:, :, 0] = ped_longit
+        state_log[:, :, 1] = ped_hoz
+        state_log[:, :, 2] = car_longit
+        state_log[:, :, 3] = car_batch.hoz_pos[:, None]
+        state_log[:, :, 4] = car_vel
+        state_log[:, 0, 5] = car_batch.car_acc
+        state_log[:, 1:, 5] = car_acc
+        state_log[:, 0, STATE_LOG_BRAKING_INDEX] = car_batch.braking
+        state_log[:, 1:, STATE_LOG_BRAKING_INDEX] = braking[:, :-1]
+        state_log[:, :, STATE_LOG_COLLIDED_INDEX] = collided_at_steps
+
+    return collided_at_steps[:, -1]
+
+
+def get_collided_at_steps(car_longit, car_hoz, car_length, car_width, ped_longit, ped_hoz, ped_radius, num_steps_check=5):
+    """ Collision flags at every step of (N, steps + 1) car and pedestrian positions, with the intermediate checks
+    of run_batch_collision_experiments. The checked points are between the positions at the ends of a step, so
+    only the steps where the pedestrian is not clear of the car at both ends on the same side are checked.
+    Returns an (N, steps + 1) array where a run stays collided from its first collision """
+    num_runs, num_states = car_longit.shape
+    longit_reach = car_length / 2.0 + ped_radius + CLOSED_FORM_CHECK_MARGIN
+    hoz_reach = car_width / 2.0 + ped_radius + CLOSED_FORM_CHECK_MARGIN
+    longit_gaps = ped_longit - car_longit
+    hoz_gaps = ped_hoz - car_hoz
+    clear_steps = (((longit_gaps[:, :-1] > longit_reach) & (longit_gaps[:, 1:] > longit_reach)) |
+                   ((longit_gaps[:, :-1] < -longit_reach) & (longit_gaps[:, 1:] < -longit_reach)) |
+                   ((hoz_gaps[:, :-1] > hoz_reach) & (hoz_gaps[:, 1:] > hoz_reach)) |
+                   ((hoz_gaps[:, :-1] < -hoz_reach) & (hoz_gaps[:, 1:] < -hoz_reach)))
+    check_runs, check_steps = np.nonzero(~clear_steps)
+
+    interp_div = max(num_steps_check - 1, 1)
+    check_points = [get_interpolated_checks(values[check_runs, check_steps], values[check_runs, check_steps + 1],
+                                            interp_div, num_steps_check)
+                    for values in (car_longit, car_hoz, ped_longit, ped_hoz)]
+    step_collisions = np.zeros((num_runs, num_states - 1), dtype=bool)
+    step_collisions[check_runs, check_steps] = get_collisions_at(check_points[0], check_points[1], car_length, car_width,
+                                                                 check_points[2], check_points[3], ped_radius).any(axis=1)
+    initial_collisions = get_collisions_at(car_longit[:, 0], car_hoz[:, 0], car_length, car_width,
+                                           ped_longit[:, 0], ped_hoz[:, 0], ped_radius)
+    return np.logical_or.accumulate(np.column_stack([initial_collisions, step_collisions]), axis=1)
+
+
+def get_interpolated_checks(starts, ends, interp_div, num_steps_check):
+    """ (M, num_steps_check) points between M starts and ends, computed as the intermediate checks of
+    run_batch_collision_experiments (the last check is the end of the step) """
+    checks = starts[:, None] + ((ends - starts) / interp_div)[:, None] * np.arange(num_steps_check)
+    checks[:, -1] = ends
+    return checks
+
+
+def get_collisions_at(car_longit, car_hoz, car_length, car_width, ped_longit, ped_hoz, ped_radius):
+    """ Broadcasting version of car_controllers.car_collides_at, with the operations of BatchCarController.collides_at """
+    closest_longit = np.clip((ped_longit - car_longit) + car_longit, car_longit - car_length / 2.0,
+                             car_longit + car_length / 2.0) - ped_longit
+    closest_hoz = np.clip((ped_hoz - car_hoz) + car_hoz, car_hoz - car_width / 2.0, car_hoz + car_width / 2.0) - ped_hoz
+    return np.hypot(closest_longit, closest_hoz) <= ped_radius
+
+
+def log_batch_state(state_log, step, pedestrian_batch, car_batch, collided):
+    """ Writes the environment state of a step for every run in the batch """
+    state_log[:, step, 0:2] = pedestrian_batch.get_current_pos()
+    state_log[:, step, 2:6] = car_batch.state.T
+    state_log[:, step, STATE_LOG_BRAKING_INDEX] = car_batch.braking
+    state_log[:, step, STATE_LOG_COLLIDED_INDEX] = collided
+
+
+def get_state_log_clearances(state_log, car_dims, ped_radius):
+    """ Smallest distance between the pedestrian circle and the car rectangle over the logged steps
+    of every run (negative when they overlap) """
+    longit_gaps = np.abs(state_log[:, :, 0] - state_log[:, :, 2]) - car_dims[0] / 2.0
+    hoz_gaps = np.abs(state_log[:, :, 1] - state_log[:, :, 3]) - car_dims[1] / 2.0
+    rect_dists = np.hypot(longit_gaps.clip(min=0), hoz_gaps.clip(min=0)) + np.minimum(np.maximum(longit_gaps, hoz_gaps), 0)
+    return (rect_dists - ped_radius).min(axis=1)
+
+
+def get_collision_scores(state_log, collided, car_dims, ped_radius):
+    """ Scores of the runs of a state log: their smallest clearance to the car, zero or less for the
+    runs that collided (including the collisions found by the intermediate checks) """
+    clearances = get_state_log_clearances(state_log, car_dims, ped_radius)
+    return np.where(collided, np.minimum(clearances, 0.0), clearances)
+
+
+def get_state_log_entries(run_state_log):
+    """ Converts the state log of a run into the step entries of CollisionEnvironment.get_env_state """
+    step_entries = run_state_log.tolist()
+    for step_entry in step_entries:
+        step_entry[STATE_LOG_BRAKING_INDEX] = bool(step_entry[STATE_LOG_BRAKING_INDEX])
+        step_entry[STATE_LOG_COLLIDED_INDEX] = bool(step_entry[STATE_LOG_COLLIDED_INDEX])
+    return step_entries
@@ -13,6 +13,7 @@ import skd_collision_tests.controllers.pedestrian_controllers as pedestrian_cont
 
 # Import third party libs
 import numpy as np
+import math
 import copy
 
 
@@ -38,9 +39,29 @@ def clamp(value, min_val, max_val):
     return value
 
 
+""" Checks if a pedestrian circle overlaps the car rectangle. Works on plain floats so that it can be called
+at every (intermediate) step of a simulation without creating controllers, lists or arrays """
+def car_collides_at(car_longit, car_hoz, car_length, car_width, ped_longit, ped_hoz, ped_radius):
+    # Compute closest point to the circle from the center of the rectangle
+    closest_car_longit = clamp(car_longit + (ped_longit - car_longit),
+                               car_longit - (car_length / 2.0),
+                               car_longit + (car_length / 2.0))
+
+    closest_car_hoz = clamp(car_hoz + (ped_hoz - car_hoz),
+                            car_hoz - (car_width / 2.0),
+                            car_hoz + (car_width / 2.0))
+
+    # Check if distance between closest point and center of circle is within the radius
+    return math.hypot(closest_car_longit - ped_longit, closest_car_hoz - ped_hoz) <= ped_radius
+
+
 
 """ Models a basic car controller """
 class BasicCarController:
+    # Fixed attribute layout (no per instance dict) for the controllers created on every run
+    __slots__ = ("car_length", "car_width", "longit_pos", "hoz_pos", "car_acc", "braking", "throttle_rate",
+                 "car_vel", "car_max_speed", "braking_rate", "multiplier", "stop_time", "car_stop_dist",
+                 "car_padding_dist", "start_brake_dist", "random_state")
 
     # CAR STATE INDICES
     LONGIT_INDEX = 0
@@ -54,7 +75,7 @@ class BasicCarController:
     SIMULATION_STEP_TIME = 0.3
     """ Constructor of the car class """
     def __init__(self, car_longit_start=100.0, car_horizontal_start=-2.0, max_speed=8.33, 
-        braking_rate=-3.5, multiplier=1.0, car_dims = [4.68, 1.68]):
+        braking_rate=-3.5, multiplier=1.0, car_dims = [4.68, 1.68], random_state=None):
          # Car's internal information
         self.car_length = car_dims[0]
         self.car_width = car_dims[1]
@@ -74,6 +95,9 @@ class BasicCarController:
         self.braking_rate = braking_rate
         self.multiplier = float(multiplier)
 
+        # Source of the speed and braking errors (the global np.random stream unless given a RandomState)
+        self.random_state = np.random if (random_state is None) else random_state
+
         # Calculate stopping distance for this controller
         self.stop_time = abs(self.car_max_speed / self.braking_rate)
 
@@ -166,24 +190,18 @@ class BasicCarController:
     can be used to update the information of the car"""
     def advance_car_state(self, pedestrian_controller):
         # Get the pedestrian's info (perfect observation)
-        ped_dimensions =  pedestrian_controller.get_dimensions()
-        ped_position = pedestrian_controller.get_current_pos()
+        # Speed at the start of the step
+        start_car_vel = self.car_vel
 
-        # Get current car state
-        current_car_state = self.get_car_state()
-
-        # Compute relative distance between ped and car controllers
-        rel_ped_from_car = np.subtract(pedestrian_controller.get_current_pos(), self.get_current_pos())
-
-        # Check is brakes are to be applied
-        self.braking = self.need_to_brake(rel_ped_from_car)
+        # Check is brakes are to be applied, based on the relative distance between ped and car controllers
+        self.braking = self.need_to_brake_at(pedestrian_controller.longit_pos - self.longit_pos)
 
 
         # Update car state
         # Check for change to braking
         if (self.braking):
             # Add error to the braking rate of the car controllers
-            acc_error = np.random.uniform(-0.1 * self.braking_rate, 0.1 * self.braking_rate, 1)
+            acc_error = self.random_state.uniform(-0.1 * self.braking_rate, 0.1 * self.braking_rate)
             self.car_acc = self.braking_rate + float(acc_error)
             # Update velocity based on braking rate
             self.car_vel =  clamp(self.car_vel + (self.car_acc *  self.SIMULATION_STEP_TIME), 0, self.car_max_speed)
@@ -192,7 +210,7 @@ class BasicCarController:
             self.car_acc = 0
             self.car_vel = self.car_max_speed
             # Update the speed parameter of the car with some error
-            speed_error = np.random.uniform(-0.05 * self.car_max_speed, 0.05 * self.car_max_speed)
+            speed_error = self.random_state.uniform(-0.05 * self.car_max_speed, 0.05 * self.car_max_speed)
             self.car_vel = clamp(self.car_vel + speed_error, 0, self.car_max_speed)
 
 
@@ -203,9 +221,8 @@ class BasicCarController:
 
        
 
-        # Update longitudinal position according to (vot + 1/2(a)(t^2)
-        step_displacement = (current_car_state[self.CAR_SPEED_INDEX] * self.SIMULATION_STEP_TIME) 
-        + (0.5 * self.car_acc * self.SIMULATION_STEP_TIME * self.SIMULATION_STEP_TIME)
+        # Update longitudinal position with the speed at the start of the step
+        step_displacement = (start_car_vel * self.SIMULATION_STEP_TIME) 
        
         # Clamp displacement to avoid negative displacement
         step_displacement = clamp(step_displacement, 0, self.car_max_speed * self.SIMULATION_STEP_TIME)
@@ -217,46 +234,22 @@ class BasicCarController:
     """ Method to query if the car should change to "is_braking = True" mode, based on the 
     stopping distance assigned to the car """
     def need_to_brake(self, rel_ped_to_car):
-        # Start breaking if condition is met
-        if (rel_ped_to_car[self.LONGIT_INDEX]) <= self.start_brake_dist:
-            return True
+        return self.need_to_brake_at(rel_ped_to_car[self.LONGIT_INDEX])
+
 
-        # Otherwise, return false
-        return False
+    def need_to_brake_at(self, rel_ped_longit):
+        """ need_to_brake given only the longitudinal distance from the car to the pedestrian """
+        # Start breaking if condition is met
+        return rel_ped_longit <= self.start_brake_dist
 
 
     """ Method to check if car collided with a particular pedestrian controller """
     def collides(self, pedestrian_controller):
-        # PED INFO
-        RADIUS_INDEX = 0
-
-        # Compute the difference vector between the centers
-        ped_loc = pedestrian_controller.get_current_pos()
-        car_loc = self.get_current_pos()
-        rel_ped_to_car = np.subtract(ped_loc, car_loc)
-
-        # Compute closest point to the circle from the center of the rectangle
-        closest_car_longit = clamp(car_loc[self.LONGIT_INDEX] + rel_ped_to_car[self.LONGIT_INDEX],
-                                   car_loc[self.LONGIT_INDEX] - (self.car_length / 2.0),
-                                   car_loc[self.LONGIT_INDEX] + (self.car_length / 2.0))
-
-        closest_car_hoz = clamp(car_loc[self.HOZ_INDEX] + rel_ped_to_car[self.HOZ_INDEX],
-                                car_loc[self.HOZ_INDEX] - (self.car_width / 2.0),
-                                car_loc[self.HOZ_INDEX] + (self.car_width / 2.0))
-
-        closest_point = np.array([closest_car_longit, closest_car_hoz])
-
-        # Compute distance between closest point and center of circle
-        diff_vec = np.subtract(closest_point, ped_loc)
-        distance = np.linalg.norm(diff_vec)
-
-        # Check if distance is greater than radius of pedestrian circle
-        ped_dimensions = pedestrian_controller.get_dimensions()
-
-        if (distance <= ped_dimensions[RADIUS_INDEX]):
-            return True
-
-        # Otherwise, return False
-        return False
+        return self.collides_at(self.longit_pos, self.hoz_pos, pedestrian_controller.longit_pos,
+                                pedestrian_controller.hoz_pos, pedestrian_controller.radius)
 
 
+    def collides_at(self, car_longit, car_hoz, ped_longit, ped_hoz, ped_radius):
+        """ Checks if the car would collide with a pedestrian when both are placed at the given
+        positions, without moving either controller """
+        return car_collides_at(car_longit, car_hoz, self.car_length, self.car_width, ped_longit, ped_hoz, ped_radius)
@@ -0,0 +1,158 @@
+import os, sys
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_collision_tests_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_collision_tests_dir)
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+# Import local libraries
+import skd_collision_tests.controllers.car_controllers as car_controllers
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
+import skd_trajectories.trajectories_filters as traj_filters
+
+# Import third party libs
+import numpy as np
+
+
+""" Space-time occupancy tables of the noise-free basic car controller. Without noise, the car drives at its
+speed until the first step where the pedestrian is within its braking distance, and brakes from then on. Its
+sweep only depends on that braking step, so the states of every braking step are tabulated once per controller
+parameters and multiplier (by stepping a BatchCarController, so they are the ones of the simulator). Checking a
+batch of safe trajectories is then a lookup of the braking step of each one and of its row of the table. Runs
+where the car releases the brakes (the pedestrian gets further than the braking distance again) are not in the
+table, and are evaluated with batch_controllers.run_closed_form_collision_experiments """
+
+
+###################################### CLASS DEFINITIONS ####################################
+class CarSweepTable:
+    """ States of the noise-free car of a multiplier for every braking step, relative to its starting position.
+    Row k of the (max_num_steps + 1, ...) arrays is the car that brakes from step k, and the last row is the car
+    that never brakes. States are indexed by the step as in the state logs of the collision experiments """
+    def __init__(self, multiplier=1.0, max_num_steps=25, max_speed=8.33, braking_rate=-3.5, car_dims=[4.68, 1.68]):
+        self.multiplier = float(multiplier)
+        self.max_num_steps = max_num_steps
+        self.max_speed = max_speed
+        self.braking_rate = braking_rate
+        num_rows = max_num_steps + 1
+
+        car_batch = batch_controllers.BatchCarController(num_rows, car_longit_start=0.0, max_speed=max_speed,
+                                                         braking_rate=braking_rate, multiplier=multiplier, car_dims=car_dims)
+        self.car_length = car_batch.car_length
+        self.car_width = car_batch.car_width
+        self.car_stop_dist = car_batch.get_car_stop_dist()
+        self.start_brake_dist = car_batch.get_car_start_brake_dist()[0]
+
+        # Longitudinal displacements of the steps, and velocities, accelerations and braking flags of the states
+        self.longit_increments = np.empty((num_rows, max_num_steps))
+        self.car_vel = np.empty((num_rows, num_rows))
+        self.car_acc = np.empty((num_rows, num_rows))
+        self.braking = np.empty((num_rows, num_rows), dtype=bool)
+        self.car_vel[:, 0] = car_batch.car_vel
+        self.car_acc[:, 0] = car_batch.car_acc
+        self.braking[:, 0] = car_batch.braking
+
+        # A pedestrian that is always within (or out of) the braking distance sets the braking decisions of the rows
+        braking_steps = np.arange(num_rows)
+        pedestrian_batch = batch_controllers.BatchPedestrianController(np.zeros((num_rows, 1, 2)))
+        for step in range(max_num_steps):
+            pedestrian_batch.set_ped_positions(np.where(braking_steps <= step, -np.inf, np.inf), 0.0)
+            car_batch.advance_car_state(pedestrian_batch, np.full(num_rows, 0.5))
+            # The increment is the clipped displacement added by advance_car_state
+            self.longit_increments[:, step] = car_batch.longit_work
+            self.car_vel[:, step + 1] = car_batch.car_vel
+            self.car_acc[:, step + 1] = car_batch.car_acc
+            self.braking[:, step + 1] = car_batch.braking
+
+
+    def get_car_longit(self, car_start_longit, braking_steps):
+        """ (N, max_num_steps + 1) longitudinal positions of cars started at car_start_longit that brake from
+        braking_steps. The increments are added in the order of the simulator, so the positions are the same """
+        return np.cumsum(np.column_stack([car_start_longit, self.longit_increments[braking_steps]]), axis=1)
+
+
+    def get_braking_steps(self, car_start_longit, ped_longit):
+        """ Braking step of every car against the (N, max_num_steps + 1) pedestrian positions, and whether the car
+        keeps braking until the end (the runs whose sweep is in the table) """
+        num_runs = len(car_start_longit)
+        driving_longit = self.get_car_longit(car_start_longit, np.full(num_runs, self.max_num_steps))
+        decisions = (ped_longit[:, :-1] - driving_longit[:, :-1]) <= self.start_brake_dist
+        braking_steps = np.where(np.any(decisions, axis=1), np.argmax(decisions, axis=1), self.max_num_steps)
+
+        car_longit = self.get_car_longit(car_start_longit, braking_steps)
+        after_braking = np.arange(self.max_num_steps) >= braking_steps[:, None]
+        released = after_braking & ((ped_longit[:, :-1] - car_longit[:, :-1]) > self.start_brake_dist)
+        return braking_steps, car_longit, ~np.any(released, axis=1)
+
+
+    def run_collision_experiments(self, safe_trajs, car_start_pos, num_steps_check=5, ped_radius=0.34, state_log=None):
+        """ Noise-free collision experiments of the safe trajectories (as accepted by BatchPedestrianController)
+        against cars started at the (N, 2) car_start_pos. Returns the collision flag of each experiment, and fills
+        state_log as batch_controllers.run_batch_collision_experiments does """
+        padded_trajs = traj_filters.get_padded_trajectories(safe_trajs)
+        traj_steps = np.minimum(np.arange(self.max_num_steps + 1), padded_trajs.shape[1] - 1)
+        ped_longit = padded_trajs[:, traj_steps, batch_controllers.BatchPedestrianController.SAFE_LONGIT_POS]
+        ped_hoz = padded_trajs[:, traj_steps, batch_controllers.BatchPedestrianController.SAFE_HOZ_POS]
+        car_start_pos = np.asarray(car_start_pos, dtype=float)
+
+        braking_steps, car_longit, in_table = self.get_braking_steps(car_start_pos[:, 0], ped_longit)
+        car_hoz = np.broadcast_to(car_start_pos[:, 1:2], car_longit.shape)
+        collided_at_steps = batch_controllers.get_collided_at_steps(car_longit, car_hoz, self.car_length, self.car_width,
+                                                                    ped_longit, ped_hoz, ped_radius, num_steps_check)
+        if(state_log is not None):
+            state_log[:, :, 0] = ped_longit
+            state_log[:, :, 1] = ped_hoz
+            state_log[:, :, 2] = car_longit
+            state_log[:, :, 3] = car_hoz
+            state_log[:, :, 4] = self.car_vel[braking_steps]
+            state_log[:, :, 5] = self.car_acc[braking_steps]
+            state_log[:, :, batch_controllers.STATE_LOG_BRAKING_INDEX] = self.braking[braking_steps]
+            state_log[:, :, batch_controllers.STATE_LOG_COLLIDED_INDEX] = collided_at_steps
+        collided = collided_at_steps[:, -1]
+
+        # Runs that release the brakes are evaluated with the closed form
+        released_runs = np.flatnonzero(~in_table)
+        if(len(released_runs) > 0):
+            pedestrian_batch = batch_controllers.BatchPedestrianController(padded_trajs[released_runs], radius=ped_radius)
+            car_batch = batch_controllers.BatchCarController(len(released_runs), multiplier=self.multiplier,
+                            max_speed=self.max_speed, braking_rate=self.braking_rate,
+                            car_dims=[self.car_length, self.car_width])
+            car_batch.set_car_pos(car_start_pos[released_runs, 0], car_start_pos[released_runs, 1])
+            released_log = None if (state_log is None) else np.empty((len(released_runs),) + state_log.shape[1:])
+            collided[released_runs] = batch_controllers.run_closed_form_collision_experiments(pedestrian_batch, car_batch,
+                                                            self.max_num_steps, num_steps_check, state_log=released_log)
+            if(state_log is not None):
+                state_log[released_runs] = released_log
+
+        return collided
+
+
+
+class CarSweepCache:
+    """ Sweep tables of the noise-free basic car controller, built on first use for every multiplier """
+    def __init__(self, max_num_steps=25, max_speed=8.33, braking_rate=-3.5, car_dims=[4.68, 1.68]):
+        self.max_num_steps = max_num_steps
+        self.car_params = {"max_speed" : max_speed, "braking_rate" : braking_rate, "car_dims" : list(car_dims)}
+        self.sweep_tables = {}
+
+
+    def get_sweep_table(self, multiplier):
+        multiplier = float(multiplier)
+        if(multiplier not in self.sweep_tables):
+            self.sweep_tables[multiplier] = CarSweepTable(multiplier, self.max_num_steps, **self.car_params)
+        return self.sweep_tables[multiplier]
+
+
+    def get_collisions(self, safe_trajs, controller_multipliers, num_steps_check=5, car_lane_pos_hoz=-2, ped_radius=0.34):
+        """ Noise-free collision flags of the safe trajectories against the car of every multiplier, started as
+        in the collision experiments. Returns an (N, num_multipliers) array """
+        padded_trajs = traj_filters.get_padded_trajectories(safe_trajs)
+        car_start_pos = traj_filters.get_batch_car_starting_pos(padded_trajs,
+                            [car_controllers.BasicCarController(multiplier=float(controller_multiplier), **self.car_params)
+                             for controller_multiplier in controller_multipliers], car_lane_pos_hoz)
+        collisions = np.empty((len(padded_trajs), len(controller_multipliers)), dtype=bool)
+        for multiplier_index, controller_multiplier in enumerate(controller_multipliers):
+            collisions[:, multiplier_index] = self.get_sweep_table(controller_multiplier).run_collision_experiments(
+                                                    padded_trajs, car_start_pos[:, multiplier_index], num_steps_check, ped_radius)
+        return collisions
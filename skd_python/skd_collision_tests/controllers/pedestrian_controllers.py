@@ -37,6 +37,9 @@ def clamp(value, min_val, max_val):
 
 ###################################### CLASS DEFINITIONS ####################################
 class PedestrianController:
+    # Fixed attribute layout (no per instance dict) for the controllers created on every run
+    __slots__ = ("safe_ped_traj", "radius", "height", "time_step", "longit_pos", "hoz_pos")
+
     SAFE_LONGIT_POS = 0
     SAFE_HOZ_POS = 1
 
@@ -54,7 +57,7 @@ class PedestrianController:
         self.time_step = 0
 
         # Initiate the controller to the starting point of the ped
-        starting_point = copy.deepcopy(safe_ped_traj[0])
+        starting_point = safe_ped_traj[0]
     
     
         self.longit_pos = starting_point[self.SAFE_LONGIT_POS]
@@ -77,10 +80,11 @@ class PedestrianController:
 
         # Move the pedestrian one step in the safe trajectory
         # Update pos
+        # (the point is only read, so it is not copied)
         if(self.time_step < len(self.safe_ped_traj)):
-            current_safe_ped_point = copy.deepcopy(self.safe_ped_traj[self.time_step])
+            current_safe_ped_point = self.safe_ped_traj[self.time_step]
         else:
-            current_safe_ped_point = copy.deepcopy(self.safe_ped_traj[-1])
+            current_safe_ped_point = self.safe_ped_traj[-1]
         self.longit_pos = current_safe_ped_point[self.SAFE_LONGIT_POS]
         self.hoz_pos = current_safe_ped_point[self.SAFE_HOZ_POS]
 
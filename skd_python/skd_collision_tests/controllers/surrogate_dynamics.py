@@ -0,0 +1,237 @@
+import os, sys
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_collision_tests_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_collision_tests_dir)
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+# Import local libraries
+import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+
+# Import third party libs
+import numpy as np
+import scipy.spatial
+
+
+""" Python version of the transition model of the SafeTrajGen planner plugin. The car dynamics (dynamicsDB.csv)
+and car intention (discretizeIntentions.csv) tables used by the plugin are loaded once (through a binary cache of
+the csv files) and indexed with KD-trees over their input columns, queried with the manhattan distance as in the
+plugin. States, actions and noise are arrays of N rows, so many states are propagated with a few array operations """
+
+# Location of the tables, as set in the planner configs by the safe trajectory generator
+DYNAMICS_FILES_DIR = os.path.dirname(skd_python_dir) + "/skd_oppt/dynamics_files"
+DYNAMICS_DB_FILE = DYNAMICS_FILES_DIR + "/dynamicsDB.csv"
+INTENTIONS_FILE = DYNAMICS_FILES_DIR + "/discretizeIntentions.csv"
+
+# Suffix of the binary caches of the csv tables
+TABLE_CACHE_SUFFIX = ".cache.npz"
+
+# State vector indices (STATE_INFO of the plugins)
+STATE_PED_LONG = 0
+STATE_PED_HOZ = 1
+STATE_VEH_LONG = 2
+STATE_VEH_HOZ = 3
+STATE_VEH_SPEED = 4
+STATE_VEH_INTENTION = 5
+STATE_SPACE_SIZE = 6
+
+# Car intentions (CAR_INTENTIONS of the plugins)
+INTENTION_HAZARD_STOP = 0.0
+INTENTION_CRUISING = 3.0
+
+# Columns of the tables. Inputs come first, the rest are the looked up outputs
+DYNAMICS_NUM_INPUTS = 3      # speed, throttle, brake
+DYNAMICS_DELTA_LONGIT = 0    # Output columns
+DYNAMICS_DELTA_SPEED = 1
+INTENTIONS_NUM_INPUTS = 3    # relative longitudinal bin, relative horizontal bin, intention
+INTENTIONS_PROBABILITY = 0   # Output column
+
+
+def load_table(csv_path, cache_dir=None):
+    """ Loads a csv table of floats. The parsed table is kept in a binary cache (next to the csv unless a
+    cache_dir is given) that is used while the size and modification time of the csv do not change """
+    csv_stat = os.stat(csv_path)
+    cache_dir = os.path.dirname(os.path.abspath(csv_path)) if (cache_dir is None) else cache_dir
+    cache_path = os.path.join(cache_dir, os.path.basename(csv_path) + TABLE_CACHE_SUFFIX)
+
+    if(os.path.isfile(cache_path)):
+        with np.load(cache_path) as table_cache:
+            if(int(table_cache["source_size"]) == csv_stat.st_size and
+                    int(table_cache["source_mtime_ns"]) == csv_stat.st_mtime_ns):
+                return table_cache["table"]
+
+    table = np.loadtxt(csv_path, delimiter=",", ndmin=2)
+    try:
+        if(not os.path.isdir(cache_dir)):
+            os.makedirs(cache_dir)
+        np.savez(cache_path, table=table, source_size=csv_stat.st_size, source_mtime_ns=csv_stat.st_mtime_ns)
+    except OSError as error:
+        # The tables can still be used without a cache (e.g read only checkouts)
+        print(error)
+
+    return table
+
+
+
+""" Nearest neighbour lookup table. The first num_inputs columns of the table are the keys """
+class LookupTable:
+    def __init__(self, table, num_inputs):
+        self.table = np.asarray(table, dtype=float)
+        self.num_inputs = num_inputs
+        self.input_tree = scipy.spatial.cKDTree(self.table[:, 0:num_inputs])
+
+    def get_num_entries(self):
+        return len(self.table)
+
+    def query(self, inputs):
+        """ Returns the output columns of the entries nearest (manhattan distance) to the (N, num_inputs) inputs """
+        input_dists, entry_indices = self.input_tree.query(np.asarray(inputs, dtype=float).reshape(-1, self.num_inputs), p=1)
+        return self.table[entry_indices, self.num_inputs:]
+
+
+
+""" Transition model of the SafeTrajGen plugin over batches of states """
+class SurrogateTransitionModel:
+    # Car constants of the plugin
+    CAR_STEP_TIME = 0.1
+    CAR_MAX_SPEED = 8.33
+    CRUISING_THROTTLE = 0.8
+    CRUISING_PROBABILITY_THRESHOLD = 0.8
+    SPEED_ERROR_RATE = 0.2
+    CAR_HOZ_BOUNDS = (-1.8, -1.6)
+    PED_HOZ_BOUNDS = (-4.5, 3.75)
+
+    """ Constructor. The defaults are the options of config/SafeTrajGen.cfg """
+    def __init__(self, dynamics_db_file=DYNAMICS_DB_FILE, intentions_file=INTENTIONS_FILE, cache_dir=None,
+                 step_time=0.3, intention_discretization=[15, 15], intention_discretization_lower=[-8.75, -6.72],
+                 intention_discretization_upper=[20, 5.85], car_dims=[4.68, 1.88], ped_radius=0.34):
+        self.dynamics_table = LookupTable(load_table(dynamics_db_file, cache_dir), DYNAMICS_NUM_INPUTS)
+        self.intentions_table = LookupTable(load_table(intentions_file, cache_dir), INTENTIONS_NUM_INPUTS)
+
+        # The car is propagated in CAR_STEP_TIME sub steps for each step of the pedestrian
+        self.step_time = step_time
+        self.num_car_substeps = max(1, int(round(step_time / self.CAR_STEP_TIME)))
+
+        # Bins of the relative positions in the intentions table
+        self.intention_lower = np.array(intention_discretization_lower, dtype=float)
+        self.intention_bin_sizes = (np.abs(np.array(intention_discretization_upper, dtype=float) - self.intention_lower)
+                                    / np.array(intention_discretization, dtype=float))
+
+        self.car_length = car_dims[0]
+        self.car_width = car_dims[1]
+        self.ped_radius = ped_radius
+
+
+    @classmethod
+    def from_oppt_cfg(cls, cfg_path, cache_dir=None):
+        """ Creates the model with the options (tables, step time, intention bins and dimensions) of a planner cfg """
+        cfg_sections = skd_core_utils.load_oppt_cfg(cfg_path)
+        cfg_options = {"step_time" : skd_core_utils.get_oppt_cfg_value(cfg_sections, "fixedStepTime", 0.3),
+                       "intention_discretization" : skd_core_utils.get_oppt_cfg_value(cfg_sections, "intentionDiscretization", [15, 15]),
+                       "intention_discretization_lower" : skd_core_utils.get_oppt_cfg_value(cfg_sections, "intentionDiscretizationLower", [-8.75, -6.72]),
+                       "intention_discretization_upper" : skd_core_utils.get_oppt_cfg_value(cfg_sections, "intentionDiscretizationUpper", [20, 5.85]),
+                       "car_dims" : skd_core_utils.get_oppt_cfg_value(cfg_sections, "carDimensions", [4.68, 1.88])[0:2],
+                       "ped_radius" : skd_core_utils.get_oppt_cfg_value(cfg_sections, "pedDimensions", [0.34])[0]}
+
+        # Empty table options (as in the templates) keep the default tables
+        for table_option, table_arg in (("dynamicsModelFile", "dynamics_db_file"), ("intentionModelFile", "intentions_file")):
+            table_file = skd_core_utils.get_oppt_cfg_value(cfg_sections, table_option, "")
+            if(isinstance(table_file, str) and len(table_file) > 0):
+                cfg_options[table_arg] = table_file
+
+        return cls(cache_dir=cache_dir, **cfg_options)
+
+
+    def estimate_car_intentions(self, rel_ped_longit, rel_ped_hoz):
+        """ Returns the intentions of the cars given the positions of the pedestrians relative to them. A car
+        cruises when the table gives a cruising probability above CRUISING_PROBABILITY_THRESHOLD """
+        rel_ped_longit = np.asarray(rel_ped_longit, dtype=float)
+        intention_inputs = np.empty(rel_ped_longit.shape + (INTENTIONS_NUM_INPUTS,))
+        intention_inputs[..., 0] = np.floor((rel_ped_longit - self.intention_lower[0]) / self.intention_bin_sizes[0])
+        intention_inputs[..., 1] = np.floor((np.asarray(rel_ped_hoz, dtype=float) - self.intention_lower[1]) / self.intention_bin_sizes[1])
+        intention_inputs[..., 2] = INTENTION_CRUISING
+
+        cruising_probabilities = self.intentions_table.query(intention_inputs)[:, INTENTIONS_PROBABILITY]
+        return np.where(cruising_probabilities.reshape(rel_ped_longit.shape) > self.CRUISING_PROBABILITY_THRESHOLD,
+                        INTENTION_CRUISING, INTENTION_HAZARD_STOP)
+
+
+    def propagate_cars(self, car_longit, car_speed, car_intentions, speed_noise):
+        """ Propagates the cars by one CAR_STEP_TIME sub step. speed_noise holds uniform [0, 1) values, which give
+        the speed error of the query in [-SPEED_ERROR_RATE * speed, 0]. Returns the next (longit, speed) """
+        car_speed = np.asarray(car_speed, dtype=float)
+        hazard_stop = (np.asarray(car_intentions) == INTENTION_HAZARD_STOP)
+
+        dynamics_inputs = np.empty(car_speed.shape + (DYNAMICS_NUM_INPUTS,))
+        dynamics_inputs[..., 0] = car_speed - self.SPEED_ERROR_RATE * car_speed * np.asarray(speed_noise)
+        dynamics_inputs[..., 1] = np.where(hazard_stop, 0.0, self.CRUISING_THROTTLE)
+        dynamics_inputs[..., 2] = np.where(hazard_stop, 1.0, 0.0)
+
+        dynamics_deltas = self.dynamics_table.query(dynamics_inputs).reshape(car_speed.shape + (-1,))
+        next_longit = car_longit + dynamics_deltas[..., DYNAMICS_DELTA_LONGIT]
+        next_speed = np.clip(car_speed + dynamics_deltas[..., DYNAMICS_DELTA_SPEED], 0.0, self.CAR_MAX_SPEED)
+        return next_longit, next_speed
+
+
+    def propagate_states(self, states, actions, random_state=None, noise=None):
+        """ Returns the next states of (N, STATE_SPACE_SIZE) states when the pedestrians apply the (N, 2) velocity
+        actions for step_time. noise is an optional (N, num_car_substeps + 1) array of uniform [0, 1) values (the
+        speed errors of the car sub steps and the horizontal position of the car), drawn from random_state (or
+        np.random) when not given """
+        states = np.asarray(states, dtype=float).reshape(-1, STATE_SPACE_SIZE)
+        actions = np.asarray(actions, dtype=float).reshape(-1, 2)
+        if(noise is None):
+            random_state = np.random if (random_state is None) else random_state
+            noise = random_state.uniform(0.0, 1.0, (len(states), self.num_car_substeps + 1))
+
+        # The intention estimated at the start of the step holds for all the car sub steps
+        car_intentions = self.estimate_car_intentions(states[:, STATE_PED_LONG] - states[:, STATE_VEH_LONG],
+                                                      states[:, STATE_PED_HOZ] - states[:, STATE_VEH_HOZ])
+        car_longit = states[:, STATE_VEH_LONG]
+        car_speed = states[:, STATE_VEH_SPEED]
+        for car_substep in range(self.num_car_substeps):
+            car_longit, car_speed = self.propagate_cars(car_longit, car_speed, car_intentions, noise[:, car_substep])
+
+        next_states = np.empty(states.shape)
+        next_states[:, STATE_PED_LONG] = states[:, STATE_PED_LONG] + actions[:, 0] * self.step_time
+        next_states[:, STATE_PED_HOZ] = np.clip(states[:, STATE_PED_HOZ] + actions[:, 1] * self.step_time,
+                                                self.PED_HOZ_BOUNDS[0], self.PED_HOZ_BOUNDS[1])
+        next_states[:, STATE_VEH_LONG] = car_longit
+        next_states[:, STATE_VEH_HOZ] = (self.CAR_HOZ_BOUNDS[0]
+                                         + (self.CAR_HOZ_BOUNDS[1] - self.CAR_HOZ_BOUNDS[0]) * noise[:, self.num_car_substeps])
+        next_states[:, STATE_VEH_SPEED] = car_speed
+        next_states[:, STATE_VEH_INTENTION] = self.estimate_car_intentions(
+                                                    next_states[:, STATE_PED_LONG] - car_longit,
+                                                    next_states[:, STATE_PED_HOZ] - next_states[:, STATE_VEH_HOZ])
+        return next_states
+
+
+    def collides(self, states):
+        """ Checks which states have the pedestrian circle overlapping the car rectangle (as the plugin collision check) """
+        states = np.asarray(states, dtype=float).reshape(-1, STATE_SPACE_SIZE)
+        closest_longit = np.clip(states[:, STATE_PED_LONG], states[:, STATE_VEH_LONG] - self.car_length / 2.0,
+                                 states[:, STATE_VEH_LONG] + self.car_length / 2.0)
+        closest_hoz = np.clip(states[:, STATE_PED_HOZ], states[:, STATE_VEH_HOZ] - self.car_width / 2.0,
+                              states[:, STATE_VEH_HOZ] + self.car_width / 2.0)
+        return np.hypot(states[:, STATE_PED_LONG] - closest_longit, states[:, STATE_PED_HOZ] - closest_hoz) <= self.ped_radius
+
+
+    def rollout_trajectories(self, start_states, ped_trajs, random_state=None):
+        """ Propagates the start states (N, STATE_SPACE_SIZE) with pedestrians following the (N, steps, 2) trajectories,
+        the first point being their start position. Returns the (N, steps, STATE_SPACE_SIZE) states and whether each
+        rollout collided at any step """
+        ped_trajs = np.asarray(ped_trajs, dtype=float)
+        states = np.empty((len(ped_trajs), ped_trajs.shape[1], STATE_SPACE_SIZE))
+        states[:, 0] = start_states
+        states[:, 0, STATE_PED_LONG:STATE_PED_HOZ + 1] = ped_trajs[:, 0]
+        collided = self.collides(states[:, 0])
+
+        for step in range(1, ped_trajs.shape[1]):
+            # Velocity that takes each pedestrian to its next point (hoz positions are clamped as in the plugin)
+            actions = (ped_trajs[:, step] - states[:, step - 1, STATE_PED_LONG:STATE_PED_HOZ + 1]) / self.step_time
+            states[:, step] = self.propagate_states(states[:, step - 1], actions, random_state)
+            collided |= self.collides(states[:, step])
+
+        return states, collided
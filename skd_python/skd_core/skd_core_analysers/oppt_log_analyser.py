@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import argparse
 import os, sys
 import copy
@@ -16,6 +15,8 @@ if(skd_core_dir not in sys.path):
 
 # Metric computation
 import skd_core_metrics.Fretchet as Fretchet
+import skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core_utils.skd_plot_renderer as skd_plot_renderer
 
 
 """ Class to represent a particle in a belief from oppt """
@@ -117,6 +118,7 @@ class OPPTLogAnalyser:
 
 
 	""" Reads from an OPPT logfile and extracts each experiment run into an independent log file """
+	@skd_core_profiling.profiled_stage("log_splitting")
 	def split_runs(self):
 		#FILE IO
 		readFile = open(self.filepath)
@@ -271,6 +273,7 @@ class OPPTLogAnalyser:
 	""" Extracts the information for a speficied run number in the associatd experiment log file.
 		The information extract is parametrized by the given start_index and up to and includeing
 		the end_index of the variables in the state space """
+	@skd_core_profiling.profiled_stage("trajectory_extraction")
 	def get_state_data(self, run_num, state_start_index, state_end_index):
 		STATE_SPACE_SIZE = 6
 		STATE_DESCRIPTION_OFFSET = 1
@@ -315,67 +318,19 @@ class OPPTLogAnalyser:
 	""" Loads a csv table represetnation of the run tracker data and plots the trajectory of 
 	    both the pedestrian and the car involved in the data """
 	def save_plot_number(self, run_num, distance):
-		# Pack information from pedestrian and car's location
-		ped_loc_longit_points = []
-		ped_loc_horizontal_points = []
-		car_loc_longit_points = []
-		car_loc_horizontal_points = []
+		skd_plot_renderer.render_plot_job(self.get_plot_job(run_num, distance))
 
+
+
+	""" Plot job of save_plot_number, to render batches of runs with skd_plot_renderer """
+	def get_plot_job(self, run_num, distance):
 		# Get data from run file
 		states = self.get_state_data(run_num, self.PED_LONGIT_INDEX, self.CAR_HOZ_INDEX)
-		NUM_POINTS = len(states)
-
-		# Extract data
-		for state in states:
-			ped_loc_longit_points.append(state[0])
-			ped_loc_horizontal_points.append(-state[1])
-			car_loc_longit_points.append(state[2])
-			car_loc_horizontal_points.append(-state[3])
-
-		# Plot data here
-		fig = plt.figure()
-		axes = plt.axes()
-
-		# Color settings
-		alphas = np.linspace(0.1, 1, NUM_POINTS)
-		rgba_colors_ped = np.zeros((NUM_POINTS, 4))
-		rgba_colors_car = np.zeros((NUM_POINTS, 4))
-		# for red the first column needs to be one
-		rgba_colors_ped[:, 0] = 1.0
-		# the fourth column needs to be your alphas
-		rgba_colors_ped[:, 3] = alphas
-		# Plot the trajectory of the pedestrian
-		axes.scatter(ped_loc_horizontal_points, ped_loc_longit_points, color=rgba_colors_ped)
-		# Plot the trajectory of the pedestrian
-		rgba_colors_car[:, 2] = 1.0
-		rgba_colors_car[:, 3] = alphas
-
-		axes.scatter(car_loc_horizontal_points, car_loc_longit_points, color=rgba_colors_car)
-
-		# Annotate plot start and end
-		axes.annotate("START", (ped_loc_horizontal_points[0], ped_loc_longit_points[0]))
-		axes.annotate("END", (ped_loc_horizontal_points[-1], ped_loc_longit_points[-1]))
-		axes.annotate("START", (car_loc_horizontal_points[0], car_loc_longit_points[0]))
-		axes.annotate("END", (car_loc_horizontal_points[-1], car_loc_longit_points[-1]))
-
-		# Annotate time index
-		for time in range(NUM_POINTS):
-			axes.annotate(time, (ped_loc_horizontal_points[time], ped_loc_longit_points[time]))
-			axes.annotate(time, (car_loc_horizontal_points[time], car_loc_longit_points[time]))
-
-		# Set options for plot
-		axes.grid(axis="both")
-		axes.set_title("Pedestrian vs Car Trajectory Run#%d and Fretchet distance = %f" % (run_num, distance))
-		axes.set_xlabel("Horizontal section of road")
-		axes.set_ylabel("Longitudinal section of road")
-		axes.set_autoscalex_on(True)
-		axes.set_autoscaley_on(True)
-
-		# Save plot
-		#plt.show()
 		logfile_basename = os.path.basename(self.filepath)
-		plt.savefig(self.output_dir +"/plots/%s_traj%d.png" % (logfile_basename, run_num))
-		plt.close()
+
+		return skd_plot_renderer.get_ped_car_plot_job(states,
+					"Pedestrian vs Car Trajectory Run#%d and Fretchet distance = %f" % (run_num, distance),
+					self.output_dir +"/plots/%s_traj%d.png" % (logfile_basename, run_num), start_end_labels=True)
 
 
 
@@ -4,7 +4,6 @@ import random
 import time
 import json, copy
 import glob
-import matplotlib.pyplot as plt
 
 # Add parent dir to package
 source_path = os.path.abspath(__file__)
@@ -17,17 +16,79 @@ if(skd_core_dir not in sys.path):
 import skd_core_analysers.oppt_log_analyser as oppt_log_analyser
 import skd_core_utils.skd_core_utils as skd_core_utils
 import skd_core_metrics.Fretchet as Fretchet
+import skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core_utils.skd_plot_renderer as skd_plot_renderer
+import skd_core_utils.skd_core_stats as skd_core_stats
+import skd_core_utils.skd_results_db as skd_results_db
+
+
+def get_augmented_trajectory(collision_traj, safe_traj):
+    """ 
+    Function to compute the augmented trajectory from a successful collision path.
+    The function augments the collision traj by appending equal sized_steps in the 
+    from the collision point to the end point of the safe traj 
+    """
+
+    MAX_DISPLACEMENT = 0.75
+
+    # Compare end points
+    collision_traj_end = collision_traj[-1]
+    safe_traj_end = safe_traj[-1]
+
+    # Extended traj
+    extend_traj = copy.deepcopy(collision_traj)
+
+    # Check if endpoints are the same
+    if(collision_traj_end != safe_traj_end):
+        # Compute the augmented section with numpy
+        np_augmented_traj = np.array([])
+        np_collision_end = np.array(collision_traj_end)
+        np_safe_traj_end = np.array(safe_traj_end)
+
+        # Calc difference vector
+        np_diff_vec = np_safe_traj_end - np_collision_end
+        np_diff_vec_norm = np.linalg.norm(np_diff_vec)
+
+        # Estimate step size
+        num_steps = np.ceil(np_diff_vec_norm / MAX_DISPLACEMENT)
+        #Step vec is step_size * (unitary_diff_ve)
+        step_vec = (np_diff_vec/np_diff_vec_norm) * (np_diff_vec_norm / num_steps)
+
+
+        # Append
+        for step in range(1, int(num_steps) + 1):
+            next_point = np_collision_end + (step * step_vec)
+            extend_traj.append(next_point.tolist())
+
+    return copy.deepcopy(extend_traj)
+
 
 
 class SKDKamikazeDataAnalyser:
     """ Class to analyse and plot the output info of the collision environments """
-    def __init__(self, parsing_summary_file, outputdir):
+    def __init__(self, parsing_summary_file, outputdir, plot_workers=None, max_plots=None, plot_sampling="first",
+                    num_bootstrap_resamples=2000, frechet_ci_target_width=0.1, results_db_path=None):
         # Save the top level dir where parsing occurs
         self.parsing_summary_file = parsing_summary_file
 
         # Location where the analyser outputs
         self.outputdir = outputdir
 
+        # Number of plotting processes, cap on plots per safe trajectory and policy used to pick them
+        self.plot_workers = plot_workers
+        self.max_plots = skd_plot_renderer.get_default_max_plots() if (max_plots is None) else max_plots
+        self.plot_sampling = plot_sampling
+
+        # Frechet distances and timings of every controller (as numpy arrays) for the bootstrap intervals
+        self.num_bootstrap_resamples = num_bootstrap_resamples
+        self.frechet_ci_target_width = frechet_ci_target_width
+        self.controller_frechet_samples = {}
+        self.controller_timing_samples = {}
+
+        # Optional results database where the kamikaze trajectories and their frechet distances are recorded
+        self.results_db_path = skd_results_db.get_results_db_path(results_db_path)
+        self.results_records = []
+
         self.parsing_summary_data = skd_core_utils.load_dict_from_yaml(self.parsing_summary_file)
       
 
@@ -60,6 +121,52 @@ class SKDKamikazeDataAnalyser:
         # Save as csv
         np.savetxt(summary_outfile_path, np_summary_data, delimiter=",", header=summary_data_headers, comments='')
 
+        self.save_bootstrap_intervals()
+
+        # Save the timing of the pipeline stages next to the summary
+        skd_core_profiling.save_timing_report(self.outputdir + "/timing_report.json")
+        self.record_results()
+
+
+
+    def record_results(self):
+        """ Records the job and the successful kamikaze trajectories of every safe trajectory, with their frechet
+        distances and timings, in the results database when there is one """
+        results_db = skd_results_db.open_results_db(self.results_db_path)
+        if(results_db is None):
+            return
+
+        job_id = results_db.add_job(skd_results_db.JOB_KAMIKAZE_ANALYSIS, self.parsing_summary_file, self.outputdir)
+        for controller_id, safe_traj_filepath, safe_traj_index, safe_traj_dir, frechet_dists, frechet_times in self.results_records:
+            results_db.replace_runs(job_id, skd_results_db.RUN_KAMIKAZE, controller_id, safe_traj_filepath, safe_traj_index,
+                                    collided=[True] * len(frechet_dists),
+                                    metrics={skd_results_db.METRIC_FRECHET : frechet_dists,
+                                             skd_results_db.METRIC_FRECHET_TIME_MS : frechet_times},
+                                    log_path=safe_traj_dir)
+        results_db.close()
+
+
+
+    def save_bootstrap_intervals(self):
+        """ Saves the bootstrap CIs of the mean frechet distance and timing of every controller, computed
+        in one batch, and the number of runs needed for the frechet CI to be frechet_ci_target_width wide """
+        controller_ids = list(self.controller_frechet_samples.keys())
+        frechet_samples = [np.concatenate(self.controller_frechet_samples[controller_id]) for controller_id in controller_ids]
+        timing_samples = [np.concatenate(self.controller_timing_samples[controller_id]) for controller_id in controller_ids]
+
+        frechet_means, frechet_lows, frechet_highs = skd_core_stats.get_bootstrap_intervals(frechet_samples,
+                                                            self.num_bootstrap_resamples)
+        timing_means, timing_lows, timing_highs = skd_core_stats.get_bootstrap_intervals(timing_samples,
+                                                            self.num_bootstrap_resamples)
+        frechet_stds = [np.std(samples, ddof=1) if (len(samples) > 1) else np.nan for samples in frechet_samples]
+        runs_needed = skd_core_stats.get_runs_for_mean_ci_width(frechet_stds, self.frechet_ci_target_width)
+
+        np_intervals = np.column_stack([np.array(controller_ids, dtype=float), [len(samples) for samples in frechet_samples],
+                                        frechet_means, frechet_lows, frechet_highs, timing_means, timing_lows, timing_highs, runs_needed])
+        header = "controller_id,sample_size,frechet_mean,frechet_bootstrap_ci_low,frechet_bootstrap_ci_high"
+        header += ",timings_mean,timings_bootstrap_ci_low,timings_bootstrap_ci_high,runs_for_frechet_ci_width_%g" % (self.frechet_ci_target_width)
+        np.savetxt(self.outputdir + "/bootstrap_statistics.csv", np_intervals.reshape(-1, 9), delimiter=",", header=header, comments='')
+
 
 
     def parse_controller_summary(self, controller_id, controller_summary):
@@ -75,34 +182,23 @@ class SKDKamikazeDataAnalyser:
                                                             controller_id, safe_traj_file_summary)
 
             # Save stats
-            controller_multiplier_frechet_stats.append(copy.deepcopy(traj_file_fretchet_stats))
-            controller_multiplier_timing_stats.append(copy.deepcopy(traj_file_timing_stats))
-
-        # Process top level statistics here
-        controller_fretchet_distances = []
-        controller_fretchet_timings = []
+            controller_multiplier_frechet_stats.append(traj_file_fretchet_stats)
+            controller_multiplier_timing_stats.append(traj_file_timing_stats)
 
-        # Gather all the controller distances statistics
+        # Controller level statistics are the merge of every safe trajectory stats
+        controller_fretchet_stats = skd_core_stats.StreamingStats()
+        controller_timing_stats = skd_core_stats.StreamingStats()
         for frechet_stat in controller_multiplier_frechet_stats:    
-            # Accumulate all distance stats
             for traj_file_stat_record in frechet_stat:
-                # add all the distances in each record
-                record_distances = traj_file_stat_record["DATA_ARRAY"] 
-                controller_fretchet_distances.extend(copy.deepcopy(record_distances))
-
+                controller_fretchet_stats.merge(traj_file_stat_record)
 
-        # Gather all the controller timings statistics
         for timing_stat in controller_multiplier_timing_stats:   
-            # Accumulate all timing stats
             for traj_file_timing_record in timing_stat:
-                # add all the distances in each record
-                record_timings = traj_file_timing_record["DATA_ARRAY"] 
-                controller_fretchet_timings.extend(record_timings)
-
+                controller_timing_stats.merge(traj_file_timing_record)
 
         controller_summary_data = [float(controller_id)]
-        controller_summary_data.extend(copy.deepcopy(skd_core_utils.process_general_stats_array(controller_fretchet_distances)))
-        controller_summary_data.extend(copy.deepcopy(skd_core_utils.process_general_stats_array(controller_fretchet_timings)))
+        controller_summary_data.extend(controller_fretchet_stats.to_array())
+        controller_summary_data.extend(controller_timing_stats.to_array())
 
         return controller_summary_data
 
@@ -135,8 +231,8 @@ class SKDKamikazeDataAnalyser:
                 safe_traj_dir, safe_traj_filepath, controller_id, safe_traj_file_keyname, safe_traj_index)
 
             # Save stats
-            safe_traj_file_fretchet_stats.append(copy.deepcopy(single_traj_fretcht_stats))
-            safe_traj_file_timings_stats.append(copy.deepcopy(single_traj_timings_stats))
+            safe_traj_file_fretchet_stats.append(single_traj_fretcht_stats)
+            safe_traj_file_timings_stats.append(single_traj_timings_stats)
 
 
         return safe_traj_file_fretchet_stats, safe_traj_file_timings_stats
@@ -176,9 +272,16 @@ class SKDKamikazeDataAnalyser:
                                         safe_traj_data_records, safe_traj_outdir)
         #print("COMPUTE STATS END")
 
-        # Record stats
-        single_traj_fretcht_stats = skd_core_utils.process_general_stats(copy.deepcopy(records_fretchet_dists))
-        single_traj_timings_stats = skd_core_utils.process_general_stats(copy.deepcopy(records_fretchet_times))
+        # Keep the samples of the controller for the bootstrap intervals
+        self.controller_frechet_samples.setdefault(controller_id, [np.zeros(0)]).append(np.array(records_fretchet_dists, dtype=float))
+        self.controller_timing_samples.setdefault(controller_id, [np.zeros(0)]).append(np.array(records_fretchet_times, dtype=float))
+
+        self.results_records.append((controller_id, safe_traj_filepath, safe_traj_index, safe_traj_dir,
+                                     records_fretchet_dists, records_fretchet_times))
+
+        # Record stats as mergeable accumulators
+        single_traj_fretcht_stats = skd_core_stats.get_streaming_stats(records_fretchet_dists)
+        single_traj_timings_stats = skd_core_stats.get_streaming_stats(records_fretchet_times)
 
         return single_traj_fretcht_stats, single_traj_timings_stats
 
@@ -190,13 +293,15 @@ class SKDKamikazeDataAnalyser:
         the fretchet distances and fretchet timings associated with the records """
         safe_traj_fretchet_distances = []
         safe_traj_fretchet_timings = []
-
+        plot_jobs = []
+        plot_record_indices = set(skd_plot_renderer.select_plot_indices(len(traj_records), self.max_plots, self.plot_sampling))
+        plot_output_dir = outputdir + "/plots"
         
         # Compute fretchet distances and timing for computations
         for record_index in range(len(traj_records)):
             record = traj_records[record_index]
             # Record time 
-            t_single_calc_start = time.clock()
+            t_single_calc_start = time.process_time()
             record_frechet = 0
             # Check for augmented path computation
             if(augmented):
@@ -209,24 +314,32 @@ class SKDKamikazeDataAnalyser:
                 record_frechet = Fretchet.frechet(record.get_kamikaze_ped_traj()), record.get_safe_traj()
                 safe_traj_fretchet_distances.append(record_frechet)
 
-            t_single_calc_end = time.clock()
+            t_single_calc_end = time.process_time()
             # Save timing
             safe_traj_fretchet_timings.append((t_single_calc_end - t_single_calc_start) * 1000)
 
             # Check for plotting
-            if(save_plots):
-                plot_output_dir = outputdir + "/plots"
-
-                try:
-                    os.makedirs(plot_output_dir)
-                except OSError as error:
-                    # Can use to debug by printing number of times dirs are attempted to be created
-                    # print(error)
-                    pass 
-
+            if(save_plots and record_index in plot_record_indices):
                 plot_title =  "SKD Interaction experiment number %d, Estimated SKD = %f" % (record_index, record_frechet)
-                skd_core_utils.save_trajectories_plot(record_index, record.get_safe_traj(), record.get_kamikaze_ped_traj(),
-                                     record.get_kamikaze_veh_traj(), plot_title, plot_output_dir) 
+                plot_jobs.append(skd_core_utils.get_trajectories_plot_job(record_index, record.get_safe_traj(), record.get_kamikaze_ped_traj(),
+                                     record.get_kamikaze_veh_traj(), plot_title, plot_output_dir))
+
+        # Render the plots as a batch, with an overview of every kamikaze trajectory against the safe trajectory
+        if(save_plots and len(traj_records) > 0):
+            try:
+                os.makedirs(plot_output_dir)
+            except OSError as error:
+                pass
+
+            skd_plot_renderer.render_plot_jobs(plot_jobs, self.plot_workers)
+
+            overview_trajs = [skd_plot_renderer.get_scene_points(record.get_kamikaze_ped_traj()) for record in traj_records]
+            overview_colors = [(1.0, 0.0, 0.0, 0.4)] * len(traj_records)
+            overview_trajs.append(skd_plot_renderer.get_scene_points(traj_records[0].get_safe_traj()))
+            overview_colors.append((0.0, 0.0, 1.0, 1.0))
+            skd_plot_renderer.render_overview_plot(overview_trajs, overview_colors,
+                        "%s: %d kamikaze trajectories" % (os.path.basename(outputdir), len(traj_records)),
+                        outputdir + "/overview.png")
 
         return safe_traj_fretchet_distances, safe_traj_fretchet_timings
 
@@ -282,44 +395,7 @@ class SKDKamikazeDataAnalyser:
 
    
     def get_augmented_trajectory(self, collision_traj, safe_traj):
-        """ 
-        Function to compute the augmented trajectory from a successful collision path.
-        The function augments the collision traj by appending equal sized_steps in the 
-        from the collision point to the end point of the safe traj 
-        """
-
-        MAX_DISPLACEMENT = 0.75
-
-        # Compare end points
-        collision_traj_end = collision_traj[-1]
-        safe_traj_end = safe_traj[-1]
-
-        # Extended traj
-        extend_traj = copy.deepcopy(collision_traj)
-
-        # Check if endpoints are the same
-        if(collision_traj_end != safe_traj_end):
-            # Compute the augmented section with numpy
-            np_augmented_traj = np.array([])
-            np_collision_end = np.array(collision_traj_end)
-            np_safe_traj_end = np.array(safe_traj_end)
-
-            # Calc difference vector
-            np_diff_vec = np_safe_traj_end - np_collision_end
-            np_diff_vec_norm = np.linalg.norm(np_diff_vec)
-
-            # Estimate step size
-            num_steps = np.ceil(np_diff_vec_norm / MAX_DISPLACEMENT)
-            #Step vec is step_size * (unitary_diff_ve)
-            step_vec = (np_diff_vec/np_diff_vec_norm) * (np_diff_vec_norm / num_steps)
-
-
-            # Append
-            for step in range(1, int(num_steps) + 1):
-                next_point = np_collision_end + (step * step_vec)
-                extend_traj.append(next_point.tolist())
-
-        return copy.deepcopy(extend_traj)
+        return get_augmented_trajectory(collision_traj, safe_traj)
 
 
 
@@ -0,0 +1,98 @@
+import sys, os
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_core_dir)
+
+
+# Append top level library path
+if(skd_python_dir not in sys.path):
+	sys.path.append(skd_python_dir)
+
+
+
+import argparse
+from datetime import datetime
+
+
+# Utils
+import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_generators.skd_kamikaze_traj_gen as skd_kamikaze_traj_gen
+import skd_core.skd_core_planners.skd_standin_planner as skd_standin_planner
+import skd_core.skd_core_planners.skd_adversarial_planner as skd_adversarial_planner
+
+
+
+class AdversarialKamikazeTrajGenerator(skd_kamikaze_traj_gen.KamikazeTrajGenerator):
+	"""
+	Kamikaze trajectory generator that searches the kamikaze trajectories in process with the
+	AdversarialKamikazePlanner instead of running the planner executable. The configs, output dirs,
+	logs and experiments summary are the ones of the KamikazeTrajGenerator, so its output is read by
+	the SKDKamikazeDataAnalyser in the same way
+	"""
+	def __init__(self, config_file_path, module_output_dir):
+		skd_kamikaze_traj_gen.KamikazeTrajGenerator.__init__(self, config_file_path, module_output_dir)
+
+		# Options of the cross-entropy search (population_size, num_iterations, elite_fraction, std_smoothing, seed)
+		kamikaze_configs = skd_core_utils.get_skd_configurations(self.config_path)
+		self.search_options = dict(kamikaze_configs.get("adversarial_search", {}))
+		self.search_seed = self.search_options.pop("seed", None)
+		self.num_searches = 0
+
+
+
+	def run_planner(self, planner_executable_path, planner_config):
+		""" Searches the attempts of the cfg in process. The planner executable is not used """
+		# Every search gets its own seed, so the searches of a seeded generator are repeatable
+		search_seed = None if (self.search_seed is None) else (self.search_seed + self.num_searches)
+		self.num_searches += 1
+
+		with skd_core_profiling.profile_stage("planner"):
+			planner_options = skd_standin_planner.StandInPlannerOptions(planner_config)
+			planner = skd_adversarial_planner.AdversarialKamikazePlanner(planner_options, seed=search_seed,
+										**self.search_options)
+			planner.execute_runs()
+
+
+
+
+def main():
+	""" Entry point for assesment """
+	argparser = argparse.ArgumentParser(
+	description= "Adversarial Kamikaze Trajectory Generator (in process search)")
+
+	argparser.add_argument(
+		'-cfg', '--config',
+		metavar='configFile',
+		type=str,
+		help='path to configuration file for SKD Kamikaze Traj Generation')
+
+	argparser.add_argument(
+		'-o', '--outdir',
+		metavar='KamikazeTrajGenModuleOutpuDir',
+		type=str,
+		help='Parent to output directory of the module')
+
+
+	# Parse arguments
+	args = argparser.parse_args()
+	config_path = args.config
+	module_outdir = args.outdir
+
+	# Get config file
+	print("Searching kamikaze trajectories from configurations in: %s" % (config_path))
+	print("Output directory: %s" % (module_outdir))
+
+	# Create timestamp
+	timestamp = datetime.now().strftime("%m-%d-%H-%M")
+	module_outdir = module_outdir + "_%s" % (timestamp) # Add timestamp to make output unique
+
+	kamikaze_generator = AdversarialKamikazeTrajGenerator(config_path, module_outdir)
+	kamikaze_generator.execute_kamikaze_traj_gen_configs(None)
+	
+
+
+if __name__ == '__main__':
+	main()
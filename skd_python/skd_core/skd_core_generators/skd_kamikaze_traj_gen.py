@@ -19,6 +19,13 @@ from datetime import datetime
 
 # Utils
 import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_core_stats as skd_core_stats
+import skd_core.skd_core_utils.skd_results_db as skd_results_db
+import skd_core.skd_core_utils.skd_multiplier_search as skd_multiplier_search
+import skd_core.skd_core_analysers.oppt_log_analyser as oppt_log_analyser
+import skd_core.skd_core_analysers.skd_kamikaze_data_analyser as skd_kamikaze_data_analyser
+import skd_core.skd_core_metrics.Fretchet as Fretchet
 import skd_trajectories.trajectories_filters as trajs_filters
 import skd_collision_tests.controllers.car_controllers as car_controllers
 import skd_trajectories.trajectories_filters as traj_filters
@@ -52,6 +59,27 @@ class KamikazeTrajGenerator:
 		except Exception as e:
 			print("Error in configs")
 
+		# Adaptive scheduling of the planner attempts. The first round runs initial_attempts per ST_n and the
+		# following rounds (up to adaptive_rounds) run round_attempts more, only for the ST_n whose success rate
+		# or frechet estimate is still uncertain. A single round keeps the fixed attempts_per_goal behaviour
+		self.adaptive_rounds = kamikaze_configs.get("adaptive_rounds", 1)
+		self.initial_attempts = kamikaze_configs.get("initial_attempts", self.num_attempts)
+		self.round_attempts = kamikaze_configs.get("round_attempts", self.num_attempts)
+		self.max_attempts_per_goal = kamikaze_configs.get("max_attempts_per_goal", 4 * self.num_attempts)
+		self.success_ci_target_width = kamikaze_configs.get("success_ci_target_width", 0.5)
+		self.frechet_ci_target_width = kamikaze_configs.get("frechet_ci_target_width", 0.5)
+
+		# Optional search of the critical multiplier of every ST_n, where the success rate of the planner crosses
+		# a target (options of skd_multiplier_search.CriticalMultiplierSearch). The search attempts are run in rounds
+		self.critical_search_options = kamikaze_configs.get("critical_multiplier_search")
+		self.critical_search_round_counts = {}
+
+		# Starting positions of the car, computed once per safe traj file for all its trajectories and multipliers
+		self.car_start_positions = {}
+
+		# Optional results database where the job and its safe trajectories are recorded (see skd_results_db)
+		self.results_db_path = skd_results_db.get_results_db_path(kamikaze_configs.get("results_db"))
+
 
 		# Load configurations
 		self.oppt_logs_dir = self.module_output_dir + "/kamikaze_traj_gen_experiments_logs" 
@@ -107,7 +135,11 @@ class KamikazeTrajGenerator:
 			# Run experiments for each of the safe trajectory files included
 			for safe_traj_filename in self.safe_traj_files:
 
-				safe_traj_file_summary = self.get_safe_traj_file_summary(controller_multiplier, 
+				if(self.adaptive_rounds > 1):
+					safe_traj_file_summary = self.get_adaptive_safe_traj_file_summary(controller_multiplier, 
+										safe_traj_filename, planner_executable_path)
+				else:
+					safe_traj_file_summary = self.get_safe_traj_file_summary(controller_multiplier, 
 										safe_traj_filename, planner_executable_path)
 				
 				# Save summary of safe_traj_fileame
@@ -120,9 +152,27 @@ class KamikazeTrajGenerator:
 
 			experiments_summary[str(controller_multiplier)] = copy.deepcopy(controller_multiplier_summary)
 			
+		if(self.critical_search_options is not None):
+			self.run_critical_multiplier_search(planner_executable_path)
 
 		# Save experiments summary and return summary
 		skd_core_utils.save_dict_to_yaml(experiments_summary, self.loader_summary_path)
+		# Save the timing of the pipeline stages next to the summary
+		skd_core_profiling.save_timing_report(self.experiments_summary_dir + "/timing_report.json")
+		self.record_results()
+
+
+	def record_results(self):
+		""" Records the job and its safe trajectories in the results database, when there is one. The kamikaze
+		trajectories are recorded by the kamikaze analyser, which extracts them from the logs """
+		results_db = skd_results_db.open_results_db(self.results_db_path)
+		if(results_db is None):
+			return
+
+		job_id = results_db.add_job(skd_results_db.JOB_KAMIKAZE_TRAJ_GEN, self.config_path, self.module_output_dir)
+		for safe_traj_filename in self.safe_traj_files:
+			results_db.add_safe_traj_file(safe_traj_filename, job_id)
+		results_db.close()
 
 
 	def get_safe_traj_file_summary(self, controller_multiplier, safe_traj_filename, planner_executable_path):
@@ -137,17 +187,18 @@ class KamikazeTrajGenerator:
 		# Run experiments for each of the trajectory index in the safe trajectory file
 		for safe_traj_number in range(TRAJS_PER_FILE):
 			# Generate an oppt configuration file
-			planner_config = self.gen_kamikaze_traj_oppt_cfg(safe_traj_filename, safe_traj_number, 
-				controller_multiplier)
+			with skd_core_profiling.profile_stage("cfg_generation"):
+				planner_config = self.gen_kamikaze_traj_oppt_cfg(safe_traj_filename, safe_traj_number, 
+					controller_multiplier)
 
-			# Need to change the stdoout and sterr of this	
-			result = subprocess.run([planner_executable_path, "--cfg", planner_config], 
-				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			self.run_planner(planner_executable_path, planner_config)
 
 			# Store the result of each of the dirs
 			safe_traj_filekey = self.get_safe_traj_filekey(safe_traj_filename)
 			kamikaze_config_suffix = self.get_kamikaze_config_suffix(controller_multiplier, safe_traj_filekey, safe_traj_number)
 			safe_traj_filename_log_dirs.append(self.get_oppt_logs_dir(kamikaze_config_suffix))
+			skd_core_profiling.record_stage_file_written("planner", self.get_oppt_logs_dir(kamikaze_config_suffix) + "/%s" 
+				% (skd_core_utils.get_oppt_log_filename("kamikaze_traj_gen")))
 
 
 		# Save a summary of the safe_traj_file
@@ -158,6 +209,170 @@ class KamikazeTrajGenerator:
 
 
 
+	def get_adaptive_safe_traj_file_summary(self, controller_multiplier, safe_traj_filename, planner_executable_path):
+		""" Runs the planner on every trajectory of the safe traj file in rounds. After each round the round logs
+		are parsed, and only the trajectories with an uncertain success rate or frechet estimate are attempted again.
+		The logs of all the rounds are merged into the log file read by the analysers """
+		safe_traj_filekey = self.get_safe_traj_filekey(safe_traj_filename)
+
+		# Set cap on number of trajectories considered per file
+		TRAJS_PER_FILE = self.max_trajs_per_file
+		if(self.max_trajs_per_file <= 0):
+			TRAJS_PER_FILE = skd_core_utils.get_num_safe_trajs(safe_traj_filename)
+
+		# Attempts, successes and frechet stats of every trajectory across rounds
+		traj_attempts = [0] * TRAJS_PER_FILE
+		traj_successes = [0] * TRAJS_PER_FILE
+		traj_frechet_stats = [skd_core_stats.StreamingStats() for safe_traj_number in range(TRAJS_PER_FILE)]
+		traj_rounds = [[] for safe_traj_number in range(TRAJS_PER_FILE)]
+		pending_trajs = list(range(TRAJS_PER_FILE))
+
+		for round_number in range(self.adaptive_rounds):
+			round_attempts = self.initial_attempts if (round_number == 0) else self.round_attempts
+
+			for safe_traj_number in pending_trajs:
+				num_attempts = min(round_attempts, self.max_attempts_per_goal - traj_attempts[safe_traj_number])
+				round_log_path = self.run_planner_round(planner_executable_path, safe_traj_filename, safe_traj_number,
+										controller_multiplier, round_number, num_attempts)
+
+				# Parse the statistics of the round
+				num_runs, num_successful, round_frechet_dists = self.get_round_log_statistics(round_log_path,
+										skd_core_utils.get_safe_traj_from_file(safe_traj_filename, safe_traj_number))
+				traj_attempts[safe_traj_number] += num_runs
+				traj_successes[safe_traj_number] += num_successful
+				traj_frechet_stats[safe_traj_number].add_array(round_frechet_dists)
+				traj_rounds[safe_traj_number].append(round_log_path)
+
+			# Keep the trajectories that are still uncertain and have attempts left
+			success_ci_low, success_ci_high = skd_core_stats.get_wilson_intervals(traj_successes, traj_attempts)
+			next_pending_trajs = []
+			for safe_traj_number in pending_trajs:
+				frechet_ci_low, frechet_ci_high = traj_frechet_stats[safe_traj_number].get_normal_ci()
+				uncertain_success = not(success_ci_high[safe_traj_number] - success_ci_low[safe_traj_number] <= self.success_ci_target_width)
+				uncertain_frechet = (traj_successes[safe_traj_number] > 0 and 
+										not(frechet_ci_high - frechet_ci_low <= self.frechet_ci_target_width))
+				if((uncertain_success or uncertain_frechet) and traj_attempts[safe_traj_number] < self.max_attempts_per_goal):
+					next_pending_trajs.append(safe_traj_number)
+			pending_trajs = next_pending_trajs
+
+			if(len(pending_trajs) == 0):
+				break
+
+		# Merge the logs of every round into the log file of the trajectory
+		safe_traj_filename_log_dirs = []
+		for safe_traj_number in range(TRAJS_PER_FILE):
+			kamikaze_config_suffix = self.get_kamikaze_config_suffix(controller_multiplier, safe_traj_filekey, safe_traj_number)
+			merged_log_path = self.get_oppt_logs_dir(kamikaze_config_suffix) + "/%s" % (
+									skd_core_utils.get_oppt_log_filename("kamikaze_traj_gen"))
+			merge_oppt_logs(traj_rounds[safe_traj_number], merged_log_path)
+			safe_traj_filename_log_dirs.append(self.get_oppt_logs_dir(kamikaze_config_suffix))
+
+		# Save a summary of the safe_traj_file
+		safe_traj_file_summary = {"safe_traj_filepath" : safe_traj_filename,
+								"safe_traj_file_log_dirs" : safe_traj_filename_log_dirs,
+								"safe_traj_file_attempts" : traj_attempts,
+								"safe_traj_file_successes" : traj_successes,
+								"safe_traj_file_rounds" : [len(rounds) for rounds in traj_rounds]}
+
+		return safe_traj_file_summary
+
+
+
+	def run_critical_multiplier_search(self, planner_executable_path):
+		""" Searches the critical multiplier of every trajectory of the safe traj files, and of all of them pooled,
+		and saves the results next to the experiments summary """
+		cells = []
+		cell_weights = []
+		for safe_traj_filename in self.safe_traj_files:
+			num_trajs = self.max_trajs_per_file
+			if(self.max_trajs_per_file <= 0):
+				num_trajs = skd_core_utils.get_num_safe_trajs(safe_traj_filename)
+			cells.extend([(safe_traj_filename, safe_traj_number) for safe_traj_number in range(num_trajs)])
+			# Deduplicated trajectories weigh their cluster sizes in the pooled search
+			cell_weights.extend(traj_filters.get_safe_traj_weights(safe_traj_filename)[0:num_trajs])
+
+		evaluate_cell = lambda cell, controller_multiplier, num_attempts: self.evaluate_critical_search_cell(
+								planner_executable_path, cell, controller_multiplier, num_attempts)
+		critical_search_summary = skd_multiplier_search.search_critical_multipliers(evaluate_cell, cells, 
+								cell_weights, **self.critical_search_options)
+		for cell, cell_summary in zip(cells, critical_search_summary["CELLS"]):
+			cell_summary["SAFE_TRAJ_FILENAME"] = cell[0]
+			cell_summary["SAFE_TRAJ_INDEX"] = cell[1]
+		skd_core_utils.save_dict_to_yaml(critical_search_summary, self.experiments_summary_dir + "/critical_multipliers.yaml")
+
+
+
+	def evaluate_critical_search_cell(self, planner_executable_path, cell, controller_multiplier, num_attempts):
+		""" Runs a round of num_attempts of the planner on a (safe traj file, index) cell at a multiplier of the
+		critical search. Rounds are numbered after the ones already in the cfgs dir of the multiplier, so they do
+		not overwrite the adaptive rounds. Returns the number of runs and successful runs of the round """
+		safe_traj_filename, safe_traj_number = cell
+		kamikaze_config_suffix = self.get_kamikaze_config_suffix(controller_multiplier, 
+								self.get_safe_traj_filekey(safe_traj_filename), safe_traj_number)
+		if(kamikaze_config_suffix not in self.critical_search_round_counts):
+			config_db_dir = self.get_config_db_dir(kamikaze_config_suffix)
+			self.critical_search_round_counts[kamikaze_config_suffix] = len([cfg_name for cfg_name in 
+								(os.listdir(config_db_dir) if os.path.isdir(config_db_dir) else [])
+								if cfg_name.startswith("KamikazeTrajGen_round_")])
+		round_number = self.critical_search_round_counts[kamikaze_config_suffix]
+		self.critical_search_round_counts[kamikaze_config_suffix] += 1
+
+		round_log_path = self.run_planner_round(planner_executable_path, safe_traj_filename, safe_traj_number,
+								controller_multiplier, round_number, num_attempts)
+		num_runs, num_successful, round_frechet_dists = self.get_round_log_statistics(round_log_path,
+								skd_core_utils.get_safe_traj_from_file(safe_traj_filename, safe_traj_number))
+		return num_runs, num_successful
+
+
+
+	def run_planner_round(self, planner_executable_path, safe_traj_filename, safe_traj_number, controller_multiplier,
+							round_number, num_attempts):
+		""" Runs num_attempts of the planner on the safe trajectory, logging to the rounds dir of the trajectory.
+		Returns the path of the round log file """
+		with skd_core_profiling.profile_stage("cfg_generation"):
+			planner_config = self.gen_kamikaze_traj_oppt_cfg(safe_traj_filename, safe_traj_number, 
+				controller_multiplier, num_attempts=num_attempts, round_number=round_number)
+
+		self.run_planner(planner_executable_path, planner_config)
+
+		safe_traj_filekey = self.get_safe_traj_filekey(safe_traj_filename)
+		kamikaze_config_suffix = self.get_kamikaze_config_suffix(controller_multiplier, safe_traj_filekey, safe_traj_number)
+		round_log_path = self.get_oppt_rounds_dir(kamikaze_config_suffix) + "/%s" % (
+								skd_core_utils.get_oppt_log_filename(get_round_log_postfix(round_number)))
+		skd_core_profiling.record_stage_file_written("planner", round_log_path)
+
+		return round_log_path
+
+
+
+	def run_planner(self, planner_executable_path, planner_config):
+		""" Runs the planner executable on an oppt cfg, which writes its log to the logPath of the cfg """
+		# Need to change the stdoout and sterr of this	
+		with skd_core_profiling.profile_stage("planner"):
+			result = subprocess.run([planner_executable_path, "--cfg", planner_config], 
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+
+	def get_round_log_statistics(self, round_log_path, safe_traj):
+		""" Returns the number of runs, successful runs and frechet distances of the successful runs in a round log """
+		if(not os.path.isfile(round_log_path)):
+			return 0, 0, []
+
+		round_analyser = oppt_log_analyser.OPPTLogAnalyser(os.path.splitext(round_log_path)[0] + "_analysis", round_log_path)
+		round_analyser.split_runs()
+
+		# Frechet distance of the augmented kamikaze trajectories, as computed by the kamikaze analyser
+		frechet_dists = []
+		successful_ped_trajs, successful_veh_trajs = round_analyser.get_successful_ped_veh_trajectories()
+		for ped_traj in successful_ped_trajs:
+			augmented_traj = skd_kamikaze_data_analyser.get_augmented_trajectory(ped_traj, safe_traj)
+			frechet_dists.append(Fretchet.frechetDist(augmented_traj, safe_traj))
+
+		return round_analyser.get_num_runs(), round_analyser.get_num_successful(), frechet_dists
+
+
+
 	
 	def get_kamikaze_config_suffix(self, controller_multiplier, safe_traj_filekey, safe_traj_index):
 		return skd_core_utils.get_kamikaze_config_suffix(controller_multiplier, safe_traj_filekey, safe_traj_index)
@@ -167,6 +382,11 @@ class KamikazeTrajGenerator:
 		return self.oppt_logs_dir + "/%s" % (kamikaze_config_suffix)
 
 
+	def get_oppt_rounds_dir(self, kamikaze_config_suffix):
+		# Round logs are kept out of the logs dir so the analysers only read the merged log
+		return self.get_oppt_logs_dir(kamikaze_config_suffix) + "/rounds"
+
+
 	def get_config_db_dir(self, kamikaze_config_suffix):
 		return self.oppt_experiment_cfgs + "/%s" % (kamikaze_config_suffix)
 
@@ -182,10 +402,36 @@ class KamikazeTrajGenerator:
 
 
 
-	def gen_kamikaze_traj_oppt_cfg(self, safe_traj_filename, safe_traj_index, controller_multiplier):
+	def get_car_start_pos(self, safe_traj_filename, safe_traj_index, controller_multiplier):
+		""" Starting position of the car for a safe trajectory and controller multiplier. The positions of
+		every trajectory of the file and every multiplier of the module are computed together on first use """
+		if(safe_traj_filename not in self.car_start_positions):
+			safe_traj_data = skd_core_utils.load_dict_from_json(safe_traj_filename)
+			safe_trajs = [safe_traj_data[str(traj_index)] for traj_index in range(len(safe_traj_data))]
+			# Create a default controller per multiplier to get starting pos
+			multiplier_controllers = [car_controllers.BasicCarController(multiplier=float(multiplier))
+										for multiplier in self.controller_multipliers]
+			self.car_start_positions[safe_traj_filename] = traj_filters.get_batch_car_starting_pos(safe_trajs,
+										multiplier_controllers)
+
+		if(controller_multiplier in self.controller_multipliers):
+			multiplier_index = self.controller_multipliers.index(controller_multiplier)
+			return self.car_start_positions[safe_traj_filename][safe_traj_index][multiplier_index].tolist()
+
+		# Multipliers outside of the module config are queried on their own
+		config_safe_trajectory =  skd_core_utils.get_safe_traj_from_file(safe_traj_filename, safe_traj_index)
+		car_controller = car_controllers.BasicCarController(multiplier=float(controller_multiplier))
+		return traj_filters.get_car_starting_pos(config_safe_trajectory, car_controller)
+
+
+
+	def gen_kamikaze_traj_oppt_cfg(self, safe_traj_filename, safe_traj_index, controller_multiplier, num_attempts=None,
+									round_number=None):
 		""" 
 		Generates a new ".cfg" with assessment options set to
-		file_options according to the desired goal area, goal margins, and initial state parameters"""
+		file_options according to the desired goal area, goal margins, and initial state parameters.
+		When a round_number is given, the cfg of that round logs to the rounds dir of the trajectory """
+		num_attempts = self.num_attempts if (num_attempts is None) else num_attempts
 
 		# Copy from a template cfg file and change the appropiate lines with 'sed'
 
@@ -208,16 +454,21 @@ class KamikazeTrajGenerator:
 
 		# Set the destination of the experiment configuration file
 		assessment_configs_path = kamikaze_config_db_dir + "/KamikazeTrajGen.cfg" 
+		log_postfix = "kamikaze_traj_gen"
+
+		# Each round has its own cfg and log file
+		if(round_number is not None):
+			assessment_configs_path = kamikaze_config_db_dir + "/KamikazeTrajGen_round_%d.cfg" % (round_number)
+			log_postfix = get_round_log_postfix(round_number)
+			kamikaze_oppt_log_dir = self.get_oppt_rounds_dir(kamikaze_config_suffix)
+			try:
+				os.makedirs(kamikaze_oppt_log_dir)
+			except OSError as error:
+				pass
 
 		
 		# Assess car_start position according to trajectories module
-		# Create a traj filter according to the car
-		config_safe_trajectory =  skd_core_utils.get_safe_traj_from_file(safe_traj_filename, safe_traj_index)
-		# Create a default controller to get starting pos
-		car_controller = car_controllers.BasicCarController(controller_multiplier)
-
-		# Query a startig pos
-		car_start_pos = traj_filters.get_car_starting_pos(config_safe_trajectory, car_controller)
+		car_start_pos = self.get_car_start_pos(safe_traj_filename, safe_traj_index, controller_multiplier)
        
 		# Make a local copy of the configuration file
 		cfg_file = shutil.copyfile(self.config_template_path, assessment_configs_path)
@@ -227,10 +478,10 @@ class KamikazeTrajGenerator:
 
 		# Replace post fix to file name
 		skd_core_utils.sed_file(cfg_file, "logFilePostfix =.*", "logFilePostfix = %s" 
-			% ("kamikaze_traj_gen"))
+			% (log_postfix))
 
 		# Replace number of samples 
-		skd_core_utils.sed_file(cfg_file, "nRuns =.*", "nRuns = %d" % (self.num_attempts))
+		skd_core_utils.sed_file(cfg_file, "nRuns =.*", "nRuns = %d" % (num_attempts))
 
 		# Set starting car pos, according to experiments
 		skd_core_utils.sed_file(cfg_file, "carStartPos =.*", "carStartPos = [%f, %f]" % (car_start_pos[0], car_start_pos[1]))
@@ -247,6 +498,36 @@ class KamikazeTrajGenerator:
 
 
 
+def get_round_log_postfix(round_number):
+	return "kamikaze_traj_gen_round_%d" % (round_number)
+
+
+def merge_oppt_logs(log_paths, merged_log_path):
+	""" Concatenates the runs of several oppt log files into merged_log_path, renumbering the runs
+	consecutively. The header (lines before the first run) of the first log is kept """
+	run_offset = 0
+	with open(merged_log_path, "w+") as merged_log:
+		for log_index in range(len(log_paths)):
+			if(not os.path.isfile(log_paths[log_index])):
+				continue
+
+			log_num_runs = 0
+			in_header = True
+			with open(log_paths[log_index]) as log_file:
+				for line in log_file:
+					if("Run #" in line):
+						in_header = False
+						# Renumber the run
+						line = line.replace("Run #%s" % (line.split("Run #")[1].split()[0]), "Run #%d" % (run_offset + log_num_runs), 1)
+						log_num_runs += 1
+					# Only the first header is kept
+					if(in_header and run_offset > 0):
+						continue
+					merged_log.write(line)
+			run_offset += log_num_runs
+
+
+
 def main():
 	""" Entry point for assesment """
 	argparser = argparse.ArgumentParser(
@@ -17,7 +17,10 @@ from datetime import datetime
 
 # Utils
 import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_results_db as skd_results_db
 import skd_core.skd_core_analysers.oppt_log_analyser as oppt_log_analyser
+import skd_trajectories.trajectories_clustering as traj_clustering
 
 
 class SafeTrajGenerator:
@@ -52,6 +55,13 @@ class SafeTrajGenerator:
 		except Exception as e:
 			print("Error in configs")
 
+		# Optional deduplication of the successful safe trajectories (options of 
+		# traj_clustering.deduplicate_safe_traj_file). Only the representatives are given to the kamikaze generator
+		self.dedup_options = safe_gen_configs.get("dedup_options")
+
+		# Optional results database where the generated trajectories are recorded (see skd_results_db)
+		self.results_db_path = skd_results_db.get_results_db_path(safe_gen_configs.get("results_db"))
+
 
 		# Set output dirs
 		self.oppt_logs_dir = self.module_output_dir + "/oppt_logs" 
@@ -94,25 +104,52 @@ class SafeTrajGenerator:
 			oppt_log_post_fix = self.log_post_fix + "_%s" % (goal_identifier)
 			
 			# Generate oppt config file
-			bounds_cfg_file = self.gen_safe_traj_oppt_cfg(goal_bound, experiment_logpath, assessment_configs_path, oppt_log_post_fix)
+			with skd_core_profiling.profile_stage("cfg_generation"):
+				bounds_cfg_file = self.gen_safe_traj_oppt_cfg(goal_bound, experiment_logpath, assessment_configs_path, oppt_log_post_fix)
 
 			# Need to change the std out and sterr of this 
-			result = subprocess.run([planner_executable_path, "--cfg", bounds_cfg_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			with skd_core_profiling.profile_stage("planner"):
+				result = subprocess.run([planner_executable_path, "--cfg", bounds_cfg_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 			# Validate and ouput sucessful save trajs
 			oppt_result_logfile = experiment_logpath + "/%s" % (skd_core_utils.get_oppt_log_filename(oppt_log_post_fix))
+			skd_core_profiling.record_stage_file_written("planner", oppt_result_logfile)
 			validator_outdir = self.safe_traj_validator_outdir + "/%s" % (goal_identifier)
 			safe_traj_validator = SafeTrajValidator(oppt_result_logfile, validator_outdir)
 
 			# Safe successful safe_trajs
 			safe_trajs_outpath = validator_outdir + "/safe_trajs.json"
-			safe_traj_validator.save_successful_safe_trajs(safe_trajs_outpath)
+			with skd_core_profiling.profile_stage("safe_traj_validation"):
+				safe_traj_validator.save_successful_safe_trajs(safe_trajs_outpath)
+
+			# Keep one weighted representative per group of near identical trajectories
+			if(self.dedup_options is not None):
+				dedup_outpath = validator_outdir + "/safe_trajs_dedup.json"
+				dedup_summary = traj_clustering.deduplicate_safe_traj_file(safe_trajs_outpath, dedup_outpath, **self.dedup_options)
+				skd_core_utils.save_dict_to_json(dedup_summary, validator_outdir + "/dedup_summary.json")
+				print("SAFE TRAJS DEDUPLICATED: %d -> %d" % (dedup_summary["TOTAL"], dedup_summary["REPRESENTATIVES"]))
+				safe_trajs_outpath = dedup_outpath
+
 			# Save name saved trajectories file
 			self.safe_trajs_generated.append(safe_trajs_outpath)
 
 
 			print("=============================== SAFE TRAJS GENERATED ============================================")
 
+		self.record_results()
+
+
+	def record_results(self):
+		""" Records the job and the generated trajectories in the results database, when there is one """
+		results_db = skd_results_db.open_results_db(self.results_db_path)
+		if(results_db is None):
+			return
+
+		job_id = results_db.add_job(skd_results_db.JOB_SAFE_TRAJ_GEN, self.config_path, self.module_output_dir)
+		for safe_trajs_file in self.safe_trajs_generated:
+			results_db.add_safe_traj_file(safe_trajs_file, job_id)
+		results_db.close()
+
 
 
 	def gen_safe_traj_oppt_cfg(self, goal_bound, experiment_logpath, assessment_configs_path, oppt_log_post_fix):
@@ -1,6 +1,15 @@
+import sys, os
 import numpy as np
 import math
 
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+if(skd_core_dir not in sys.path):
+    sys.path.append(skd_core_dir)
+
+import skd_core_utils.skd_core_profiling as skd_core_profiling
+
 # Euclidean distance.
 def euc_dist(pt1,pt2):
     return math.sqrt((pt2[0]-pt1[0])*(pt2[0]-pt1[0])+(pt2[1]-pt1[1])*(pt2[1]-pt1[1]))
@@ -24,7 +33,47 @@ def _c(ca,i,j,P,Q):
 Algorithm: http://www.kr.tuwien.ac.at/staff/eiter/et-archive/cdtr9464.pdf
 P and Q are arrays of 2-element arrays (points)
 """
+@skd_core_profiling.profiled_stage("frechet")
 def frechetDist(P,Q):
     ca = np.ones((len(P),len(Q)))
     ca = np.multiply(ca,-1)
-    return _c(ca,len(P)-1,len(Q)-1,P,Q)
\ No newline at end of file
+    return _c(ca,len(P)-1,len(Q)-1,P,Q)
+
+""" Computes the discrete frechet distance between P and every polygonal line in Q_batch, an array
+of shape (B, m, 2). Lines with fewer than m points can be padded by repeating their last point, which
+does not change their distance. The dynamic program of frechetDist is solved for the whole batch at
+once, one cell at a time, instead of recursively for each pair
+"""
+@skd_core_profiling.profiled_stage("frechet")
+def frechetDistBatch(P, Q_batch, max_batch_cells=2**22):
+    P = np.asarray(P, dtype=float).reshape(len(P), -1)[:, 0:2]
+    Q_batch = np.asarray(Q_batch, dtype=float)
+    Q_batch = Q_batch.reshape(len(Q_batch), -1, Q_batch.shape[-1])[:, :, 0:2]
+    num_lines = len(Q_batch)
+    frechet_dists = np.empty(num_lines)
+
+    # Lines are processed in chunks to bound the size of the (B, n, m) tables
+    chunk_size = max(1, max_batch_cells // max(1, len(P) * Q_batch.shape[1]))
+    for chunk_start in range(0, num_lines, chunk_size):
+        Q_chunk = Q_batch[chunk_start:chunk_start + chunk_size]
+        frechet_dists[chunk_start:chunk_start + len(Q_chunk)] = _c_batch(P, Q_chunk)
+
+    return frechet_dists
+
+
+def _c_batch(P, Q_batch):
+    # Euclidean distance of every pair of points, as computed by euc_dist
+    diffs = Q_batch[:, None, :, :] - P[None, :, None, :]
+    point_dists = np.sqrt(diffs[..., 0] * diffs[..., 0] + diffs[..., 1] * diffs[..., 1])
+
+    # Coupling table, first row and column are running maxima of the distances
+    ca = np.empty(point_dists.shape)
+    ca[:, 0, :] = np.maximum.accumulate(point_dists[:, 0, :], axis=1)
+    ca[:, :, 0] = np.maximum.accumulate(point_dists[:, :, 0], axis=1)
+    for i in range(1, len(P)):
+        # Cells of the previous row do not depend on this row
+        prev_row_min = np.minimum(ca[:, i-1, 1:], ca[:, i-1, :-1])
+        for j in range(1, Q_batch.shape[1]):
+            ca[:, i, j] = np.maximum(np.minimum(prev_row_min[:, j-1], ca[:, i, j-1]), point_dists[:, i, j])
+
+    return ca[:, -1, -1]
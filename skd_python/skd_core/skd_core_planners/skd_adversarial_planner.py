@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+In-process adversarial search of kamikaze trajectories. Given an oppt kamikaze cfg (as written by the
+KamikazeTrajGenerator), the pedestrian step actions are searched with the cross-entropy method over
+batched rollouts of the python car controller, and the best trajectory of every attempt is written to
+a log file in the OPPT format, so that the kamikaze analysers can read it as a planner log. The search
+takes milliseconds per attempt, which allows screening sweeps of safe trajectories and multipliers
+before running the planner on them.
+"""
+import sys, os
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_core_dir)
+
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+import argparse
+import time
+import numpy as np
+
+# Utils
+import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_planners.skd_standin_planner as skd_standin_planner
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
+
+
+# Default options of the cross-entropy search
+DEFAULT_POPULATION_SIZE = 256
+DEFAULT_NUM_ITERATIONS = 12
+DEFAULT_ELITE_FRACTION = 0.1
+DEFAULT_STD_SMOOTHING = 0.7
+MIN_ACTION_STD = 0.05
+
+# Cost of the rollouts that do not collide, added to their closest distance to the car
+MISS_COST = 1000.0
+# Collision steps of the rollouts that do not collide
+NO_COLLISION_STEP = -1
+
+
+def rollout_kamikaze_actions(ped_start, car_start, controller_multiplier, actions, step_time, noise=None):
+    """ Simulates the (R, steps, 2) velocity actions of R pedestrians starting at ped_start against
+    R basic car controllers starting at car_start, with the step order of the stand-in planner (the car
+    reacts to the pedestrian, then the pedestrian moves). noise is an optional (steps, R) array of uniform
+    [0, 1) samples for the car errors. Returns the (R, steps + 1, 2) pedestrian positions, the (R, steps + 1, 4)
+    car states, the (R, steps + 1) braking flags and the first collision step of every rollout """
+    num_rollouts, num_steps = actions.shape[0], actions.shape[1]
+    pedestrian_batch = batch_controllers.BatchPedestrianController(
+                            np.tile(np.asarray(ped_start, dtype=float), (num_rollouts, 1, 1)))
+    car_batch = batch_controllers.BatchCarController(num_rollouts, car_longit_start=car_start[0],
+                            car_horizontal_start=car_start[1], multiplier=controller_multiplier)
+
+    ped_positions = np.empty((num_rollouts, num_steps + 1, 2))
+    car_states = np.empty((num_rollouts, num_steps + 1, 4))
+    braking = np.zeros((num_rollouts, num_steps + 1), dtype=bool)
+    collision_steps = np.full(num_rollouts, NO_COLLISION_STEP, dtype=int)
+    collided = np.empty(num_rollouts, dtype=bool)
+
+    ped_positions[:, 0] = pedestrian_batch.get_current_pos()
+    car_states[:, 0] = car_batch.state.T
+    for step in range(num_steps):
+        car_batch.advance_car_state(pedestrian_batch, None if (noise is None) else noise[step])
+        pedestrian_batch.set_ped_positions(pedestrian_batch.longit_pos + actions[:, step, 0] * step_time,
+                                           pedestrian_batch.hoz_pos + actions[:, step, 1] * step_time)
+
+        ped_positions[:, step + 1] = pedestrian_batch.get_current_pos()
+        car_states[:, step + 1] = car_batch.state.T
+        braking[:, step + 1] = car_batch.braking
+
+        car_batch.collides(pedestrian_batch, out=collided)
+        collision_steps[collided & (collision_steps == NO_COLLISION_STEP)] = step + 1
+
+    return ped_positions, car_states, braking, collision_steps
+
+
+def get_kamikaze_costs(ped_positions, car_states, collision_steps, safe_traj):
+    """ Costs of the rollouts (lower is better). Colliding rollouts cost the largest distance, up to the
+    collision, between the pedestrian and the safe trajectory point of the same step (an upper bound of
+    their frechet distance), so the search prefers collisions close to the safe trajectory. The rest cost
+    MISS_COST plus their closest distance to the car """
+    safe_traj = np.asarray(safe_traj, dtype=float)
+    num_steps = ped_positions.shape[1]
+    safe_points = safe_traj[np.minimum(np.arange(num_steps), len(safe_traj) - 1)]
+
+    # Steps after the collision are not part of the kamikaze trajectory
+    step_dists = np.hypot(*np.moveaxis(ped_positions - safe_points[None, :, :], -1, 0))
+    after_collision = np.arange(num_steps)[None, :] > collision_steps[:, None]
+    step_dists[after_collision & (collision_steps[:, None] != NO_COLLISION_STEP)] = 0.0
+
+    car_dists = np.hypot(ped_positions[:, :, 0] - car_states[:, :, batch_controllers.BatchCarController.LONGIT_INDEX],
+                         ped_positions[:, :, 1] - car_states[:, :, batch_controllers.BatchCarController.HOZ_INDEX])
+
+    return np.where(collision_steps != NO_COLLISION_STEP, step_dists.max(axis=1), MISS_COST + car_dists.min(axis=1))
+
+
+def get_safe_traj_actions(safe_traj, num_steps, step_time):
+    """ Velocity actions that follow the safe trajectory (and then stay at its last point) """
+    safe_traj = np.asarray(safe_traj, dtype=float)
+    actions = np.zeros((num_steps, 2))
+    safe_actions = np.diff(safe_traj, axis=0)[0:num_steps] / step_time
+    actions[0:len(safe_actions)] = safe_actions
+    return actions
+
+
+def clip_actions(actions, max_speed):
+    """ Clips velocity actions to max_speed per axis and in norm (as the actions of the planner) """
+    np.clip(actions, -max_speed, max_speed, out=actions)
+    speeds = np.hypot(actions[..., 0], actions[..., 1])
+    scale = np.ones(speeds.shape)
+    np.divide(max_speed, speeds, out=scale, where=speeds > max_speed)
+    actions *= scale[..., None]
+    return actions
+
+
+
+class AdversarialKamikazePlanner:
+    """
+    Searches the kamikaze trajectories of an oppt kamikaze cfg. Every attempt (nRuns in the cfg) is an
+    independent cross-entropy search, and all the attempts are searched as a single batch of rollouts:
+    each iteration samples population_size action sequences per attempt around the attempt mean (initially
+    the actions of the safe trajectory), and refits the mean and deviation to the elite_fraction of least cost
+    """
+    def __init__(self, planner_options, population_size=DEFAULT_POPULATION_SIZE, num_iterations=DEFAULT_NUM_ITERATIONS,
+                 elite_fraction=DEFAULT_ELITE_FRACTION, std_smoothing=DEFAULT_STD_SMOOTHING, seed=None):
+        self.options = planner_options
+        assert (self.options.is_kamikaze_cfg()), "Adversarial search needs a kamikaze cfg (safeTrajFilePath)"
+
+        self.population_size = max(2, int(population_size))
+        self.num_iterations = max(1, int(num_iterations))
+        self.num_elites = max(1, int(round(elite_fraction * self.population_size)))
+        self.std_smoothing = std_smoothing
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+        self.safe_traj = skd_core_utils.get_safe_traj_from_file(self.options.safe_traj_file_path,
+                                                                self.options.safe_traj_index)
+        initial_state = self.options.initial_state
+        self.car_start = [initial_state[2], initial_state[3]]
+        if(self.options.car_start_pos is not None):
+            self.car_start = self.options.car_start_pos
+
+
+    def rollout(self, actions, noise=None):
+        return rollout_kamikaze_actions(self.safe_traj[0], self.car_start, self.options.controller_multiplier,
+                                        actions, self.options.step_time, noise)
+
+
+    @skd_core_profiling.profiled_stage("adversarial_search")
+    def search_attempts(self, num_attempts):
+        """ Runs num_attempts searches. Returns the (num_attempts, steps, 2) best actions of every attempt """
+        num_steps = self.options.num_steps
+        max_speed = self.options.ped_max_speed
+        action_shape = (num_attempts, self.population_size, num_steps, 2)
+
+        means = np.tile(get_safe_traj_actions(self.safe_traj, num_steps, self.options.step_time), (num_attempts, 1, 1))
+        stds = np.full(means.shape, max_speed / 2.0)
+        best_actions = clip_actions(means.copy(), max_speed)
+
+        for iteration in range(self.num_iterations):
+            actions = clip_actions(means[:, None] + stds[:, None] * self.rng.standard_normal(action_shape), max_speed)
+            # The first sample of every attempt keeps its best actions so far
+            actions[:, 0] = best_actions
+
+            ped_positions, car_states, braking, collision_steps = self.rollout(
+                                    actions.reshape((-1, num_steps, 2)), self.rng.random_sample((num_steps, actions.shape[0] * actions.shape[1])))
+            costs = get_kamikaze_costs(ped_positions, car_states, collision_steps, self.safe_traj).reshape(num_attempts, -1)
+
+            # Refit the sampling distribution of every attempt to its elites
+            elite_indices = np.argsort(costs, axis=1)[:, 0:self.num_elites]
+            elites = actions[np.arange(num_attempts)[:, None], elite_indices]
+            means = elites.mean(axis=1)
+            stds = np.maximum(self.std_smoothing * elites.std(axis=1) + (1 - self.std_smoothing) * stds, MIN_ACTION_STD)
+
+            best_actions = elites[:, 0].copy()
+
+        return best_actions
+
+
+    def get_run_record(self, actions):
+        """ Simulates the actions of an attempt (with new car errors) and returns its run record, cut
+        at the collision step, with the rewards of the kamikaze reward plugin """
+        ped_positions, car_states, braking, collision_steps = self.rollout(actions[None],
+                                                    self.rng.random_sample((actions.shape[0], 1)))
+        num_run_steps = actions.shape[0] if (collision_steps[0] == NO_COLLISION_STEP) else collision_steps[0]
+        success = (collision_steps[0] != NO_COLLISION_STEP)
+
+        states = []
+        for step in range(num_run_steps + 1):
+            intention = (skd_standin_planner.CAR_INTENTION_HAZARD_STOP if braking[0, step]
+                         else skd_standin_planner.CAR_INTENTION_CRUISING)
+            states.append(ped_positions[0, step].tolist() + car_states[0, step, 0:3].tolist() + [intention])
+
+        rewards = [-self.options.step_penalty] * num_run_steps
+        if(success):
+            rewards[-1] += self.options.goal_reward
+        elif(num_run_steps > 0):
+            rewards[-1] = min(rewards[-1], -self.options.terminal_penalty)
+
+        discounts = np.power(self.options.discount_factor, np.arange(len(rewards)))
+        return {"STATES" : states, "ACTIONS" : actions[0:num_run_steps].tolist(), "REWARDS" : rewards,
+                "DISCOUNTED_REWARD" : float(np.sum(discounts * np.array(rewards))), "SUCCESS" : success}
+
+
+    def execute_runs(self):
+        """ Searches all the attempts of the cfg and writes the associated oppt log file """
+        log_filepath = self.options.get_log_filepath()
+
+        # Create log dir
+        try:
+            os.makedirs(os.path.dirname(log_filepath))
+        except OSError as error:
+            pass
+
+        t_search_start = time.time()
+        attempt_actions = self.search_attempts(self.options.num_runs)
+        # Runs are timed with their share of the batched search
+        run_time_ms = (time.time() - t_search_start) * 1000 / max(1, self.options.num_runs)
+
+        with open(log_filepath, "w+") as log_file:
+            self.write_log_header(log_file)
+            for run_index in range(self.options.num_runs):
+                run_record = self.get_run_record(attempt_actions[run_index])
+                run_record["TIME_MS"] = run_time_ms
+                skd_standin_planner.write_oppt_run(log_file, run_index + 1, run_record)
+
+        return log_filepath
+
+
+    def write_log_header(self, log_file):
+        # Seed of the runs, 0 when they were not seeded
+        log_file.write("seed: %d\n" % (0 if (self.seed is None) else self.seed))
+        log_file.write("Robot: Pedestrian\n")
+        log_file.write("Planning environment: SKDGenTestingEnvironmnent.sdf\n")
+        log_file.write("Execution environment: SKDGenTestingEnvironmnent.sdf\n")
+        log_file.write("solver: AdversarialKamikazePlanner\n")
+
+
+
+
+def main():
+    """ Entry point of the adversarial planner """
+    argparser = argparse.ArgumentParser(
+    description= "Cross-entropy search of kamikaze trajectories for an oppt kamikaze cfg file (-cfg). Writes an"
+    " oppt formatted log file to the logPath in the cfg")
+
+    argparser.add_argument(
+        '-cfg', '--cfg',
+        metavar='cfgFile',
+        type=str,
+        help='path to the oppt cfg file')
+
+    argparser.add_argument(
+        '-p', '--population',
+        metavar='population',
+        type=int,
+        default=DEFAULT_POPULATION_SIZE,
+        help='action sequences sampled per attempt and iteration')
+
+    argparser.add_argument(
+        '-i', '--iterations',
+        metavar='iterations',
+        type=int,
+        default=DEFAULT_NUM_ITERATIONS,
+        help='cross-entropy iterations')
+
+    argparser.add_argument(
+        '-s', '--seed',
+        metavar='seed',
+        type=int,
+        default=None,
+        help='seed for the random number generator')
+
+    # Parse arguments
+    args = argparser.parse_args()
+
+    planner_options = skd_standin_planner.StandInPlannerOptions(args.cfg)
+    planner = AdversarialKamikazePlanner(planner_options, population_size=args.population,
+                                         num_iterations=args.iterations, seed=args.seed)
+    log_filepath = planner.execute_runs()
+    print("Adversarial planner log written to %s" % (log_filepath))
+
+
+
+if __name__ == '__main__':
+    main()
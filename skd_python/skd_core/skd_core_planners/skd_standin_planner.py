@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Stand-in for the OPPT "abt" planner executable. It accepts the same "--cfg" argument as the
+compiled planner, reads the options rewritten by the SKD generators, simulates the pedestrian/car
+interaction with the python collision models and writes a log file in the OPPT format, so that
+the orchestration and analysis layers can be run (and profiled) without building OPPT.
+"""
+import sys, os
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_core_dir)
+
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+import argparse
+import time
+import numpy as np
+
+# Utils
+import skd_core.skd_core_utils.skd_core_utils as skd_core_utils
+import skd_collision_tests.controllers.car_controllers as car_controllers
+import skd_collision_tests.controllers.pedestrian_controllers as pedestrian_controllers
+
+
+# Environment variable used to set the latency of the planner when called by the generators
+STANDIN_LATENCY_ENV_VAR = "SKD_STANDIN_LATENCY"
+
+# Intention values logged in the state vector (as in the oppt plugins)
+CAR_INTENTION_HAZARD_STOP = 0
+CAR_INTENTION_CRUISING = 3
+
+
+class StandInPlannerOptions:
+    """ Options of a planner run, as read from an oppt cfg file """
+    def __init__(self, cfg_path):
+        self.cfg_path = cfg_path
+        cfg = skd_core_utils.load_oppt_cfg(cfg_path)
+
+        # Log options
+        self.log_path = skd_core_utils.get_oppt_cfg_value(cfg, "logPath", "")
+        self.log_file_postfix = str(skd_core_utils.get_oppt_cfg_value(cfg, "logFilePostfix", "standin"))
+
+        # Experiment options
+        self.num_runs = int(skd_core_utils.get_oppt_cfg_value(cfg, "nRuns", 1))
+        self.num_steps = int(skd_core_utils.get_oppt_cfg_value(cfg, "nSteps", 25))
+        self.discount_factor = skd_core_utils.get_oppt_cfg_value(cfg, "discountFactor", 0.98)
+        self.step_time = skd_core_utils.get_oppt_cfg_value(cfg, "fixedStepTime", 0.3)
+
+        # Reward options
+        self.goal_reward = skd_core_utils.get_oppt_cfg_value(cfg, "goalReward", 5000)
+        self.step_penalty = skd_core_utils.get_oppt_cfg_value(cfg, "stepPenalty", 5)
+        self.terminal_penalty = skd_core_utils.get_oppt_cfg_value(cfg, "terminalPenalty", 5000)
+
+        # Car and pedestrian options
+        self.initial_state = skd_core_utils.get_oppt_cfg_value(cfg, "lowerBound", [120, 3, 100, -2, 0, 3])
+        self.controller_multiplier = skd_core_utils.get_oppt_cfg_value(cfg, "controllerMultiplier", 1.0)
+        self.car_start_pos = skd_core_utils.get_oppt_cfg_value(cfg, "carStartPos", None)
+        self.goal_bounds = skd_core_utils.get_oppt_cfg_value(cfg, "goalBounds", None)
+        self.safe_traj_file_path = skd_core_utils.get_oppt_cfg_value(cfg, "safeTrajFilePath", "")
+        self.safe_traj_index = int(skd_core_utils.get_oppt_cfg_value(cfg, "safeTrajIndex", 0))
+
+        # Max pedestrian speed per axis from the action limits
+        action_limits = skd_core_utils.get_oppt_cfg_value(cfg, "additionalDimensionLimits", [[0, 2.5], [0, 2.5]])
+        self.ped_max_speed = max([abs(limit) for axis_limits in action_limits for limit in axis_limits])
+
+
+    def is_kamikaze_cfg(self):
+        """ Kamikaze cfgs are the ones pointing to a safe trajectory file """
+        return (self.safe_traj_file_path is not None) and (str(self.safe_traj_file_path) != "")
+
+
+    def get_log_filepath(self):
+        return os.path.join(str(self.log_path), skd_core_utils.get_oppt_log_filename(self.log_file_postfix))
+
+
+
+class StandInPlanner:
+    """
+    Simulates the runs described by an oppt cfg with the python collision models. Safe trajectory
+    cfgs (goalBounds) are successful when the pedestrian reaches the goal area without colliding, and
+    kamikaze cfgs (safeTrajFilePath) are successful when the pedestrian collides with the car.
+    """
+    def __init__(self, planner_options, latency=0.0, seed=None):
+        self.options = planner_options
+        # Seconds spent per run, to emulate the planning time of the real planner
+        self.latency = latency
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+        # Safe trajectory followed by the pedestrian on kamikaze runs
+        self.safe_traj = None
+        if(self.options.is_kamikaze_cfg()):
+            self.safe_traj = skd_core_utils.get_safe_traj_from_file(self.options.safe_traj_file_path,
+                                                                    self.options.safe_traj_index)
+
+
+    def execute_runs(self):
+        """ Simulates all the runs in the cfg file and writes the associated oppt log file """
+        log_filepath = self.options.get_log_filepath()
+
+        # Create log dir
+        try:
+            os.makedirs(os.path.dirname(log_filepath))
+        except OSError as error:
+            pass
+
+        with open(log_filepath, "w+") as log_file:
+            self.write_log_header(log_file)
+
+            for run_index in range(self.options.num_runs):
+                t_run_start = time.time()
+                run_record = self.simulate_run()
+
+                # Emulate the planning time of the planner
+                if(self.latency > 0):
+                    time.sleep(self.latency)
+
+                run_record["TIME_MS"] = (time.time() - t_run_start) * 1000
+                write_oppt_run(log_file, run_index + 1, run_record)
+
+        return log_filepath
+
+
+    def write_log_header(self, log_file):
+        # Seed of the runs, 0 when they were not seeded
+        log_file.write("seed: %d\n" % (0 if (self.seed is None) else self.seed))
+        log_file.write("Robot: Pedestrian\n")
+        log_file.write("Planning environment: SKDGenTestingEnvironmnent.sdf\n")
+        log_file.write("Execution environment: SKDGenTestingEnvironmnent.sdf\n")
+        log_file.write("solver: StandInPlanner\n")
+
+
+    def get_initial_controllers(self):
+        """ Creates the pedestrian and car controllers at the start of a run """
+        initial_state = self.options.initial_state
+
+        # Pedestrian starts on the safe traj for kamikaze runs or the initial belief otherwise
+        if(self.safe_traj is not None):
+            ped_controller = pedestrian_controllers.PedestrianController(self.safe_traj)
+        else:
+            ped_controller = pedestrian_controllers.PedestrianController([[initial_state[0], initial_state[1]]])
+
+        # Car starts at the carStartPos when given
+        car_start = [initial_state[2], initial_state[3]]
+        if(self.options.car_start_pos is not None):
+            car_start = self.options.car_start_pos
+
+        car_controller = car_controllers.BasicCarController(car_longit_start=car_start[0],
+                        car_horizontal_start=car_start[1], multiplier=self.options.controller_multiplier)
+
+        return ped_controller, car_controller
+
+
+    def simulate_run(self):
+        """ Simulates a single run and returns its record (states, actions and rewards) """
+        ped_controller, car_controller = self.get_initial_controllers()
+        max_step_displacement = self.options.ped_max_speed * self.options.step_time
+
+        # Aggressiveness of the pedestrian towards the car in this run
+        run_aggression = self.rng.uniform(0, 1)
+        # Goal of the pedestrian in this run for safe trajectory cfgs
+        run_goal = None
+        if(self.options.goal_bounds is not None):
+            bounds = self.options.goal_bounds
+            run_goal = [self.rng.uniform(bounds[0], bounds[1]), self.rng.uniform(bounds[2], bounds[3])]
+
+        states = [get_state_vector(ped_controller, car_controller)]
+        actions = []
+        rewards = []
+        success = False
+
+        for step in range(self.options.num_steps):
+            # Choose the pedestrian displacement for this step
+            ped_pos = ped_controller.get_current_pos()
+            target = self.get_step_target(step, ped_controller, car_controller, run_goal, run_aggression)
+            displacement = np.clip(np.array(target) - np.array(ped_pos), -max_step_displacement, max_step_displacement)
+            displacement += self.rng.uniform(-0.1, 0.1, 2) * max_step_displacement
+            actions.append((displacement / self.options.step_time).tolist())
+
+            # Propagate car and pedestrian
+            car_controller.advance_car_state(ped_controller)
+            ped_controller.set_ped_position(ped_pos[0] + displacement[0], ped_pos[1] + displacement[1])
+            states.append(get_state_vector(ped_controller, car_controller))
+
+            # Check terminal conditions
+            reward = -self.options.step_penalty
+            collided = car_controller.collides(ped_controller)
+            terminal = False
+
+            if(self.safe_traj is not None):
+                # Kamikaze runs succeed on collision and end when the car drives past the pedestrian
+                car_passed = (car_controller.get_current_pos()[0] >
+                                ped_controller.get_current_pos()[0] + car_controller.get_car_dimensions()[0]/2)
+                if(collided):
+                    reward += self.options.goal_reward
+                    success = True
+                    terminal = True
+                elif(car_passed):
+                    reward -= self.options.terminal_penalty
+                    terminal = True
+            else:
+                # Safe runs succeed when reaching the goal area without colliding
+                if(collided):
+                    reward -= self.options.terminal_penalty
+                    terminal = True
+                elif(in_goal_bounds(ped_controller.get_current_pos(), self.options.goal_bounds)):
+                    reward += self.options.goal_reward
+                    success = True
+                    terminal = True
+
+            rewards.append(reward)
+            if(terminal):
+                break
+
+        # Penalise runs that never reached a terminal state
+        if(not success and (len(rewards) > 0)):
+            rewards[-1] = min(rewards[-1], -self.options.terminal_penalty)
+
+        discounts = np.power(self.options.discount_factor, np.arange(len(rewards)))
+        discounted_reward = float(np.sum(discounts * np.array(rewards)))
+
+        return {"STATES" : states, "ACTIONS" : actions, "REWARDS" : rewards,
+                "DISCOUNTED_REWARD" : discounted_reward, "SUCCESS" : success}
+
+
+    def get_step_target(self, step, ped_controller, car_controller, run_goal, run_aggression):
+        """ Returns the location the pedestrian walks towards in the given step """
+        # Safe trajectory cfgs walk towards the goal area
+        if(self.safe_traj is None):
+            return run_goal
+
+        # Kamikaze cfgs follow the safe trajectory, deviating towards the front of the car
+        safe_point = self.safe_traj[min(step + 1, len(self.safe_traj) - 1)]
+        car_pos = car_controller.get_current_pos()
+        car_front = [car_pos[0] + car_controller.get_car_dimensions()[0]/2, car_pos[1]]
+
+        return [safe_point[0] + run_aggression * (car_front[0] - safe_point[0]),
+                safe_point[1] + run_aggression * (car_front[1] - safe_point[1])]
+
+
+
+########################################### OPPT LOG HELPERS ###########################################
+def get_state_vector(ped_controller, car_controller):
+    """ Returns the state in the oppt format [PED_LONGIT, PED_HOZ, CAR_LONGIT, CAR_HOZ, CAR_SPEED, CAR_INTENTION] """
+    ped_pos = ped_controller.get_current_pos()
+    car_state = car_controller.get_car_state()
+    intention = CAR_INTENTION_HAZARD_STOP if car_controller.is_braking() else CAR_INTENTION_CRUISING
+    return [ped_pos[0], ped_pos[1], car_state[0], car_state[1], car_state[2], intention]
+
+
+def in_goal_bounds(position, goal_bounds):
+    """ Checks if a position is within goal bounds [longit_min, longit_max, hoz_min, hoz_max] """
+    return (goal_bounds[0] <= position[0] <= goal_bounds[1]) and (goal_bounds[2] <= position[1] <= goal_bounds[3])
+
+
+def serialize_oppt_state(state, prefix="S"):
+    """ Returns a state line in the format written by oppt (VectorState::serialize) """
+    return "%s: %s w: 1 END USER_DATA_BEGIN  USER_DATA_END " % (prefix, " ".join(["%g" % (val) for val in state]))
+
+
+def write_oppt_run(log_file, run_number, run_record):
+    """ Writes a run record (STATES, ACTIONS, REWARDS, DISCOUNTED_REWARD, SUCCESS, TIME_MS)
+    to an open log file, in the format parsed by OPPTLogAnalyser """
+    states = run_record["STATES"]
+    actions = run_record["ACTIONS"]
+    rewards = run_record["REWARDS"]
+
+    log_file.write("Run #%d\n" % (run_number))
+
+    # Step information
+    for step in range(len(actions)):
+        log_file.write("t = %d\n" % (step))
+        log_file.write(serialize_oppt_state(states[step]) + "\n")
+        log_file.write("A: %s \n" % (" ".join(["%g" % (val) for val in actions[step]])))
+        log_file.write("Immediate reward: %g\n" % (rewards[step]))
+
+    # Final state
+    log_file.write("t = %d\n" % (len(actions)))
+    log_file.write(serialize_oppt_state(states[-1]) + "\n")
+    log_file.write("FINAL_STATE_BEGIN\n")
+    log_file.write("FINAL_STATE_END\n")
+
+    # Run summary
+    log_file.write("Total discounted reward: %g\n" % (run_record["DISCOUNTED_REWARD"]))
+    log_file.write("Run successful: %s\n" % ("True" if run_record["SUCCESS"] else "False"))
+    log_file.write("Num steps: %d\n" % (len(actions)))
+    log_file.write("Total time taken: %gms\n" % (run_record.get("TIME_MS", 0)))
+    log_file.write("RUN_FINISHED_USER_DATA_BEGIN\n")
+    log_file.write("RUN_FINISHED_USER_DATA_END\n")
+
+
+
+
+def main():
+    """ Entry point of the stand-in planner """
+    argparser = argparse.ArgumentParser(
+    description= "Stand-in for the OPPT abt planner. Simulates the runs in an oppt cfg file (-cfg) with the python"
+    " collision models and writes an oppt formatted log file to the logPath in the cfg")
+
+    argparser.add_argument(
+        '-cfg', '--cfg',
+        metavar='cfgFile',
+        type=str,
+        help='path to the oppt cfg file')
+
+    argparser.add_argument(
+        '-l', '--latency',
+        metavar='latency',
+        type=float,
+        default=float(os.getenv(STANDIN_LATENCY_ENV_VAR, 0.0)),
+        help='seconds spent per run to emulate the planning time (defaults to $%s or 0)' % (STANDIN_LATENCY_ENV_VAR))
+
+    argparser.add_argument(
+        '-s', '--seed',
+        metavar='seed',
+        type=int,
+        default=None,
+        help='seed for the random number generator')
+
+    # Parse arguments
+    args = argparser.parse_args()
+
+    planner_options = StandInPlannerOptions(args.cfg)
+    planner = StandInPlanner(planner_options, latency=args.latency, seed=args.seed)
+    log_filepath = planner.execute_runs()
+    print("Stand-in planner log written to %s" % (log_filepath))
+
+
+
+if __name__ == '__main__':
+    main()
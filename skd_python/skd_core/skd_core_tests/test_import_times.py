@@ -0,0 +1,88 @@
+import sys, os
+import argparse, subprocess
+import json, statistics
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_core_dir)
+
+
+# Modules loaded by the cli entry points and by the process pool workers
+ENTRY_POINT_MODULES = ["skd_core.skd_core_utils.skd_core_utils",
+					"skd_core.skd_core_generators.skd_safe_traj_gen",
+					"skd_core.skd_core_generators.skd_kamikaze_traj_gen",
+					"skd_core.skd_core_analysers.skd_kamikaze_data_analyser",
+					"skd_core.skd_core_planners.skd_standin_planner",
+					"skd_collision_tests.collision_environment.collision_experiments_loader",
+					"skd_collision_tests.collision_environment.collision_data_analyser",
+					"skd_aggregator"]
+
+# Heavy dependencies that should only be loaded when the GUI, plots or CI helpers are used
+LAZY_MODULES = ["tkinter", "matplotlib", "scipy"]
+
+# Runs in a fresh interpreter so that nothing is already cached in sys.modules
+IMPORT_TIMER_CODE = """
+import sys, time, json
+sys.path.insert(0, %r)
+t_start = time.perf_counter()
+import %s
+t_end = time.perf_counter()
+print(json.dumps({"IMPORT_TIME_S" : t_end - t_start,
+				"LOADED_LAZY_MODULES" : [name for name in %r if name in sys.modules]}))
+"""
+
+
+def time_module_import(module_name, num_samples):
+	""" Imports module_name num_samples times in fresh interpreters. Returns the import times
+	and the heavy modules that were loaded as a side effect """
+	import_times = []
+	loaded_lazy_modules = []
+	for sample in range(num_samples):
+		timer_code = IMPORT_TIMER_CODE % (skd_python_dir, module_name, LAZY_MODULES)
+		timer_output = subprocess.run([sys.executable, "-c", timer_code], stdout=subprocess.PIPE, check=True)
+		import_record = json.loads(timer_output.stdout.decode().strip().splitlines()[-1])
+		import_times.append(import_record["IMPORT_TIME_S"])
+		loaded_lazy_modules = import_record["LOADED_LAZY_MODULES"]
+
+	return import_times, loaded_lazy_modules
+
+
+
+def run_import_benchmarks(num_samples, outpath=None):
+	benchmark_summary = {}
+	print("%-75s %12s %12s  %s" % ("MODULE", "MEDIAN (ms)", "MIN (ms)", "LAZY MODULES LOADED"))
+	for module_name in ENTRY_POINT_MODULES:
+		import_times, loaded_lazy_modules = time_module_import(module_name, num_samples)
+		benchmark_summary[module_name] = {"IMPORT_TIMES_S" : import_times,
+										"MEDIAN_IMPORT_TIME_S" : statistics.median(import_times),
+										"LOADED_LAZY_MODULES" : loaded_lazy_modules}
+		print("%-75s %12.1f %12.1f  %s" % (module_name, 1000 * statistics.median(import_times),
+										1000 * min(import_times), ",".join(loaded_lazy_modules)))
+
+	if(outpath is not None):
+		with open(outpath, "w+") as outfile:
+			json.dump(benchmark_summary, outfile, indent = 4)
+
+	return benchmark_summary
+
+
+
+if __name__ == '__main__':
+	argparser = argparse.ArgumentParser(
+	description= "Import time benchmarks of the SKD entry points")
+
+	argparser.add_argument(
+		'-n', '--samples',
+		type=int,
+		default=5,
+		help='number of fresh interpreters used per module')
+
+	argparser.add_argument(
+		'-o', '--outpath',
+		type=str,
+		default=None,
+		help='optional json file to save the benchmark results')
+
+	args = argparser.parse_args()
+	run_import_benchmarks(args.samples, args.outpath)
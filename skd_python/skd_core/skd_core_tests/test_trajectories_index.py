@@ -0,0 +1,89 @@
+import sys, os
+import argparse
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+skd_python_dir = os.path.dirname(skd_core_dir)
+if(skd_python_dir not in sys.path):
+	sys.path.append(skd_python_dir)
+
+# Import local skd_libraries
+import skd_trajectories.trajectories_generators as traj_generators
+import skd_trajectories.trajectories_index as traj_index
+import skd_core.skd_core_metrics.Fretchet as Fretchet
+
+import numpy as np
+
+
+# Checks the queries of trajectories_index.TrajectoryIndex against brute force frechetDistBatch distances
+def get_test_trajectories(num_trajs, num_duplicates, random_state):
+	""" Safe trajectories with some of them repeated, so that queries have ties at the k-th neighbour """
+	trajs = traj_generators.sample_safe_trajectory_array([100, 130], [100, 130], [100, 130], num_trajs,
+														random_state=random_state)
+	duplicates = trajs[random_state.randint(num_trajs, size=num_duplicates)]
+	return np.concatenate([trajs, duplicates])
+
+
+def get_brute_force_results(traj_dists, num_results):
+	""" Indices and distances of the num_results nearest trajectories, sorted by distance (ties by index) """
+	result_order = np.lexsort((np.arange(len(traj_dists)), traj_dists))[0:num_results]
+	return result_order, traj_dists[result_order]
+
+
+def check_queries(index, trajs, queries, k):
+	""" Returns the number of nearest and radius queries that differ from brute force """
+	nearest_failures = 0
+	radius_failures = 0
+	for query in queries:
+		traj_dists = Fretchet.frechetDistBatch(query, trajs)
+		expected_indices, expected_dists = get_brute_force_results(traj_dists, k)
+		result_indices, result_dists = index.query_nearest(query, k)
+		if(not (np.array_equal(result_indices, expected_indices) and np.array_equal(result_dists, expected_dists))):
+			nearest_failures += 1
+			print("query_nearest mismatch: %s %s != %s %s" % (result_indices, result_dists, expected_indices, expected_dists))
+
+		# The radius of the k-th neighbour puts its distance (and its ties) on the boundary of the query
+		radius = expected_dists[-1]
+		expected_indices, expected_dists = get_brute_force_results(traj_dists, int((traj_dists <= radius).sum()))
+		result_indices, result_dists = index.query_radius(query, radius)
+		if(not (np.array_equal(result_indices, expected_indices) and np.array_equal(result_dists, expected_dists))):
+			radius_failures += 1
+			print("query_radius mismatch: %s != %s" % (result_indices, expected_indices))
+
+	return nearest_failures, radius_failures
+
+
+def main():
+	""" Entry point of the test """
+	argparser = argparse.ArgumentParser(
+		description="Compares the trajectory index queries with brute force frechet distances"
+	)
+	argparser.add_argument('-n', '--num_trajs', type=int, default=1000, help='Number of indexed trajectories')
+	argparser.add_argument('-q', '--num_queries', type=int, default=40, help='Number of random queries')
+	argparser.add_argument('-k', '--k', type=int, default=5, help='Neighbours of the nearest queries')
+	argparser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the trajectories')
+	args = argparser.parse_args()
+
+	random_state = np.random.RandomState(args.seed)
+	trajs = get_test_trajectories(args.num_trajs, args.num_trajs // 10, random_state)
+	index = traj_index.TrajectoryIndex(trajs, random_state=random_state)
+
+	# Random queries, queries at indexed (and duplicated) trajectories, which tie with their copies, and shifted
+	# indexed trajectories, whose distances are the ones of their end points (so the lower bounds are tight)
+	queries = list(traj_generators.sample_safe_trajectory_array([100, 130], [100, 130], [100, 130], args.num_queries,
+																random_state=random_state))
+	queries += list(trajs[-args.num_queries:])
+	queries += list(trajs[random_state.randint(len(trajs), size=args.num_queries)] +
+					random_state.uniform(-2.0, 2.0, (args.num_queries, 1, 2)))
+
+	nearest_failures, radius_failures = check_queries(index, trajs, queries, args.k)
+	print("%d queries, %d query_nearest and %d query_radius mismatches, %d exact distances computed" %
+		(len(queries), nearest_failures, radius_failures, index.get_num_exact_evaluations()))
+	if(nearest_failures > 0 or radius_failures > 0):
+		sys.exit(1)
+
+
+
+if __name__ == '__main__':
+	main()
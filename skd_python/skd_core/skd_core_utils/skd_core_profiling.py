@@ -0,0 +1,264 @@
+"""
+Lightweight per-stage instrumentation for the SKD pipeline. Stages are timed with the
+profile_stage context manager or the profiled_stage decorator, which accumulate wall time,
+cpu time, call counts and bytes read/written per stage name. A cProfile (or pyinstrument)
+capture of single stages can be enabled with enable_stage_capture or the SKD_PROFILE_STAGES
+environment variable, and the collected stats are dumped with save_timing_report.
+"""
+import os
+import sys
+import time
+import json
+import types
+import functools
+import contextlib
+
+
+# Environment variables used to request profiler captures without code changes
+PROFILE_STAGES_ENV_VAR = "SKD_PROFILE_STAGES"
+PROFILE_DIR_ENV_VAR = "SKD_PROFILE_DIR"
+PROFILE_BACKEND_ENV_VAR = "SKD_PROFILE_BACKEND"
+
+# The skd modules are imported both from the skd_python and the skd_core roots, which loads
+# this module twice. The stage registry is kept in a shared module so both copies report together.
+_STATE_MODULE_NAME = "_skd_core_profiling_state"
+
+
+def _get_profiling_state():
+    """ Returns the process wide profiling state """
+    state = sys.modules.get(_STATE_MODULE_NAME)
+    if(state is None):
+        state = types.ModuleType(_STATE_MODULE_NAME)
+        # Stats collected per stage name
+        state.stages = {}
+        # Stages to capture with a profiler, mapped to their capture objects
+        state.capture_stages = {}
+        state.capture_dir = os.getenv(PROFILE_DIR_ENV_VAR)
+        state.capture_backend = os.getenv(PROFILE_BACKEND_ENV_VAR, "cprofile")
+        state.capture_active = False
+
+        for stage_name in os.getenv(PROFILE_STAGES_ENV_VAR, "").split(","):
+            if(len(stage_name.strip()) > 0):
+                state.capture_stages[stage_name.strip()] = None
+
+        sys.modules[_STATE_MODULE_NAME] = state
+    return state
+
+
+
+class StageStats:
+    """ Accumulated timing and I/O statistics of a pipeline stage """
+    def __init__(self, stage_name):
+        self.stage_name = stage_name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+
+    def add_call(self, wall_time, cpu_time, bytes_read=0, bytes_written=0):
+        self.calls += 1
+        self.wall_time += wall_time
+        self.cpu_time += cpu_time
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+
+
+    def merge(self, stage_record):
+        """ Merges a stage record (as in the timing report) into these stats """
+        self.calls += stage_record["CALLS"]
+        self.wall_time += stage_record["WALL_TIME_S"]
+        self.cpu_time += stage_record["CPU_TIME_S"]
+        self.bytes_read += stage_record["BYTES_READ"]
+        self.bytes_written += stage_record["BYTES_WRITTEN"]
+
+
+    def to_dict(self):
+        return {"CALLS" : self.calls,
+                "WALL_TIME_S" : self.wall_time,
+                "CPU_TIME_S" : self.cpu_time,
+                "MEAN_WALL_TIME_S" : (self.wall_time / self.calls) if (self.calls > 0) else 0.0,
+                "BYTES_READ" : self.bytes_read,
+                "BYTES_WRITTEN" : self.bytes_written}
+
+
+
+def get_stage_stats(stage_name):
+    """ Returns the stats object associated with stage_name, creating it if needed """
+    stages = _get_profiling_state().stages
+    if(stage_name not in stages):
+        stages[stage_name] = StageStats(stage_name)
+    return stages[stage_name]
+
+
+def read_process_io_counters():
+    """ Returns the (bytes_read, bytes_written) of this process through read/write calls.
+    Zeros are returned on platforms without /proc/self/io """
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = {}
+            for line in io_file:
+                key, value = line.split(":")
+                counters[key.strip()] = int(value)
+            return counters["rchar"], counters["wchar"]
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def record_stage_io(stage_name, bytes_read=0, bytes_written=0):
+    """ Adds I/O that is not seen by this process (e.g files written by the planner) to a stage """
+    stage_stats = get_stage_stats(stage_name)
+    stage_stats.bytes_read += bytes_read
+    stage_stats.bytes_written += bytes_written
+
+
+def record_stage_file_written(stage_name, filepath):
+    """ Adds the size of a file written by another process (e.g the planner log) to a stage """
+    if(os.path.isfile(filepath)):
+        record_stage_io(stage_name, bytes_written=os.path.getsize(filepath))
+
+
+
+@contextlib.contextmanager
+def profile_stage(stage_name):
+    """ Context manager accumulating the wall time, cpu time, calls and I/O of the wrapped block """
+    state = _get_profiling_state()
+    profiler = _start_stage_capture(state, stage_name)
+
+    start_read, start_written = read_process_io_counters()
+    t_wall_start = time.perf_counter()
+    t_cpu_start = time.process_time()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - t_wall_start
+        cpu_time = time.process_time() - t_cpu_start
+        end_read, end_written = read_process_io_counters()
+
+        _stop_stage_capture(state, stage_name, profiler)
+        get_stage_stats(stage_name).add_call(wall_time, cpu_time,
+                                             end_read - start_read, end_written - start_written)
+
+
+def profiled_stage(stage_name):
+    """ Decorator version of profile_stage """
+    def stage_decorator(func):
+        @functools.wraps(func)
+        def stage_wrapper(*args, **kwargs):
+            with profile_stage(stage_name):
+                return func(*args, **kwargs)
+        return stage_wrapper
+    return stage_decorator
+
+
+
+######################################## PROFILER CAPTURES ############################################
+def enable_stage_capture(stage_name, capture_dir=None, backend="cprofile"):
+    """ Enables a profiler capture of every call to the stage. Backend is either "cprofile" or
+    "pyinstrument". Captures are written to capture_dir (or next to the timing report) by save_timing_report """
+    state = _get_profiling_state()
+    state.capture_stages[stage_name] = None
+    state.capture_backend = backend
+    if(capture_dir is not None):
+        state.capture_dir = capture_dir
+
+
+def _start_stage_capture(state, stage_name):
+    # Only one capture can run at a time, nested stages are included in the outer capture
+    if(stage_name not in state.capture_stages or state.capture_active):
+        return None
+
+    profiler = state.capture_stages[stage_name]
+    if(state.capture_backend == "pyinstrument"):
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        # Keep every capture of the stage
+        state.capture_stages[stage_name] = (state.capture_stages[stage_name] or []) + [profiler]
+    else:
+        import cProfile
+        if(profiler is None):
+            profiler = cProfile.Profile()
+            state.capture_stages[stage_name] = profiler
+        profiler.enable()
+
+    state.capture_active = True
+    return profiler
+
+
+def _stop_stage_capture(state, stage_name, profiler):
+    if(profiler is None):
+        return
+
+    if(state.capture_backend == "pyinstrument"):
+        profiler.stop()
+    else:
+        profiler.disable()
+    state.capture_active = False
+
+
+def save_stage_captures(capture_dir=None):
+    """ Writes the profiler captures of the captured stages. Returns the list of files written """
+    state = _get_profiling_state()
+    capture_dir = capture_dir if (capture_dir is not None) else (state.capture_dir or os.getcwd())
+    capture_files = []
+
+    for stage_name in state.capture_stages:
+        capture = state.capture_stages[stage_name]
+        if(capture is None):
+            continue
+
+        try:
+            os.makedirs(capture_dir)
+        except OSError as error:
+            pass
+
+        if(isinstance(capture, list)):
+            # pyinstrument sessions, one html file per call
+            for capture_index in range(len(capture)):
+                capture_path = capture_dir + "/%s_%d.html" % (stage_name, capture_index)
+                with open(capture_path, "w+") as capture_file:
+                    capture_file.write(capture[capture_index].output_html())
+                capture_files.append(capture_path)
+        else:
+            # cProfile stats of all calls, to be read with pstats or snakeviz
+            capture_path = capture_dir + "/%s.prof" % (stage_name)
+            capture.dump_stats(capture_path)
+            capture_files.append(capture_path)
+
+    return capture_files
+
+
+
+########################################### TIMING REPORTS #############################################
+def get_timing_report():
+    """ Returns a dictionary with the stats of every stage timed in this process """
+    stages = _get_profiling_state().stages
+    return {stage_name : stages[stage_name].to_dict() for stage_name in sorted(stages)}
+
+
+def merge_timing_report(timing_report):
+    """ Merges a timing report (e.g from a worker process) into the stats of this process """
+    for stage_name in timing_report:
+        get_stage_stats(stage_name).merge(timing_report[stage_name])
+
+
+def save_timing_report(outpath):
+    """ Saves the timing report of this process as json, along with any profiler captures """
+    timing_report = get_timing_report()
+    with open(outpath, "w+") as report_file:
+        json.dump(timing_report, report_file, indent = 4)
+
+    # Captures are written next to the report unless a capture dir was requested
+    capture_dir = _get_profiling_state().capture_dir
+    if(capture_dir is None):
+        capture_dir = os.path.dirname(os.path.abspath(outpath)) + "/stage_captures"
+    save_stage_captures(capture_dir)
+
+    return timing_report
+
+
+def reset_timing_report():
+    """ Clears the stats collected so far """
+    _get_profiling_state().stages.clear()
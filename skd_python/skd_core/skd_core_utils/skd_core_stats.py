@@ -0,0 +1,361 @@
+"""
+Streaming statistics for the SKD analysers. StreamingStats keeps the count, sum, mean, M2
+(sum of squared deviations), min and max of a stream of values using Welford's updates, so
+the statistics of files, workers and controllers can be merged instead of concatenating the
+raw data. An optional t-digest keeps approximate quantiles with bounded memory.
+Wilson/Clopper-Pearson intervals of rates and bootstrap intervals of means are computed for
+arrays of counts or samples at once, along with the runs needed to reach a target CI width.
+"""
+import math
+import numpy as np
+
+
+# Two sided 95% quantile of the standard normal distribution
+NORMAL_95_Z = 1.959963984540054
+
+
+
+class TDigest:
+    """ Merging t-digest (Dunning & Ertl) of approximate quantiles. Values are buffered and
+    compressed into at most ~compression centroids """
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroid_means = np.zeros(0)
+        self.centroid_weights = np.zeros(0)
+        self.buffer = []
+
+
+    def add(self, value, weight=1.0):
+        self.buffer.append((float(value), float(weight)))
+        if(len(self.buffer) >= 10 * self.compression):
+            self.compress()
+
+
+    def add_array(self, values):
+        np_values = np.asarray(values, dtype=float).ravel()
+        self.centroid_means = np.concatenate([self.centroid_means, np_values])
+        self.centroid_weights = np.concatenate([self.centroid_weights, np.ones(len(np_values))])
+        self.compress()
+
+
+    def merge(self, other):
+        other.compress()
+        self.centroid_means = np.concatenate([self.centroid_means, other.centroid_means])
+        self.centroid_weights = np.concatenate([self.centroid_weights, other.centroid_weights])
+        self.compress()
+
+
+    def compress(self):
+        """ Merges the buffered values and the centroids using the k1 (arcsine) scale function """
+        if(len(self.buffer) > 0):
+            np_buffer = np.array(self.buffer, dtype=float)
+            self.centroid_means = np.concatenate([self.centroid_means, np_buffer[:, 0]])
+            self.centroid_weights = np.concatenate([self.centroid_weights, np_buffer[:, 1]])
+            self.buffer = []
+
+        if(len(self.centroid_means) <= 1):
+            return
+
+        order = np.argsort(self.centroid_means, kind="mergesort")
+        means = self.centroid_means[order]
+        weights = self.centroid_weights[order]
+        total_weight = weights.sum()
+
+        # Each centroid can grow until the k1 scale function increases by one
+        merged_means = [means[0]]
+        merged_weights = [weights[0]]
+        weight_so_far = 0.0
+        k_limit = self._k_scale(0.0) + 1.0
+        for index in range(1, len(means)):
+            projected_q = (weight_so_far + merged_weights[-1] + weights[index]) / total_weight
+            if(self._k_scale(projected_q) <= k_limit):
+                new_weight = merged_weights[-1] + weights[index]
+                merged_means[-1] += (means[index] - merged_means[-1]) * weights[index] / new_weight
+                merged_weights[-1] = new_weight
+            else:
+                weight_so_far += merged_weights[-1]
+                k_limit = self._k_scale(weight_so_far / total_weight) + 1.0
+                merged_means.append(means[index])
+                merged_weights.append(weights[index])
+
+        self.centroid_means = np.array(merged_means)
+        self.centroid_weights = np.array(merged_weights)
+
+
+    def _k_scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+
+    def quantile(self, q):
+        """ Approximate q quantile (0 <= q <= 1), interpolated between the centroids """
+        self.compress()
+        if(len(self.centroid_means) == 0):
+            return float("nan")
+        if(len(self.centroid_means) == 1):
+            return float(self.centroid_means[0])
+
+        # Centroids are placed at the middle of their cumulative weight
+        centroid_positions = np.cumsum(self.centroid_weights) - self.centroid_weights / 2.0
+        return float(np.interp(q * self.centroid_weights.sum(), centroid_positions, self.centroid_means))
+
+
+    def to_dict(self):
+        self.compress()
+        return {"MEANS" : self.centroid_means.tolist(),
+                "WEIGHTS" : self.centroid_weights.tolist(),
+                "COMPRESSION" : self.compression}
+
+
+    @classmethod
+    def from_dict(cls, digest_dict):
+        digest = cls(digest_dict["COMPRESSION"])
+        digest.centroid_means = np.array(digest_dict["MEANS"], dtype=float)
+        digest.centroid_weights = np.array(digest_dict["WEIGHTS"], dtype=float)
+        return digest
+
+
+
+class StreamingStats:
+    """ Mergeable accumulator of count, sum, mean, M2, min and max (and optionally quantiles) """
+    def __init__(self, quantiles=False, compression=100):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.digest = TDigest(compression) if quantiles else None
+
+
+    def add(self, value):
+        """ Welford update with a single value """
+        value = float(value)
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if(self.digest is not None):
+            self.digest.add(value)
+
+
+    def add_array(self, values):
+        """ Adds a batch of values by merging its numpy moments """
+        np_values = np.asarray(values, dtype=float).ravel()
+        if(len(np_values) == 0):
+            return
+        batch_mean = np_values.mean()
+        self._merge_moments(len(np_values), np_values.sum(), batch_mean,
+                            np.sum((np_values - batch_mean) ** 2), np_values.min(), np_values.max())
+        if(self.digest is not None):
+            self.digest.add_array(np_values)
+
+
+    def merge(self, other):
+        """ Combines the stats of another accumulator (Chan et al. parallel update) into this one """
+        self._merge_moments(other.count, other.total, other.mean, other.m2, other.min, other.max)
+        if(self.digest is not None and other.digest is not None):
+            self.digest.merge(other.digest)
+        return self
+
+
+    def _merge_moments(self, count, total, mean, m2, min_value, max_value):
+        if(count == 0):
+            return
+        new_count = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * count / new_count
+        self.mean += delta * count / new_count
+        self.count = new_count
+        self.total += total
+        self.min = min(self.min, min_value)
+        self.max = max(self.max, max_value)
+
+
+    def get_var(self, ddof=1):
+        return (self.m2 / (self.count - ddof)) if (self.count > ddof) else float("nan")
+
+
+    def get_sem(self):
+        """ Standard error of the mean (as scipy.stats.sem) """
+        return math.sqrt(self.get_var() / self.count) if (self.count > 1) else float("nan")
+
+
+    def get_normal_ci(self, z=NORMAL_95_Z):
+        """ Normal approximation CI of the mean. As scipy.stats.norm.interval, it is undefined (nan)
+        when the standard error is not positive """
+        sem = self.get_sem()
+        if(not(sem > 0)):
+            return float("nan"), float("nan")
+        return self.mean - z * sem, self.mean + z * sem
+
+
+    def get_quantile(self, q):
+        assert (self.digest is not None), "Quantiles were not enabled for these stats"
+        return self.digest.quantile(q)
+
+
+    def to_array(self):
+        """ Returns [size, sum, mean, var, ci_low, ci_high] as process_general_stats_array """
+        ci_low, ci_high = self.get_normal_ci()
+        mean = self.mean if (self.count > 0) else float("nan")
+        return [self.count, self.total, mean, self.get_var(), ci_low, ci_high]
+
+
+    def to_dict(self):
+        """ Summary with the keys of process_general_stats plus the state needed to merge it later """
+        data_size, data_sum, data_mean, data_var, ci_low, ci_high = self.to_array()
+        stats_dict = {"DATA_SUM" : data_sum,
+                    "DATA_SIZE" : data_size,
+                    "DATA_MEAN" : data_mean,
+                    "DATA_VAR" : data_var,
+                    "DATA_CI_LOW" : ci_low,
+                    "DATA_CI_HIGH" : ci_high,
+                    "DATA_M2" : self.m2,
+                    "DATA_MIN" : self.min,
+                    "DATA_MAX" : self.max}
+        if(self.digest is not None):
+            stats_dict["DATA_DIGEST"] = self.digest.to_dict()
+        return stats_dict
+
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+        stats = cls()
+        stats.count = stats_dict["DATA_SIZE"]
+        stats.total = stats_dict["DATA_SUM"]
+        stats.mean = stats_dict["DATA_MEAN"] if (stats.count > 0) else 0.0
+        stats.m2 = stats_dict["DATA_M2"]
+        stats.min = stats_dict["DATA_MIN"]
+        stats.max = stats_dict["DATA_MAX"]
+        if("DATA_DIGEST" in stats_dict):
+            stats.digest = TDigest.from_dict(stats_dict["DATA_DIGEST"])
+        return stats
+
+
+
+def get_streaming_stats(data_array, quantiles=False):
+    """ Returns the StreamingStats of an array of values """
+    stats = StreamingStats(quantiles)
+    stats.add_array(data_array)
+    return stats
+
+
+def merge_streaming_stats(stats_list, quantiles=False):
+    """ Returns a new accumulator with all the given stats merged """
+    merged_stats = StreamingStats(quantiles)
+    for stats in stats_list:
+        merged_stats.merge(stats)
+    return merged_stats
+
+
+
+############################################ RATE INTERVALS ###################################################
+def get_wilson_intervals(successes, trials, z=NORMAL_95_Z):
+    """ Wilson score intervals of Bernoulli rates (e.g collision rates). Inputs can be arrays, the
+    intervals of every entry are computed at once. Entries without trials are nan """
+    np_successes = np.asarray(successes, dtype=float)
+    np_trials = np.asarray(trials, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np_successes / np_trials
+        denominator = 1 + z * z / np_trials
+        centre = (rates + z * z / (2 * np_trials)) / denominator
+        half_width = z * np.sqrt(rates * (1 - rates) / np_trials + z * z / (4 * np_trials * np_trials)) / denominator
+    return np.clip(centre - half_width, 0.0, 1.0), np.clip(centre + half_width, 0.0, 1.0)
+
+
+def get_weighted_rate_counts(successes, trials, weights):
+    """ Counts of the rate of several groups of runs pooled (e.g the ST_n cells of a controller), where every
+    run of a group stands for its weight (e.g the cluster size of a deduplicated safe trajectory). Returns
+    (successes, trials) with the weighted rate and the effective (Kish) number of trials, so the intervals of
+    the counts account for the weights. Equal weights give the summed counts """
+    np_successes = np.asarray(successes, dtype=float)
+    np_trials = np.asarray(trials, dtype=float)
+    np_weights = np.asarray(weights, dtype=float)
+    if(len(np_weights) == 0 or np.all(np_weights == np_weights[0])):
+        return np_successes.sum(), np_trials.sum()
+
+    weighted_trials = np.sum(np_weights * np_trials)
+    if(weighted_trials <= 0):
+        return 0.0, 0.0
+    effective_trials = weighted_trials ** 2 / np.sum(np_weights * np_weights * np_trials)
+    return np.sum(np_weights * np_successes) / weighted_trials * effective_trials, effective_trials
+
+
+def get_clopper_pearson_intervals(successes, trials, alpha=0.05):
+    """ Exact (Clopper-Pearson) intervals of Bernoulli rates, computed at once for arrays of counts """
+    # Only loaded when the exact intervals are requested
+    import scipy.special as special
+    np_successes = np.asarray(successes, dtype=float)
+    np_trials = np.asarray(trials, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ci_low = np.where(np_successes > 0,
+                    special.betaincinv(np_successes, np_trials - np_successes + 1, alpha / 2), 0.0)
+        ci_high = np.where(np_successes < np_trials,
+                    special.betaincinv(np_successes + 1, np_trials - np_successes, 1 - alpha / 2), 1.0)
+    no_trials = np_trials <= 0
+    return np.where(no_trials, np.nan, ci_low), np.where(no_trials, np.nan, ci_high)
+
+
+def get_runs_for_rate_ci_width(rates, target_width, z=NORMAL_95_Z, max_runs=10**7):
+    """ Smallest number of runs for the Wilson interval of each rate to be at most target_width wide.
+    Unknown (nan) rates use the worst case rate of 0.5 """
+    np_rates = np.asarray(rates, dtype=float)
+    np_rates = np.where(np.isfinite(np_rates), np_rates, 0.5)
+
+    # Bisection over all the rates at once, the interval width decreases with the number of runs
+    low = np.ones(np_rates.shape)
+    high = np.full(np_rates.shape, float(max_runs))
+    while(np.any(high - low > 1)):
+        mid = np.floor((low + high) / 2)
+        ci_low, ci_high = get_wilson_intervals(np_rates * mid, mid, z)
+        narrow_enough = (ci_high - ci_low) <= target_width
+        high = np.where(narrow_enough, mid, high)
+        low = np.where(narrow_enough, low, mid)
+    return high.astype(int)
+
+
+def get_runs_for_mean_ci_width(stds, target_width, z=NORMAL_95_Z):
+    """ Number of samples for the normal CI of a mean with the given standard deviations
+    to be at most target_width wide """
+    np_stds = np.asarray(stds, dtype=float)
+    with np.errstate(invalid="ignore"):
+        return np.ceil((2 * z * np_stds / target_width) ** 2)
+
+
+
+########################################### BOOTSTRAP INTERVALS ###############################################
+def get_bootstrap_intervals(samples_list, num_resamples=2000, alpha=0.05, seed=None, max_batch_values=2*10**7):
+    """ Percentile bootstrap CIs of the mean of several samples (e.g the frechet distances of every
+    controller). All the samples are resampled together as one padded (samples, resamples, size)
+    array, in batches of resamples of at most max_batch_values values. Returns (means, ci_lows, ci_highs) """
+    rng = np.random.RandomState(seed)
+    num_samples = len(samples_list)
+    sizes = np.array([len(samples) for samples in samples_list], dtype=int)
+    max_size = max(1, sizes.max()) if (num_samples > 0) else 1
+
+    # Padded matrix of the samples, the padding is never drawn
+    padded_samples = np.zeros((num_samples, max_size))
+    for sample_index in range(num_samples):
+        padded_samples[sample_index, :sizes[sample_index]] = samples_list[sample_index]
+    column_mask = np.arange(max_size)[None, None, :] < sizes[:, None, None]
+
+    resample_means = np.zeros((num_samples, num_resamples))
+    batch_size = max(1, min(num_resamples, max_batch_values // max(1, num_samples * max_size)))
+    for batch_start in range(0, num_resamples, batch_size):
+        batch_end = min(num_resamples, batch_start + batch_size)
+        # Uniform draws scaled by each sample size give the resampled indices of every sample at once
+        draws = rng.random_sample((num_samples, batch_end - batch_start, max_size))
+        resampled_indices = np.floor(draws * sizes[:, None, None]).astype(int)
+        resampled = np.take_along_axis(padded_samples[:, None, :], resampled_indices, axis=2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            resample_means[:, batch_start:batch_end] = np.where(column_mask, resampled, 0.0).sum(axis=2) / sizes[:, None]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = padded_samples.sum(axis=1) / sizes
+    ci_lows = np.percentile(resample_means, 100 * alpha / 2, axis=1)
+    ci_highs = np.percentile(resample_means, 100 * (1 - alpha / 2), axis=1)
+    empty = sizes == 0
+    return np.where(empty, np.nan, means), np.where(empty, np.nan, ci_lows), np.where(empty, np.nan, ci_highs)
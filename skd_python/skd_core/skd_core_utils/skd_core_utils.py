@@ -1,13 +1,25 @@
 import yaml
 import subprocess
-import os
+import os, sys
 import copy
 import json
-import tkinter as tk
-import tkinter.filedialog as fd
 import numpy as np
-import scipy.stats as st
-import matplotlib.pyplot as plt
+# tkinter and matplotlib are slow to import (and tkinter needs a display), so they are
+# imported inside the GUI and plotting helpers that use them
+
+# The C (libyaml) loaders are used when PyYAML is built with them
+YAML_FULL_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+YAML_SAFE_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Add skd_core dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+if(skd_core_dir not in sys.path):
+    sys.path.append(skd_core_dir)
+
+import skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core_utils.skd_plot_renderer as skd_plot_renderer
+import skd_core_utils.skd_core_stats as skd_core_stats
 
 # Utiliy structures to convenienty pass data
 class TrajectoryDataRecord:
@@ -49,7 +61,7 @@ def get_skd_configurations(config_path):
 
 
 def generate_kamikaze_configs(outpath, controller_multipliers, cfg_template_path,
-                     data_files = [], attempts=2, trajs_per_file=-1):
+                     data_files = [], attempts=2, trajs_per_file=-1, adaptive_options=None):
     # Verify that files is not empty
     if(len(data_files) <= 0):
         # Ask for files 
@@ -59,7 +71,7 @@ def generate_kamikaze_configs(outpath, controller_multipliers, cfg_template_path
         safe_traj_files = copy.deepcopy(data_files)
 
     kamikaze_configs = get_kamikaze_configs(controller_multipliers, safe_traj_files, 
-        cfg_template_path, attempts, trajs_per_file)
+        cfg_template_path, attempts, trajs_per_file, adaptive_options)
 
     # Save file
     with open(outpath, 'w+') as kamikaze_config_file:
@@ -69,8 +81,11 @@ def generate_kamikaze_configs(outpath, controller_multipliers, cfg_template_path
 
 
 
-def get_kamikaze_configs(controller_multipliers, files, cfg_template_path, attempts = 2, trajs_per_file=-1):
-    """ Generates a local configuration file for input to the Kamikaze Traj Generator Module """
+def get_kamikaze_configs(controller_multipliers, files, cfg_template_path, attempts = 2, trajs_per_file=-1,
+                         adaptive_options=None):
+    """ Generates a local configuration file for input to the Kamikaze Traj Generator Module. The optional 
+    adaptive_options (adaptive_rounds, initial_attempts, round_attempts, max_attempts_per_goal, 
+    success_ci_target_width, frechet_ci_target_width) enable the multi-round scheduling of planner attempts """
   
     # Local config for kamikaze trajectory generation
     kamikaze_traj_configs = {
@@ -80,17 +95,22 @@ def get_kamikaze_configs(controller_multipliers, files, cfg_template_path, attem
             "max_trajs_per_file" : trajs_per_file,
             "kamikaze_cfg_file" : cfg_template_path
     }
+    if(adaptive_options is not None):
+        kamikaze_traj_configs.update(adaptive_options)
     return kamikaze_traj_configs
 
 
-def get_safe_trajs_config(goal_bounds, initial_state, cfg_template_path, attempts=2):
-    """ Generates a local configuration file for input to the Kamikaze Traj Generator Module """
+def get_safe_trajs_config(goal_bounds, initial_state, cfg_template_path, attempts=2, dedup_options=None):
+    """ Generates a local configuration file for input to the Kamikaze Traj Generator Module. The optional 
+    dedup_options (frechet_threshold, cell_size, num_hash_points) enable the deduplication of the safe trajectories """
     safe_traj_configs = {
             "goal_bounds" : goal_bounds,
             "safe_trajs_attempts_per_goal" : attempts,
             "initial_state" : initial_state, 
             "safe_gen_cfg_file" : cfg_template_path
     }
+    if(dedup_options is not None):
+        safe_traj_configs["dedup_options"] = dedup_options
 
     return safe_traj_configs
 
@@ -108,6 +128,8 @@ def get_kamikaze_config_suffix(controller_multiplier, safe_traj_filekey, safe_tr
 def retrieve_safe_files(message):
     """ Uses a GUI selection of experiment directories to be considered by an instance 
     of this class """
+    import tkinter as tk
+    import tkinter.filedialog as fd
     root = tk.Tk()
     files = []
     
@@ -140,35 +162,14 @@ def get_safe_traj_from_file(safe_traj_file_path, key_index):
 ################################# Utilities to process the general statistics of an array of numbers ##############
 
 def process_general_stats(data_array):
-    # Use numpy to compute the statistics
-    np_data_array = np.array(data_array)
-    np_data_sum = sum(data_array)
-    np_data_size = len(data_array)
-    np_data_mean = np.mean(data_array)
-    np_data_var = np.var(data_array, ddof = 1)
-    np_ci =  st.norm.interval(alpha=0.95, loc=np_data_mean, scale=st.sem(np_data_array))
-
-    data_summary = {"DATA_ARRAY" : copy.deepcopy(data_array),
-            "DATA_SUM" : np_data_sum,
-            "DATA_SIZE" : np_data_size,
-            "DATA_MEAN" : np_data_mean,
-            "DATA_VAR" : np_data_var,
-            "DATA_CI_LOW" : np_ci[0],
-            "DATA_CI_HIGH" : np_ci[1]}
-
-    return data_summary
+    """ Summary statistics of an array of numbers. The summary holds the mergeable state of the
+    stats (see skd_core_stats.StreamingStats.from_dict) instead of a copy of the data """
+    return skd_core_stats.get_streaming_stats(data_array).to_dict()
 
 
 def process_general_stats_array(data_array):   
-    # Use numpy to compute the statistics
-    np_data_array = np.array(data_array)
-    np_data_sum = sum(data_array)
-    np_data_size = len(data_array)
-    np_data_mean = np.mean(data_array)
-    np_data_var = np.var(data_array, ddof = 1)
-    np_ci =  st.norm.interval(alpha=0.95, loc=np_data_mean, scale=st.sem(np_data_array))
-
-    return [np_data_size, np_data_sum, np_data_mean, np_data_var, np_ci[0], np_ci[1]]
+    """ Returns [size, sum, mean, var, ci_low, ci_high] of an array of numbers """
+    return skd_core_stats.get_streaming_stats(data_array).to_array()
 
 
 
@@ -181,14 +182,23 @@ def list_to_str(list_var):
         return result
 
 
+@skd_core_profiling.profiled_stage("yaml_dumping")
 def save_dict_to_yaml(dict_value, outpath):
     with open(outpath, "w+") as yaml_outfile:
         yaml.dump(dict_value, yaml_outfile)
 
 
-def load_dict_from_yaml(load_yaml_path):
+@skd_core_profiling.profiled_stage("yaml_dumping")
+def dump_dict_to_yaml(dict_value):
+    """ Returns the yaml text of a dict, as written by save_dict_to_yaml """
+    return yaml.dump(dict_value)
+
+
+@skd_core_profiling.profiled_stage("yaml_loading")
+def load_dict_from_yaml(load_yaml_path, safe=False):
+    """ Loads a yaml file. Files of plain data (e.g the run logs) can be loaded with the faster safe loader """
     with open(load_yaml_path) as load_yaml_file:
-        dict_value = yaml.full_load(load_yaml_file)
+        dict_value = yaml.load(load_yaml_file, Loader=YAML_SAFE_LOADER if safe else YAML_FULL_LOADER)
         
         return dict_value
 
@@ -214,60 +224,15 @@ def sed_file(filepath, old_txt, new_txt):
 """ Loads a csv table represetnation of the run tracker data and plots the trajectory of 
     both the pedestrian and the car involved in the data """
 def save_plot_number(run_num, exp_states, output_path, status):
-    # Pack information from pedestrian and car's location
-    ped_loc_longit_points = []
-    ped_loc_horizontal_points = []
-    car_loc_longit_points = []
-    car_loc_horizontal_points = []
-
-    # Get data from run file
-    states = copy.deepcopy(exp_states)
-    NUM_POINTS = len(states)
-
-    # Extract data
-    for state in states:
-        ped_loc_longit_points.append(state[0])
-        ped_loc_horizontal_points.append(-state[1])
-        car_loc_longit_points.append(state[2])
-        car_loc_horizontal_points.append(-state[3])
-
-    # Plot data here
-    fig = plt.figure()
-    axes = plt.axes()
-
-    # Color settings
-    alphas = np.linspace(0.1, 1, NUM_POINTS)
-    rgba_colors_ped = np.zeros((NUM_POINTS, 4))
-    rgba_colors_car = np.zeros((NUM_POINTS, 4))
-    # for red the first column needs to be one
-    rgba_colors_ped[:, 0] = 1.0
-    # the fourth column needs to be your alphas
-    rgba_colors_ped[:, 3] = alphas
-    # Plot the trajectory of the pedestrian
-    axes.scatter(ped_loc_horizontal_points, ped_loc_longit_points, color=rgba_colors_ped)
-    # Plot the trajectory of the pedestrian
-    rgba_colors_car[:, 2] = 1.0
-    rgba_colors_car[:, 3] = alphas
-
-    axes.scatter(car_loc_horizontal_points, car_loc_longit_points, color=rgba_colors_car)
-
-
-    # Annotate time index
-    for time in range(NUM_POINTS):
-        axes.annotate(time, (ped_loc_horizontal_points[time], ped_loc_longit_points[time]))
-        axes.annotate(time, (car_loc_horizontal_points[time], car_loc_longit_points[time]))
-
-    # Set options for plot
-    axes.grid(axis="both")
-    axes.set_title("Pedestrian vs Car Trajectory Run#%d, Collided %r" % (run_num, status))
-    axes.set_xlabel("Horizontal section of road")
-    axes.set_ylabel("Longitudinal section of road")
-    axes.set_autoscalex_on(True)
-    axes.set_autoscaley_on(True)
-
-    # Save plot
-    plt.savefig(output_path +"/plot_%d.png" % (run_num), transparent=False, facecolor='white')
-    plt.close()
+    plot_job = get_run_plot_job(run_num, exp_states, output_path, status)
+    skd_plot_renderer.render_plot_job(plot_job)
+
+
+def get_run_plot_job(run_num, exp_states, output_path, status):
+    """ Plot job of save_plot_number, to render batches of runs with skd_plot_renderer """
+    return skd_plot_renderer.get_ped_car_plot_job(exp_states,
+                "Pedestrian vs Car Trajectory Run#%d, Collided %r" % (run_num, status),
+                output_path +"/plot_%d.png" % (run_num))
 
 
 
@@ -275,74 +240,14 @@ def save_plot_number(run_num, exp_states, output_path, status):
 """ Loads a csv table represetnation of the run tracker data and plots the trajectory of 
     both the pedestrian and the car involved in the data """
 def save_trajectories_plot(run_num, ped_safe_traj, ped_kamikaze_traj, veh_traj,  title, output_dir):
-    # Pack information from pedestrian and car's location
-    ped_safe_loc_longit_points = []
-    ped_safe_loc_hoz_points = []
-    ped_kamikaze_loc_longit_points = []
-    ped_kamikaze_loc_hoz_points = []
-    car_loc_longit_points = []
-    car_loc_horizontal_points = []
-
-    # Get data from run file
-    NUM_POINTS = min(len(ped_safe_traj), len(veh_traj), len(ped_kamikaze_traj))
-
-    # Extract data
-    for index_val in range(NUM_POINTS):
-        ped_safe_point = ped_safe_traj[index_val]
-        ped_kamikaze_point = ped_kamikaze_traj[index_val]
-        veh_point = veh_traj[index_val]
-
-        # Append in reverse order to look like scene
-        ped_safe_loc_longit_points.append(ped_safe_point[0])
-        ped_safe_loc_hoz_points.append(-ped_safe_point[1])
-        ped_kamikaze_loc_longit_points.append(ped_kamikaze_point[0])
-        ped_kamikaze_loc_hoz_points.append(-ped_kamikaze_point[1])
-        car_loc_longit_points.append(veh_point[0])
-        car_loc_horizontal_points.append(-veh_point[1])
-
-    # Plot data here
-    fig = plt.figure()
-    axes = plt.axes()
-
-    # Color settings
-    alphas = np.linspace(0.1, 1, NUM_POINTS)
-    rgba_colors_ped_safe = np.zeros((NUM_POINTS, 4))
-    rgba_colors_ped_kamikaze = np.zeros((NUM_POINTS, 4))
-    rgba_colors_car = np.zeros((NUM_POINTS, 4))
-    # plot blue for safe traj
-    rgba_colors_ped_safe[:, 2] = 1.0
-    # the fourth column needs to be your alphas
-    rgba_colors_ped_safe[:, 3] = alphas
-    axes.scatter(ped_safe_loc_hoz_points, ped_safe_loc_longit_points, color=rgba_colors_ped_safe)
-    # Plot the safe traj with red
-    rgba_colors_ped_kamikaze[:, 0] = 1.0
-    rgba_colors_ped_kamikaze[:, 3] = alphas
-    # Plot the trajectory of the pedestrian
-    axes.scatter(ped_kamikaze_loc_hoz_points, ped_kamikaze_loc_longit_points, color=rgba_colors_ped_kamikaze)
-    # Plot the veh traj with green 
-    rgba_colors_car[:, 1] = 1.0
-    rgba_colors_car[:, 3] = alphas
-
-    axes.scatter(car_loc_horizontal_points, car_loc_longit_points, color=rgba_colors_car)
-
-
-    # Annotate time index
-    for time in range(NUM_POINTS):
-        axes.annotate(time, (ped_safe_loc_hoz_points[time], ped_safe_loc_longit_points[time]))
-        axes.annotate(time, (ped_kamikaze_loc_hoz_points[time], ped_kamikaze_loc_longit_points[time]))
-        axes.annotate(time, (car_loc_horizontal_points[time], car_loc_longit_points[time]))
-
-    # Set options for plot
-    axes.grid(axis="both")
-    axes.set_title(title)
-    axes.set_xlabel("Horizontal section of road")
-    axes.set_ylabel("Longitudinal section of road")
-    axes.set_autoscalex_on(True)
-    axes.set_autoscaley_on(True)
-
-    # Save plot
-    plt.savefig(output_dir +"/plot_%d.png" % (run_num), transparent=False, facecolor='white')
-    plt.close()
+    plot_job = get_trajectories_plot_job(run_num, ped_safe_traj, ped_kamikaze_traj, veh_traj, title, output_dir)
+    skd_plot_renderer.render_plot_job(plot_job)
+
+
+def get_trajectories_plot_job(run_num, ped_safe_traj, ped_kamikaze_traj, veh_traj,  title, output_dir):
+    """ Plot job of save_trajectories_plot, to render batches of runs with skd_plot_renderer """
+    return skd_plot_renderer.get_trajectories_plot_job(ped_safe_traj, ped_kamikaze_traj, veh_traj, title,
+                output_dir +"/plot_%d.png" % (run_num))
 
 
 
@@ -353,4 +258,77 @@ def save_trajectories_plot(run_num, ped_safe_traj, ped_kamikaze_traj, veh_traj,
 #################### HELPER FUNCTIONS SPECIFIC TO OPPT ###############################################
 def get_oppt_log_filename(log_post_fix):
     """ Return the string of oppt log file outputted by the generator """
-    return "log_ABT_Pedestrian_" + log_post_fix + ".log"
\ No newline at end of file
+    return "log_ABT_Pedestrian_" + log_post_fix + ".log"
+
+
+def load_oppt_cfg(cfg_path):
+    """ Loads an oppt ".cfg" file into a dictionary of sections, where each section maps
+    the option keys to their (unparsed) string values. Options declared before the first
+    section header are stored under the "" section """
+    cfg_sections = {"" : {}}
+    current_section = ""
+
+    with open(cfg_path) as cfg_file:
+        for cfg_line in cfg_file:
+            line = cfg_line.strip()
+
+            # Skip comments and empty lines
+            if(len(line) <= 0 or line.startswith("#")):
+                continue
+
+            # Section headers are given as [section_name]
+            if(line.startswith("[") and line.endswith("]") and "=" not in line):
+                current_section = line[1:-1].strip()
+                cfg_sections.setdefault(current_section, {})
+                continue
+
+            # Options are given as key = value
+            if("=" in line):
+                key, value = line.split("=", 1)
+                cfg_sections[current_section][key.strip()] = value.strip()
+
+    return cfg_sections
+
+
+def get_oppt_cfg_value(cfg_sections, key, default=None):
+    """ Returns the parsed value of the first option matching key in the loaded oppt cfg sections """
+    for section in cfg_sections:
+        if(key in cfg_sections[section]):
+            return parse_oppt_cfg_value(cfg_sections[section][key])
+
+    return default
+
+
+def parse_oppt_cfg_value(value_str):
+    """ Parses an oppt cfg option value. Lists can be given either as "[a, b]" or "[ a b ]"
+    (as written by list_to_str), numbers are returned as floats and anything else as a string """
+    value_str = value_str.strip()
+
+    # Parse (possibly nested) lists of numbers
+    if(value_str.startswith("[") and value_str.endswith("]")):
+        list_items = []
+        current_item = ""
+        depth = 0
+        for char in value_str[1:-1]:
+            # Separators only split items at the top level of the list
+            if(depth == 0 and (char == "," or char.isspace())):
+                if(len(current_item) > 0):
+                    list_items.append(current_item)
+                current_item = ""
+                continue
+            if(char == "["):
+                depth += 1
+            elif(char == "]"):
+                depth -= 1
+            current_item += char
+
+        if(len(current_item) > 0):
+            list_items.append(current_item)
+
+        return [parse_oppt_cfg_value(item) for item in list_items]
+
+    # Parse numbers
+    try:
+        return float(value_str)
+    except ValueError:
+        return value_str
\ No newline at end of file
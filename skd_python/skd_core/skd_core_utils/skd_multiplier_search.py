@@ -0,0 +1,213 @@
+"""
+Search of the critical controller multiplier, the multiplier where the collision rate of the car controller
+crosses a target rate. Instead of running every multiplier of a fixed grid, the multipliers are bisected with
+noisy responses: every point gets batches of runs until the interval of its rate excludes the target (or it
+reaches max_runs_per_point), so the runs concentrate on the multipliers near the threshold and the far ones are
+decided with a single batch. The rate is looked at after every batch of every point, so the intervals are exact
+(Clopper-Pearson) intervals with the error level split over all the looks the search can make (Bonferroni),
+which keeps the confidence of the bounds of the critical multiplier. The collision rate decreases with the
+multiplier, as the cars brake from further away. The runs are given by an evaluate(multiplier, num_runs) ->
+(runs, collisions) callback, which is backed by the collision environment or by the kamikaze planner jobs.
+"""
+import os, sys
+import math
+import numpy as np
+
+# Add skd_core dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+if(skd_core_dir not in sys.path):
+    sys.path.append(skd_core_dir)
+
+import skd_core_utils.skd_core_stats as skd_core_stats
+
+
+# Default options of the search
+DEFAULT_TARGET_RATE = 0.05
+DEFAULT_MULTIPLIER_BOUNDS = [0.5, 1.5]
+DEFAULT_TOLERANCE = 0.01
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_MAX_RUNS_PER_POINT = 200
+DEFAULT_CONFIDENCE = 0.95
+
+# Outcomes of the test of a multiplier against the target rate
+ABOVE_TARGET = 1
+BELOW_TARGET = -1
+UNDECIDED = 0
+
+
+
+class CriticalMultiplierSearch:
+    """ Noisy bisection of the critical multiplier of an evaluate(multiplier, num_runs) -> (runs, collisions)
+    callback. The search keeps the bracket of multipliers above and below the target rate until it is
+    tolerance wide. The confidence bounds of the critical multiplier are the closest multipliers whose
+    intervals were entirely above or below the target; undecided points move the bracket by their rate
+    estimate but never the bounds. Both bounds hold together with the given confidence """
+    def __init__(self, evaluate, target_rate=DEFAULT_TARGET_RATE, multiplier_bounds=DEFAULT_MULTIPLIER_BOUNDS,
+                 tolerance=DEFAULT_TOLERANCE, batch_size=DEFAULT_BATCH_SIZE, max_runs_per_point=DEFAULT_MAX_RUNS_PER_POINT,
+                 confidence=DEFAULT_CONFIDENCE):
+        self.evaluate = evaluate
+        self.target_rate = float(target_rate)
+        self.multiplier_bounds = [float(multiplier_bounds[0]), float(multiplier_bounds[1])]
+        self.tolerance = float(tolerance)
+        self.batch_size = int(batch_size)
+        self.max_runs_per_point = int(max_runs_per_point)
+        self.confidence = float(confidence)
+
+        # Error level of every look: the two bounds and every bisection point are tested, each one up to
+        # num_looks times
+        self.num_looks = int(math.ceil(self.max_runs_per_point / float(self.batch_size)))
+        bracket_ratio = (self.multiplier_bounds[1] - self.multiplier_bounds[0]) / self.tolerance
+        self.max_points = 2 + (int(math.ceil(math.log(bracket_ratio, 2))) if (bracket_ratio > 1) else 0)
+        self.look_alpha = (1 - self.confidence) / (self.num_looks * self.max_points)
+
+        # {multiplier : [runs, collisions]} of the evaluated points
+        self.points = {}
+
+
+    def get_num_runs(self):
+        return int(sum(point[0] for point in self.points.values()))
+
+
+    def get_point_rate(self, multiplier):
+        runs, collisions = self.points[multiplier]
+        return (collisions / runs) if (runs > 0) else np.nan
+
+
+    def test_point(self, multiplier):
+        """ Runs batches of the multiplier until its rate is decided against the target rate. Returns
+        ABOVE_TARGET, BELOW_TARGET or UNDECIDED (when max_runs_per_point are not enough) """
+        point = self.points.setdefault(multiplier, [0, 0])
+        while(True):
+            if(point[0] > 0):
+                ci_low, ci_high = skd_core_stats.get_clopper_pearson_intervals(point[1], point[0], self.look_alpha)
+                if(ci_low > self.target_rate):
+                    return ABOVE_TARGET
+                if(ci_high < self.target_rate):
+                    return BELOW_TARGET
+            num_runs = min(self.batch_size, self.max_runs_per_point - point[0])
+            if(num_runs <= 0):
+                return UNDECIDED
+
+            runs, collisions = self.evaluate(multiplier, num_runs)
+            if(runs <= 0):
+                return UNDECIDED
+            point[0] += int(runs)
+            point[1] += int(collisions)
+
+
+    def run(self):
+        """ Bisects the multiplier bounds. Returns a summary with the critical multiplier, its confidence bounds
+        (None where there is no decided point), whether it is outside the bounds, and the evaluated points """
+        low, high = self.multiplier_bounds
+        low_outcome = self.test_point(low)
+        high_outcome = self.test_point(high)
+        ci_low = low if (low_outcome == ABOVE_TARGET) else None
+        ci_high = high if (high_outcome == BELOW_TARGET) else None
+
+        outside_bounds = None
+        if(low_outcome == BELOW_TARGET):
+            outside_bounds = "BELOW"
+            critical_multiplier = low
+        elif(high_outcome == ABOVE_TARGET):
+            outside_bounds = "ABOVE"
+            critical_multiplier = high
+        else:
+            while(high - low > self.tolerance):
+                mid = (low + high) / 2.0
+                outcome = self.test_point(mid)
+                if(outcome == UNDECIDED):
+                    outcome = ABOVE_TARGET if (self.get_point_rate(mid) > self.target_rate) else BELOW_TARGET
+                elif(outcome == ABOVE_TARGET):
+                    ci_low = mid
+                else:
+                    ci_high = mid
+
+                if(outcome == ABOVE_TARGET):
+                    low = mid
+                else:
+                    high = mid
+            critical_multiplier = (low + high) / 2.0
+
+        return {"CRITICAL_MULTIPLIER" : critical_multiplier,
+                "CRITICAL_MULTIPLIER_CI" : [ci_low, ci_high],
+                "OUTSIDE_BOUNDS" : outside_bounds,
+                "TARGET_RATE" : self.target_rate,
+                "CONFIDENCE" : self.confidence,
+                "LOOK_ALPHA" : self.look_alpha,
+                "NUM_RUNS" : self.get_num_runs(),
+                "POINTS" : self.get_points_summary()}
+
+
+    def get_points_summary(self):
+        multipliers = sorted(self.points)
+        runs = np.array([self.points[multiplier][0] for multiplier in multipliers])
+        collisions = np.array([self.points[multiplier][1] for multiplier in multipliers])
+        ci_low, ci_high = skd_core_stats.get_clopper_pearson_intervals(collisions, runs, self.look_alpha)
+        return [{"MULTIPLIER" : multipliers[point_index],
+                 "RUNS" : int(runs[point_index]),
+                 "TOTAL_COLLIDED" : int(collisions[point_index]),
+                 "CI_LOW" : float(ci_low[point_index]),
+                 "CI_HIGH" : float(ci_high[point_index])} for point_index in range(len(multipliers))]
+
+
+
+def get_weighted_allocation(num_runs, cell_shares, allocated_runs):
+    """ Runs of every cell for the next num_runs runs of a point, so that the runs allocated to the cells so far
+    follow their shares (largest remainders), and allocated_runs is updated with them """
+    targets = (allocated_runs.sum() + num_runs) * cell_shares
+    new_allocation = np.floor(targets).astype(int)
+    remainder_order = np.argsort(-(targets - new_allocation), kind="mergesort")
+    new_allocation[remainder_order[0:allocated_runs.sum() + num_runs - new_allocation.sum()]] += 1
+    cell_runs = np.maximum(new_allocation - allocated_runs, 0)
+    allocated_runs += cell_runs
+    return cell_runs
+
+
+def search_critical_multipliers(evaluate_cell, cells, cell_weights=None, **search_options):
+    """ Searches the critical multiplier of every cell (e.g the ST_n safe trajectories) with an
+    evaluate_cell(cell, multiplier, num_runs) -> (runs, collisions) callback, and the aggregate critical
+    multiplier of the collision rate of all the cells pooled, where every batch and the runs cap of a point
+    are spread over the cells in proportion to their weights (e.g the cluster sizes of deduplicated safe
+    trajectories, by default every cell weighs the same), so the pooled rate is the weighted one. The largest
+    critical multiplier of the cells is the one that keeps every cell under the target rate. Its bounds need the
+    bounds of all the cells to hold together, so the error level of the cell searches is split over the cells """
+    cell_weights = np.ones(len(cells)) if (cell_weights is None) else np.asarray(cell_weights, dtype=float)
+    cell_options = dict(search_options)
+    cell_options["confidence"] = 1 - (1 - search_options.get("confidence", DEFAULT_CONFIDENCE)) / max(1, len(cells))
+    cell_summaries = []
+    for cell, cell_weight in zip(cells, cell_weights):
+        cell_summary = CriticalMultiplierSearch(lambda multiplier, num_runs: evaluate_cell(cell, multiplier, num_runs),
+                                                **cell_options).run()
+        cell_summary["WEIGHT"] = float(cell_weight)
+        cell_summaries.append(cell_summary)
+
+    if(len(cells) == 0):
+        return {"TARGET_RATE" : float(search_options.get("target_rate", DEFAULT_TARGET_RATE)),
+                "TOTAL_RUNS" : 0, "POOLED" : None, "MAX_OF_CELLS" : None, "CELLS" : []}
+
+    cell_shares = cell_weights / cell_weights.sum()
+    pooled_allocations = {}
+    def evaluate_pooled(multiplier, num_runs):
+        allocated_runs = pooled_allocations.setdefault(multiplier, np.zeros(len(cells), dtype=int))
+        cell_runs = get_weighted_allocation(num_runs, cell_shares, allocated_runs)
+        cell_results = [evaluate_cell(cells[cell_index], multiplier, int(cell_runs[cell_index]))
+                        for cell_index in np.flatnonzero(cell_runs)]
+        return sum(result[0] for result in cell_results), sum(result[1] for result in cell_results)
+    pooled_options = dict(search_options)
+    pooled_options["batch_size"] = len(cells) * search_options.get("batch_size", DEFAULT_BATCH_SIZE)
+    pooled_options["max_runs_per_point"] = len(cells) * search_options.get("max_runs_per_point", DEFAULT_MAX_RUNS_PER_POINT)
+    pooled_summary = CriticalMultiplierSearch(evaluate_pooled, **pooled_options).run()
+
+    # Bounds of the max from the bounds of the cells (no upper bound when a cell has none)
+    cell_ci_low = [cell_summary["CRITICAL_MULTIPLIER_CI"][0] for cell_summary in cell_summaries]
+    cell_ci_high = [cell_summary["CRITICAL_MULTIPLIER_CI"][1] for cell_summary in cell_summaries]
+    max_summary = {"CRITICAL_MULTIPLIER" : max(cell_summary["CRITICAL_MULTIPLIER"] for cell_summary in cell_summaries),
+                   "CRITICAL_MULTIPLIER_CI" : [max([ci for ci in cell_ci_low if ci is not None], default=None),
+                                               None if (None in cell_ci_high) else max(cell_ci_high)]}
+
+    return {"TARGET_RATE" : pooled_summary["TARGET_RATE"],
+            "TOTAL_RUNS" : int(sum(cell_summary["NUM_RUNS"] for cell_summary in cell_summaries) + pooled_summary["NUM_RUNS"]),
+            "POOLED" : pooled_summary,
+            "MAX_OF_CELLS" : max_summary,
+            "CELLS" : cell_summaries}
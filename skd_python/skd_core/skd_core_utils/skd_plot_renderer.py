@@ -0,0 +1,297 @@
+"""
+Headless plot rendering for the SKD analysers. Plots are described as plain dictionaries
+(plot jobs) so they can be sent to worker processes, and are drawn with the Agg canvas on a
+single reusable figure per process instead of going through the pyplot state machine.
+The time index labels of every trajectory are drawn as a single path collection rather than
+one annotation per time step.
+"""
+import os, sys
+import random
+import numpy as np
+
+# Add skd_core dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+if(skd_core_dir not in sys.path):
+    sys.path.append(skd_core_dir)
+
+import skd_core_utils.skd_core_profiling as skd_core_profiling
+
+
+# Environment variables for the default number of plotting processes and plot cap
+PLOT_WORKERS_ENV_VAR = "SKD_PLOT_WORKERS"
+MAX_PLOTS_ENV_VAR = "SKD_MAX_PLOTS"
+
+# Sampling policies used to choose which runs are plotted when there is a cap on the plots
+PLOT_SAMPLING_POLICIES = ["first", "uniform", "random"]
+
+# Base colours of the plotted series (alpha goes from 0.1 to 1 over time)
+RED = (1.0, 0.0, 0.0)
+GREEN = (0.0, 1.0, 0.0)
+BLUE = (0.0, 0.0, 1.0)
+
+# Default size of the figures produced by pyplot
+FIGURE_SIZE = (6.4, 4.8)
+FIGURE_DPI = 100
+LABEL_FONT_SIZE = 10
+
+# Renderer of the current process (created on first use, one per worker process)
+_process_renderer = None
+
+
+def get_default_plot_workers():
+    return int(os.getenv(PLOT_WORKERS_ENV_VAR, "1"))
+
+
+def get_default_max_plots():
+    return int(os.getenv(MAX_PLOTS_ENV_VAR, "-1"))
+
+
+
+################################################## PLOT JOBS ##################################################
+def get_plot_job(title, outpath, series, labels=None, xlim=None, ylim=None):
+    """ Returns a plot job. Series is a list of (points, rgb, time_labels) where points are the
+    (horizontal, longitudinal) plot coordinates. Labels are extra (text, x, y) annotations """
+    return {"TITLE" : title,
+            "OUTPATH" : outpath,
+            "SERIES" : series,
+            "LABELS" : labels if (labels is not None) else [],
+            "XLIM" : xlim,
+            "YLIM" : ylim}
+
+
+def get_scene_points(traj, longit_index=0, hoz_index=1):
+    """ Converts (longit, hoz) trajectory points to plot coordinates. The horizontal
+    axis is mirrored to look like the scene """
+    np_traj = np.array(traj, dtype=float).reshape(-1, max(longit_index, hoz_index) + 1)
+    return np.stack([-np_traj[:, hoz_index], np_traj[:, longit_index]], axis=1)
+
+
+def get_ped_car_plot_job(states, title, outpath, start_end_labels=False):
+    """ Plot job for states of the form [ped_longit, ped_hoz, car_longit, car_hoz, ...] """
+    np_states = np.array(states, dtype=float).reshape(len(states), -1)
+    ped_points = get_scene_points(np_states[:, 0:2])
+    car_points = get_scene_points(np_states[:, 2:4])
+
+    labels = []
+    if(start_end_labels and len(np_states) > 0):
+        for points in [ped_points, car_points]:
+            labels.append(("START", points[0][0], points[0][1]))
+            labels.append(("END", points[-1][0], points[-1][1]))
+
+    return get_plot_job(title, outpath, [(ped_points, RED, True), (car_points, BLUE, True)], labels)
+
+
+def get_trajectories_plot_job(ped_safe_traj, ped_kamikaze_traj, veh_traj, title, outpath):
+    """ Plot job comparing the safe and kamikaze pedestrian trajectories with the vehicle trajectory """
+    num_points = min(len(ped_safe_traj), len(veh_traj), len(ped_kamikaze_traj))
+    series = [(get_scene_points(ped_safe_traj[:num_points]), BLUE, True),
+              (get_scene_points(ped_kamikaze_traj[:num_points]), RED, True),
+              (get_scene_points(veh_traj[:num_points]), GREEN, True)]
+    return get_plot_job(title, outpath, series)
+
+
+
+############################################### PLOT SAMPLING ##################################################
+def select_plot_indices(num_items, max_plots=-1, policy="first", seed=None):
+    """ Returns the sorted indices of the items to plot. A negative max_plots plots every item,
+    otherwise the "first" items, items spread "uniform"ly or a "random" sample are chosen """
+    assert (policy in PLOT_SAMPLING_POLICIES), "Unknown plot sampling policy %s" % (policy)
+    if(max_plots < 0 or max_plots >= num_items):
+        return list(range(num_items))
+
+    if(policy == "first"):
+        return list(range(max_plots))
+    elif(policy == "uniform"):
+        return sorted(set(np.linspace(0, num_items - 1, max_plots).round().astype(int).tolist()))
+    else:
+        return sorted(random.Random(seed).sample(range(num_items), max_plots))
+
+
+
+############################################### RENDERER #######################################################
+class TrajectoryPlotRenderer:
+    """ Draws plot jobs with the Agg canvas. The figure, axes, scatter and label collections are
+    created once and their data is replaced for every plot """
+    def __init__(self, figsize=FIGURE_SIZE, dpi=FIGURE_DPI):
+        # Imported here so that matplotlib is only loaded by processes that plot
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(1, 1, 1)
+        self.axes.grid(axis="both")
+        self.axes.set_xlabel("Horizontal section of road")
+        self.axes.set_ylabel("Longitudinal section of road")
+
+        # Artists reused between plots (created when first needed)
+        self.scatter_collections = []
+        self.label_collection = None
+        self.line_collection = None
+        self.glyph_cache = {}
+
+
+    def get_glyph(self, text):
+        """ Returns the path of the label text (in points, anchored at its bottom left corner) """
+        if(text not in self.glyph_cache):
+            from matplotlib.textpath import TextPath
+            from matplotlib.font_manager import FontProperties
+            self.glyph_cache[text] = TextPath((0, 0), str(text), size=LABEL_FONT_SIZE, prop=FontProperties())
+        return self.glyph_cache[text]
+
+
+    def get_scatter_collection(self, series_index):
+        while(len(self.scatter_collections) <= series_index):
+            self.scatter_collections.append(self.axes.scatter([], []))
+        return self.scatter_collections[series_index]
+
+
+    def get_label_collection(self):
+        if(self.label_collection is None):
+            from matplotlib.collections import PathCollection
+            from matplotlib.transforms import Affine2D
+            # Glyphs are in points and placed at data offsets, like an annotation
+            glyph_transform = Affine2D().scale(self.figure.dpi / 72.0)
+            try:
+                self.label_collection = PathCollection([], offsets=np.zeros((0, 2)), offset_transform=self.axes.transData,
+                                                       transform=glyph_transform, facecolors="black", edgecolors="none")
+            except (TypeError, AttributeError):
+                # Older matplotlib releases name the offset transform transOffset
+                self.label_collection = PathCollection([], offsets=np.zeros((0, 2)), transOffset=self.axes.transData,
+                                                       transform=glyph_transform, facecolors="black", edgecolors="none")
+            self.axes.add_collection(self.label_collection, autolim=False)
+        return self.label_collection
+
+
+    def get_line_collection(self):
+        if(self.line_collection is None):
+            from matplotlib.collections import LineCollection
+            self.line_collection = LineCollection([], linewidths=1.0)
+            self.axes.add_collection(self.line_collection, autolim=False)
+        return self.line_collection
+
+
+    def clear_artists(self):
+        for scatter_collection in self.scatter_collections:
+            scatter_collection.set_visible(False)
+        if(self.label_collection is not None):
+            self.label_collection.set_visible(False)
+        if(self.line_collection is not None):
+            self.line_collection.set_visible(False)
+
+
+    def set_axes_limits(self, all_points, xlim=None, ylim=None):
+        """ Sets the limits to the plot job limits, or to the data limits with the pyplot margins """
+        MARGIN = 0.05
+        np_points = np.concatenate(all_points) if (len(all_points) > 0) else np.zeros((0, 2))
+        np_points = np_points[np.all(np.isfinite(np_points), axis=1)]
+        limits = [xlim, ylim]
+        for axis in range(2):
+            if(limits[axis] is None and len(np_points) > 0):
+                axis_min = np_points[:, axis].min()
+                axis_max = np_points[:, axis].max()
+                axis_pad = (axis_max - axis_min) * MARGIN if (axis_max > axis_min) else 0.5
+                limits[axis] = (axis_min - axis_pad, axis_max + axis_pad)
+        if(limits[0] is not None):
+            self.axes.set_xlim(limits[0])
+        if(limits[1] is not None):
+            self.axes.set_ylim(limits[1])
+
+
+    def render(self, plot_job):
+        """ Draws the plot job and saves it to its outpath """
+        self.clear_artists()
+        label_glyphs = []
+        label_offsets = []
+        all_points = []
+
+        for series_index in range(len(plot_job["SERIES"])):
+            points, rgb, time_labels = plot_job["SERIES"][series_index]
+            points = np.asarray(points, dtype=float).reshape(-1, 2)
+            num_points = len(points)
+            all_points.append(points)
+
+            # Colours fade in with time
+            rgba_colors = np.zeros((num_points, 4))
+            rgba_colors[:, 0:3] = rgb
+            rgba_colors[:, 3] = np.linspace(0.1, 1, num_points)
+            scatter_collection = self.get_scatter_collection(series_index)
+            scatter_collection.set_offsets(points)
+            scatter_collection.set_color(rgba_colors)
+            scatter_collection.set_visible(True)
+
+            if(time_labels):
+                label_glyphs.extend([self.get_glyph(time) for time in range(num_points)])
+                label_offsets.extend(points.tolist())
+
+        for text, x, y in plot_job["LABELS"]:
+            label_glyphs.append(self.get_glyph(text))
+            label_offsets.append([x, y])
+
+        # All the labels of the plot are drawn as one collection
+        if(len(label_glyphs) > 0):
+            label_collection = self.get_label_collection()
+            label_collection.set_paths(label_glyphs)
+            label_collection.set_offsets(np.array(label_offsets, dtype=float))
+            label_collection.set_visible(True)
+
+        self.axes.set_title(plot_job["TITLE"])
+        self.set_axes_limits(all_points, plot_job["XLIM"], plot_job["YLIM"])
+        self.figure.savefig(plot_job["OUTPATH"], transparent=False, facecolor='white')
+
+
+    def render_overview(self, trajectories, colors, title, outpath, xlim=None, ylim=None):
+        """ Draws every trajectory (list of plot coordinate points) as a line in a single image """
+        self.clear_artists()
+        segments = [np.asarray(points, dtype=float).reshape(-1, 2) for points in trajectories]
+        line_collection = self.get_line_collection()
+        line_collection.set_segments(segments)
+        line_collection.set_color(colors)
+        line_collection.set_visible(True)
+
+        self.axes.set_title(title)
+        self.set_axes_limits(segments, xlim, ylim)
+        self.figure.savefig(outpath, transparent=False, facecolor='white')
+
+
+
+def get_process_renderer():
+    """ Returns the renderer of this process, creating it on first use """
+    global _process_renderer
+    if(_process_renderer is None):
+        _process_renderer = TrajectoryPlotRenderer()
+    return _process_renderer
+
+
+def _render_plot_job(plot_job):
+    get_process_renderer().render(plot_job)
+    return plot_job["OUTPATH"]
+
+
+@skd_core_profiling.profiled_stage("plotting")
+def render_plot_job(plot_job):
+    """ Renders a single plot job in this process """
+    return _render_plot_job(plot_job)
+
+
+@skd_core_profiling.profiled_stage("plotting")
+def render_plot_jobs(plot_jobs, num_workers=None):
+    """ Renders a batch of plot jobs, using a pool of num_workers processes when more than one
+    is requested. Returns the paths of the rendered plots """
+    num_workers = get_default_plot_workers() if (num_workers is None) else num_workers
+    if(num_workers <= 1 or len(plot_jobs) <= 1):
+        return [_render_plot_job(plot_job) for plot_job in plot_jobs]
+
+    import multiprocessing
+    # Send the jobs in chunks so each worker reuses its figure across many plots
+    chunksize = max(1, len(plot_jobs) // (4 * num_workers))
+    with multiprocessing.Pool(min(num_workers, len(plot_jobs))) as pool:
+        return pool.map(_render_plot_job, plot_jobs, chunksize)
+
+
+@skd_core_profiling.profiled_stage("plotting")
+def render_overview_plot(trajectories, colors, title, outpath):
+    """ Renders many trajectories (lists of plot coordinate points) in a single overview image """
+    get_process_renderer().render_overview(trajectories, colors, title, outpath)
+    return outpath
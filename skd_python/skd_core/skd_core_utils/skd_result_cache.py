@@ -0,0 +1,135 @@
+"""
+Content-addressed on-disk cache of simulation results. Entries are the numpy arrays of a result, saved as a
+compressed .npz file named after the SHA-256 hash of everything the result depends on (e.g the trajectory
+points, the controller parameters, the number of steps and the RNG seeds), so repeated or overlapping sweeps
+only simulate the entries they have not seen before. The size of the cache is bounded: the least recently
+used entries (by file mtime, which is refreshed on every hit) are evicted once it grows past max_bytes, or
+when the cache is opened with a smaller bound. Entries are written to a temporary file and renamed, so
+concurrent writers never leave partial entries.
+"""
+import os
+import hashlib
+import numpy as np
+
+
+# Default bound of the size of a cache directory
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+RESULT_CACHE_SUFFIX = ".npz"
+
+
+def get_cache_key(*key_parts):
+    """ SHA-256 hex digest of the key parts. Arrays are hashed with their dtype and shape, and any other
+    part by its repr (which must be stable across runs, e.g numbers, strings and lists of them) """
+    key_hash = hashlib.sha256()
+    for key_part in key_parts:
+        if(isinstance(key_part, np.ndarray)):
+            key_array = np.ascontiguousarray(key_part)
+            key_hash.update(("%s%s" % (key_array.dtype.str, key_array.shape)).encode())
+            key_hash.update(key_array.tobytes())
+        else:
+            key_hash.update(repr(key_part).encode())
+        # Separator, so that the boundaries of the parts are part of the key
+        key_hash.update(b"\0")
+    return key_hash.hexdigest()
+
+
+
+class ResultCache:
+    """ LRU cache of {name : array} results in cache_dir, bounded to max_bytes """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Size of the entries, counted once and kept up to date by the puts and evictions of this process
+        self.total_bytes = sum(entry_size for entry_path, entry_size, entry_mtime in self.get_entries())
+        if(self.total_bytes > self.max_bytes):
+            self.evict()
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+
+    def get_entry_path(self, key):
+        return os.path.join(self.cache_dir, key + RESULT_CACHE_SUFFIX)
+
+
+    def get_entries(self):
+        """ Returns the (path, size, mtime_ns) of the entries of the cache """
+        entries = []
+        for dir_entry in os.scandir(self.cache_dir):
+            if(dir_entry.name.endswith(RESULT_CACHE_SUFFIX)):
+                try:
+                    entry_stat = dir_entry.stat()
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                entries.append((dir_entry.path, entry_stat.st_size, entry_stat.st_mtime_ns))
+        return entries
+
+
+    def get(self, key):
+        """ Returns the {name : array} result of the key, or None when it is not cached """
+        entry_path = self.get_entry_path(key)
+        try:
+            with np.load(entry_path) as entry:
+                result = {name : entry[name] for name in entry.files}
+            # Mark as recently used
+            os.utime(entry_path)
+        except (FileNotFoundError, ValueError, OSError):
+            # Missing, evicted or unreadable entries are simulated again
+            self.num_misses += 1
+            return None
+
+        self.num_hits += 1
+        return result
+
+
+    def put(self, key, result):
+        """ Saves the {name : array} result of the key, and evicts the least recently used entries when the
+        cache is over its size bound """
+        entry_path = self.get_entry_path(key)
+        temp_path = "%s.%d.tmp" % (entry_path, os.getpid())
+        with open(temp_path, "wb") as temp_file:
+            np.savez_compressed(temp_file, **result)
+        entry_size = os.path.getsize(temp_path)
+        previous_size = os.path.getsize(entry_path) if os.path.isfile(entry_path) else 0
+        os.replace(temp_path, entry_path)
+
+        self.total_bytes += entry_size - previous_size
+        if(self.total_bytes > self.max_bytes):
+            self.evict()
+
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is within max_bytes """
+        entries = sorted(self.get_entries(), key=lambda entry: entry[2])
+        self.total_bytes = sum(entry[1] for entry in entries)
+        for entry_path, entry_size, entry_mtime in entries:
+            if(self.total_bytes <= self.max_bytes):
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= entry_size
+
+
+    def get_stats(self):
+        return {"CACHE_DIR" : self.cache_dir,
+                "HITS" : self.num_hits,
+                "MISSES" : self.num_misses,
+                "TOTAL_BYTES" : self.total_bytes,
+                "MAX_BYTES" : self.max_bytes}
+
+
+
+def pack_strings(strings):
+    """ Packs a list of strings into a uint8 array of their utf-8 texts, each one ended by a null byte """
+    return np.frombuffer("".join([string + "\0" for string in strings]).encode(), dtype=np.uint8)
+
+
+def unpack_strings(packed_strings):
+    """ Returns the list of strings of a pack_strings array """
+    return packed_strings.tobytes().decode().split("\0")[:-1]
@@ -0,0 +1,311 @@
+"""
+Indexed store of the results of the SKD pipeline. The generators, the collision experiments loader and
+the analysers record their jobs, the safe trajectories they used, their runs (collision experiments and
+successful kamikaze trajectories) and per run metrics (e.g the frechet distance) into a SQLite database,
+so that ad-hoc questions are answered with a query instead of parsing the output directories again.
+The query methods return numpy arrays. The store is enabled with the results_db option of the configs
+(or the SKD_RESULTS_DB environment variable).
+"""
+import os, sys
+import json
+import time
+import sqlite3
+import numpy as np
+
+# Add skd_core dir to package
+source_path = os.path.abspath(__file__)
+skd_core_dir = os.path.dirname(os.path.dirname(source_path))
+if(skd_core_dir not in sys.path):
+    sys.path.append(skd_core_dir)
+
+import skd_core_utils.skd_core_stats as skd_core_stats
+
+
+# Environment variable with the path of the results database used when the configs do not set one
+RESULTS_DB_ENV_VAR = "SKD_RESULTS_DB"
+
+# Types of the recorded jobs
+JOB_SAFE_TRAJ_GEN = "safe_traj_gen"
+JOB_KAMIKAZE_TRAJ_GEN = "kamikaze_traj_gen"
+JOB_COLLISION_EXPERIMENTS = "collision_experiments"
+JOB_COLLISION_ANALYSIS = "collision_analysis"
+JOB_KAMIKAZE_ANALYSIS = "kamikaze_analysis"
+
+# Types of the recorded runs
+RUN_COLLISION = "collision"
+RUN_KAMIKAZE = "kamikaze"
+
+# Names of the recorded run metrics
+METRIC_FRECHET = "frechet"
+METRIC_FRECHET_TIME_MS = "frechet_time_ms"
+
+# Controller ids (multipliers) closer than this are the same controller
+CONTROLLER_ID_TOLERANCE = 1e-9
+
+RESULTS_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    job_type TEXT NOT NULL,
+    config_path TEXT,
+    output_dir TEXT,
+    created_time REAL);
+
+CREATE TABLE IF NOT EXISTS trajectories (
+    traj_id INTEGER PRIMARY KEY,
+    job_id INTEGER,
+    safe_traj_file TEXT NOT NULL,
+    safe_traj_index INTEGER NOT NULL,
+    goal TEXT,
+    num_points INTEGER,
+    start_longit REAL,
+    start_hoz REAL,
+    end_longit REAL,
+    end_hoz REAL,
+    weight REAL DEFAULT 1,
+    UNIQUE(safe_traj_file, safe_traj_index));
+CREATE INDEX IF NOT EXISTS trajectories_goal ON trajectories(goal);
+
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL,
+    run_type TEXT NOT NULL,
+    controller_id REAL NOT NULL,
+    traj_id INTEGER NOT NULL,
+    run_number INTEGER NOT NULL,
+    collided INTEGER,
+    log_path TEXT);
+CREATE INDEX IF NOT EXISTS runs_controller_traj ON runs(run_type, controller_id, traj_id);
+CREATE INDEX IF NOT EXISTS runs_traj ON runs(traj_id);
+
+CREATE TABLE IF NOT EXISTS run_metrics (
+    run_id INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY(run_id, metric));
+CREATE INDEX IF NOT EXISTS run_metrics_metric ON run_metrics(metric, value);
+"""
+
+
+def get_results_db_path(db_path=None):
+    """ Returns db_path, or the path in the SKD_RESULTS_DB environment variable (None when neither is set) """
+    return db_path if (db_path is not None) else os.getenv(RESULTS_DB_ENV_VAR)
+
+
+def open_results_db(db_path=None):
+    """ Opens the results database at db_path (or SKD_RESULTS_DB). Returns None when no database is configured """
+    db_path = get_results_db_path(db_path)
+    return ResultsDB(db_path) if (db_path is not None) else None
+
+
+def get_safe_traj_weights(safe_traj_file, num_trajs):
+    """ Weights of the trajectories of a safe traj file, read from the weights file that the deduplication writes
+    next to it (see trajectories_filters.get_weights_filepath). One per trajectory when there is none """
+    weights_path = os.path.splitext(safe_traj_file)[0] + "_weights.json"
+    if(not os.path.isfile(weights_path)):
+        return [1.0] * num_trajs
+    with open(weights_path) as weights_file:
+        weights_data = json.load(weights_file)
+    return [float(weights_data[str(safe_traj_index)]) for safe_traj_index in range(num_trajs)]
+
+
+def get_safe_traj_goal(safe_traj_file):
+    """ Goal of the trajectories of a safe traj file, the name of the goal directory it was generated in """
+    return os.path.basename(os.path.dirname(os.path.abspath(safe_traj_file)))
+
+
+
+class ResultsDB:
+    """ SQLite store of the jobs, trajectories, runs and run metrics of the pipeline """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if(not os.path.isdir(db_dir)):
+            os.makedirs(db_dir)
+
+        # Writers of other processes wait for the lock instead of failing
+        self.connection = sqlite3.connect(db_path, timeout=60.0)
+        self.connection.executescript(RESULTS_DB_SCHEMA)
+
+        # Safe traj files recorded by this connection
+        self.recorded_files = set()
+
+        # Databases created before the trajectories had weights get the column, every trajectory weighing one
+        traj_columns = [column[1] for column in self.connection.execute("PRAGMA table_info(trajectories)").fetchall()]
+        if("weight" not in traj_columns):
+            with self.connection:
+                self.connection.execute("ALTER TABLE trajectories ADD COLUMN weight REAL DEFAULT 1")
+
+
+    def close(self):
+        self.connection.close()
+
+
+
+    ######################################## WRITERS ############################################
+    def add_job(self, job_type, config_path=None, output_dir=None):
+        """ Records a job and returns its id """
+        with self.connection:
+            job_cursor = self.connection.execute(
+                "INSERT INTO jobs (job_type, config_path, output_dir, created_time) VALUES (?, ?, ?, ?)",
+                (job_type, config_path, output_dir, time.time()))
+        return job_cursor.lastrowid
+
+
+    def add_safe_traj_file(self, safe_traj_file, job_id=None):
+        """ Records the trajectories of a safe traj file (the file is referenced, not copied), with their weights
+        when the file was deduplicated. Trajectories that are already recorded keep their id, and get the current
+        weights. Returns the ids of the trajectories in key order """
+        safe_traj_file = os.path.abspath(safe_traj_file)
+        with open(safe_traj_file) as safe_traj_json:
+            safe_traj_data = json.load(safe_traj_json)
+        safe_traj_weights = get_safe_traj_weights(safe_traj_file, len(safe_traj_data))
+
+        traj_rows = []
+        for safe_traj_index in range(len(safe_traj_data)):
+            safe_traj = safe_traj_data[str(safe_traj_index)]
+            traj_rows.append((job_id, safe_traj_file, safe_traj_index, get_safe_traj_goal(safe_traj_file), len(safe_traj),
+                              safe_traj[0][0], safe_traj[0][1], safe_traj[-1][0], safe_traj[-1][1],
+                              safe_traj_weights[safe_traj_index]))
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO trajectories (job_id, safe_traj_file, safe_traj_index, goal,"
+                                        " num_points, start_longit, start_hoz, end_longit, end_hoz, weight)"
+                                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", traj_rows)
+            self.connection.executemany("UPDATE trajectories SET weight = ? WHERE safe_traj_file = ? AND safe_traj_index = ?",
+                                        [(traj_row[9], safe_traj_file, traj_row[2]) for traj_row in traj_rows])
+
+        traj_ids = dict(self.connection.execute("SELECT safe_traj_index, traj_id FROM trajectories WHERE safe_traj_file = ?",
+                                                (safe_traj_file,)).fetchall())
+        return [traj_ids[safe_traj_index] for safe_traj_index in range(len(safe_traj_data))]
+
+
+    def get_traj_id(self, safe_traj_file, safe_traj_index):
+        """ Returns the id of a safe trajectory, recording its file when it is not recorded yet. Files are recorded
+        again the first time they are used by this connection, so their weights are the current ones """
+        if(os.path.abspath(safe_traj_file) not in self.recorded_files):
+            self.recorded_files.add(os.path.abspath(safe_traj_file))
+            return self.add_safe_traj_file(safe_traj_file)[int(safe_traj_index)]
+        traj_row = self.connection.execute("SELECT traj_id FROM trajectories WHERE safe_traj_file = ? AND safe_traj_index = ?",
+                                           (os.path.abspath(safe_traj_file), int(safe_traj_index))).fetchone()
+        if(traj_row is not None):
+            return traj_row[0]
+        return self.add_safe_traj_file(safe_traj_file)[int(safe_traj_index)]
+
+
+    def replace_runs(self, job_id, run_type, controller_id, safe_traj_file, safe_traj_index, collided=None,
+                     metrics=None, log_path=None):
+        """ Records the runs of a controller on a safe trajectory, numbered by their position, replacing the runs
+        recorded before for them. collided is a sequence of flags (None when unknown) and metrics maps metric names
+        to sequences of values (one per run). Returns the ids of the runs """
+        metrics = {} if (metrics is None) else metrics
+        num_runs = len(collided) if (collided is not None) else max([len(values) for values in metrics.values()] + [0])
+        controller_id = float(controller_id)
+        traj_id = self.get_traj_id(safe_traj_file, safe_traj_index)
+
+        with self.connection:
+            replaced_runs = "SELECT run_id FROM runs WHERE run_type = ? AND abs(controller_id - ?) < ? AND traj_id = ?"
+            replaced_params = (run_type, controller_id, CONTROLLER_ID_TOLERANCE, traj_id)
+            self.connection.execute("DELETE FROM run_metrics WHERE run_id IN (%s)" % (replaced_runs), replaced_params)
+            self.connection.execute("DELETE FROM runs WHERE run_id IN (%s)" % (replaced_runs), replaced_params)
+
+            run_ids = []
+            for run_number in range(num_runs):
+                run_collided = None if (collided is None) else int(bool(collided[run_number]))
+                run_cursor = self.connection.execute("INSERT INTO runs (job_id, run_type, controller_id, traj_id, run_number,"
+                                                     " collided, log_path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                                     (job_id, run_type, controller_id, traj_id, run_number, run_collided, log_path))
+                run_ids.append(run_cursor.lastrowid)
+
+            for metric in metrics:
+                self.connection.executemany("INSERT INTO run_metrics (run_id, metric, value) VALUES (?, ?, ?)",
+                                            [(run_id, metric, float(value)) for run_id, value in zip(run_ids, metrics[metric])])
+
+        return run_ids
+
+
+
+    ######################################## QUERIES ############################################
+    def query_array(self, sql, params=()):
+        """ Returns the rows of a query as a 2D float array (NULLs are nan) """
+        query_cursor = self.connection.execute(sql, params)
+        rows = query_cursor.fetchall()
+        return np.array(rows, dtype=float).reshape(len(rows), len(query_cursor.description))
+
+
+    def get_run_filters(self, run_type, controller_id=None, goal=None, safe_traj_file=None):
+        """ Returns the WHERE clause (on runs r and trajectories t) and parameters selecting runs """
+        conditions = ["r.run_type = ?"]
+        params = [run_type]
+        if(controller_id is not None):
+            conditions.append("abs(r.controller_id - ?) < ?")
+            params.extend([float(controller_id), CONTROLLER_ID_TOLERANCE])
+        if(goal is not None):
+            conditions.append("t.goal = ?")
+            params.append(goal)
+        if(safe_traj_file is not None):
+            conditions.append("t.safe_traj_file = ?")
+            params.append(os.path.abspath(safe_traj_file))
+        return " AND ".join(conditions), params
+
+
+    def query_runs(self, run_type=RUN_COLLISION, controller_id=None, goal=None, safe_traj_file=None, metrics=()):
+        """ Returns the runs matching the filters as a dict of arrays (RUN_ID, CONTROLLER_ID, TRAJ_ID, SAFE_TRAJ_INDEX,
+        RUN_NUMBER, COLLIDED and one array per requested metric, nan where a run has no value) """
+        where_clause, params = self.get_run_filters(run_type, controller_id, goal, safe_traj_file)
+        metric_columns = "".join([", (SELECT value FROM run_metrics m WHERE m.run_id = r.run_id AND m.metric = ?)"
+                                  for metric in metrics])
+        run_rows = self.query_array("SELECT r.run_id, r.controller_id, r.traj_id, t.safe_traj_index, r.run_number, r.collided%s"
+                                    " FROM runs r JOIN trajectories t ON t.traj_id = r.traj_id WHERE %s"
+                                    " ORDER BY r.controller_id, r.traj_id, r.run_number" % (metric_columns, where_clause),
+                                    list(metrics) + params)
+
+        runs = {"RUN_ID" : run_rows[:, 0].astype(int),
+                "CONTROLLER_ID" : run_rows[:, 1],
+                "TRAJ_ID" : run_rows[:, 2].astype(int),
+                "SAFE_TRAJ_INDEX" : run_rows[:, 3].astype(int),
+                "RUN_NUMBER" : run_rows[:, 4].astype(int),
+                "COLLIDED" : run_rows[:, 5]}
+        for metric_index, metric in enumerate(metrics):
+            runs[metric] = run_rows[:, 6 + metric_index]
+        return runs
+
+
+    def get_collision_rates(self, controller_id=None, goal=None, safe_traj_file=None, max_frechet=None):
+        """ Returns the collision counts of the collision runs per (controller, trajectory) as a dict of arrays
+        (CONTROLLER_ID, TRAJ_ID, SAFE_TRAJ_INDEX, TOTAL_COLLIDED, TOTAL_ATTEMPTS, COLLISION_RATE, MEAN_FRECHET, WEIGHT).
+        WEIGHT is the weight of the trajectory (its cluster size when its file was deduplicated). MEAN_FRECHET is the mean frechet distance of the kamikaze runs of the same controller and trajectory (nan
+        without kamikaze runs). With max_frechet, only the trajectories with a mean frechet below it are kept """
+        where_clause, params = self.get_run_filters(RUN_COLLISION, controller_id, goal, safe_traj_file)
+        rate_rows = self.query_array(
+            "SELECT r.controller_id, r.traj_id, t.safe_traj_index, sum(r.collided), count(*),"
+            " (SELECT avg(m.value) FROM runs k JOIN run_metrics m ON m.run_id = k.run_id"
+            "  WHERE k.run_type = ? AND abs(k.controller_id - r.controller_id) < ? AND k.traj_id = r.traj_id AND m.metric = ?),"
+            " t.weight FROM runs r JOIN trajectories t ON t.traj_id = r.traj_id WHERE %s"
+            " GROUP BY r.controller_id, r.traj_id ORDER BY r.controller_id, r.traj_id" % (where_clause),
+            [RUN_KAMIKAZE, CONTROLLER_ID_TOLERANCE, METRIC_FRECHET] + params)
+
+        if(max_frechet is not None):
+            with np.errstate(invalid="ignore"):
+                rate_rows = rate_rows[rate_rows[:, 5] < max_frechet]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            collision_rates = rate_rows[:, 3] / rate_rows[:, 4]
+        return {"CONTROLLER_ID" : rate_rows[:, 0],
+                "TRAJ_ID" : rate_rows[:, 1].astype(int),
+                "SAFE_TRAJ_INDEX" : rate_rows[:, 2].astype(int),
+                "TOTAL_COLLIDED" : rate_rows[:, 3].astype(int),
+                "TOTAL_ATTEMPTS" : rate_rows[:, 4].astype(int),
+                "COLLISION_RATE" : collision_rates,
+                "MEAN_FRECHET" : rate_rows[:, 5],
+                "WEIGHT" : rate_rows[:, 6]}
+
+
+    def get_pooled_collision_rate(self, controller_id=None, goal=None, safe_traj_file=None, max_frechet=None):
+        """ Returns (total_collided, total_attempts, collision_rate) of the runs selected as in get_collision_rates.
+        The runs are weighted by the weights of their trajectories as in the pooled rates of the collision analyser
+        (skd_core_stats.get_weighted_rate_counts), so the totals are the effective counts of the weighted rate.
+        Without deduplicated files they are the plain run counts """
+        collision_rates = self.get_collision_rates(controller_id, goal, safe_traj_file, max_frechet)
+        total_collided, total_attempts = skd_core_stats.get_weighted_rate_counts(collision_rates["TOTAL_COLLIDED"],
+                                                    collision_rates["TOTAL_ATTEMPTS"], collision_rates["WEIGHT"])
+        return total_collided, total_attempts, (total_collided / total_attempts) if (total_attempts > 0) else float("nan")
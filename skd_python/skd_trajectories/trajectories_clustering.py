@@ -0,0 +1,145 @@
+import os, sys
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_trajectories_dir = os.path.dirname(source_path)
+skd_python_dir = os.path.dirname(skd_trajectories_dir)
+
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+
+# Import local libraries
+import skd_trajectories.trajectories_filters as traj_filters
+import skd_core.skd_core_metrics.Fretchet as Fretchet
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+
+# Import third party libs
+import numpy as np
+import json
+
+
+""" Deduplication of safe trajectory sets. Trajectories are bucketed by a quantized grid hash of a few
+of their points, and the trajectories of each bucket are clustered by their discrete frechet distance.
+One representative is kept per cluster, weighted by the number of trajectories it stands for. The weights
+are applied where the rates of several trajectories are pooled: the pooled collision rates, controller
+statistics and paired differences of the collision analyser, and the pooled critical multiplier searches.
+Rates of a single trajectory, and the frechet and timing statistics of the kamikaze analyser (which are
+per kamikaze trajectory found) are unweighted """
+
+# Default options of the deduplication
+DEFAULT_FRECHET_THRESHOLD = 0.25
+DEFAULT_CELL_SIZE = 1.0
+DEFAULT_NUM_HASH_POINTS = 3
+
+
+def get_grid_hash_keys(padded_trajs, cell_size=DEFAULT_CELL_SIZE, num_hash_points=DEFAULT_NUM_HASH_POINTS):
+    """ Returns the bucket of each trajectory of a (num_trajs, steps, 2) array. Trajectories share a bucket when
+    num_hash_points points, evenly spaced over their steps (first and last included), fall in the same cells
+    of a grid of cell_size meters """
+    hash_steps = np.unique(np.linspace(0, padded_trajs.shape[1] - 1, num_hash_points).round().astype(int))
+    grid_cells = np.floor(padded_trajs[:, hash_steps, :] / cell_size).astype(np.int64)
+
+    # Unique rows of the cells give the bucket ids
+    grid_cells = grid_cells.reshape(len(padded_trajs), -1)
+    unique_cells, bucket_keys = np.unique(grid_cells, axis=0, return_inverse=True)
+    return bucket_keys.reshape(-1)
+
+
+def get_leader_clusters(padded_trajs, members, frechet_threshold):
+    """ Greedy clustering of the members (indices of padded_trajs). The first unassigned member becomes the
+    representative of a new cluster, which takes every unassigned member within frechet_threshold of it.
+    Returns a list of (representative, cluster members) """
+    clusters = []
+    unassigned = np.asarray(members, dtype=int)
+    while(len(unassigned) > 0):
+        representative = unassigned[0]
+        # The frechet distance is at least the distance between the first (and the last) points, so
+        # only the members within the threshold at both ends are compared
+        endpoint_dists = np.maximum(
+            np.hypot(*(padded_trajs[unassigned, 0] - padded_trajs[representative, 0]).T),
+            np.hypot(*(padded_trajs[unassigned, -1] - padded_trajs[representative, -1]).T))
+        candidates = np.flatnonzero(endpoint_dists <= frechet_threshold)
+
+        in_cluster = np.zeros(len(unassigned), dtype=bool)
+        in_cluster[candidates] = Fretchet.frechetDistBatch(padded_trajs[representative],
+                                                           padded_trajs[unassigned[candidates]]) <= frechet_threshold
+        # The representative is always in its own cluster
+        in_cluster[0] = True
+
+        clusters.append((int(representative), unassigned[in_cluster]))
+        unassigned = unassigned[~in_cluster]
+
+    return clusters
+
+
+@skd_core_profiling.profiled_stage("trajectory_dedup")
+def cluster_trajectories(safe_trajs, frechet_threshold=DEFAULT_FRECHET_THRESHOLD, cell_size=DEFAULT_CELL_SIZE,
+                         num_hash_points=DEFAULT_NUM_HASH_POINTS):
+    """ Clusters the trajectories (as accepted by traj_filters.get_padded_trajectories). Trajectories are first
+    clustered within their grid bucket, and the representatives of the buckets are then clustered together, which
+    joins the near duplicates split by the edges of the grid cells. Every trajectory is within twice the
+    frechet_threshold of its representative. Returns the indices of the representatives (in trajectory order),
+    their weights (cluster sizes) and the cluster of every trajectory """
+    padded_trajs = traj_filters.get_padded_trajectories(safe_trajs)
+    bucket_keys = get_grid_hash_keys(padded_trajs, cell_size, num_hash_points)
+
+    # Clusters within each bucket
+    bucket_order = np.argsort(bucket_keys, kind="mergesort")
+    bucket_starts = np.flatnonzero(np.concatenate([[True], np.diff(bucket_keys[bucket_order]) != 0]))
+    bucket_clusters = []
+    for bucket_members in np.split(bucket_order, bucket_starts[1:]):
+        bucket_clusters.extend(get_leader_clusters(padded_trajs, bucket_members, frechet_threshold))
+
+    # Merge the bucket clusters whose representatives are close
+    bucket_representatives = np.array(sorted(representative for representative, members in bucket_clusters), dtype=int)
+    bucket_cluster_members = {representative : members for representative, members in bucket_clusters}
+    merged_clusters = get_leader_clusters(padded_trajs, bucket_representatives, frechet_threshold)
+
+    cluster_labels = np.full(len(padded_trajs), -1, dtype=int)
+    representatives = np.empty(len(merged_clusters), dtype=int)
+    weights = np.empty(len(merged_clusters), dtype=int)
+    for cluster_index, (representative, merged_representatives) in enumerate(sorted(merged_clusters, key=lambda cluster: cluster[0])):
+        for bucket_representative in merged_representatives:
+            cluster_labels[bucket_cluster_members[bucket_representative]] = cluster_index
+        representatives[cluster_index] = representative
+        weights[cluster_index] = int(np.count_nonzero(cluster_labels == cluster_index))
+
+    return representatives, weights, cluster_labels
+
+
+def deduplicate_safe_traj_file(safe_traj_path, outpath, frechet_threshold=DEFAULT_FRECHET_THRESHOLD,
+                               cell_size=DEFAULT_CELL_SIZE, num_hash_points=DEFAULT_NUM_HASH_POINTS):
+    """ Writes the cluster representatives of a safe trajectory file into outpath, renumbered from 0, with their
+    weights next to it (see traj_filters.get_weights_filepath). The weights of an already deduplicated file are added up.
+    Returns a summary with the source index, weight and cluster of the trajectories """
+    with open(safe_traj_path) as safe_traj_file:
+        safe_traj_data = json.load(safe_traj_file)
+    safe_trajs = [safe_traj_data[str(traj_index)] for traj_index in range(len(safe_traj_data))]
+    source_weights = np.array(traj_filters.get_safe_traj_weights(safe_traj_path), dtype=int)
+
+    if(len(safe_trajs) > 0):
+        representatives, weights, cluster_labels = cluster_trajectories(safe_trajs, frechet_threshold, cell_size,
+                                                                        num_hash_points)
+        weights = np.bincount(cluster_labels, weights=source_weights, minlength=len(representatives)).astype(int)
+    else:
+        representatives, weights, cluster_labels = np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    dedup_trajs = {}
+    dedup_weights = {}
+    for traj_num in range(len(representatives)):
+        dedup_trajs[str(traj_num)] = safe_trajs[representatives[traj_num]]
+        dedup_weights[str(traj_num)] = int(weights[traj_num])
+
+    with open(outpath, "w+") as dedup_file:
+        json.dump(dedup_trajs, dedup_file)
+    with open(traj_filters.get_weights_filepath(outpath), "w+") as weights_file:
+        json.dump(dedup_weights, weights_file)
+
+    return {"SAFE_TRAJ_FILE" : safe_traj_path,
+            "DEDUP_TRAJ_FILE" : outpath,
+            "TOTAL" : len(safe_trajs),
+            "REPRESENTATIVES" : len(representatives),
+            "SOURCE_INDICES" : representatives.tolist(),
+            "WEIGHTS" : weights.tolist(),
+            "CLUSTER_LABELS" : cluster_labels.tolist()}
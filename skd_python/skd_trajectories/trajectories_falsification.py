@@ -0,0 +1,192 @@
+import os, sys
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_trajectories_dir = os.path.dirname(source_path)
+skd_python_dir = os.path.dirname(skd_trajectories_dir)
+
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+
+# Import local libraries
+import skd_trajectories.trajectories_generators as traj_generators
+import skd_trajectories.trajectories_filters as traj_filters
+import skd_collision_tests.controllers.car_controllers as car_controllers
+import skd_collision_tests.controllers.batch_controllers as batch_controllers
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+import skd_core.skd_core_utils.skd_core_stats as skd_core_stats
+
+# Import third party libs
+import numpy as np
+import scipy.stats
+
+
+""" Cross-entropy falsification of a car controller over the parametric safe trajectories of
+trajectories_generators (start, contact and end longitudinal points). The sampling distribution of the
+parameters (independent truncated normals within the bounds) is refitted every generation to the trajectories
+that get closest to a collision, until the collisions are the elites. The failure probability under the
+uniform sampling of the bounds is then estimated by importance sampling from the fitted distribution """
+
+# Parameters of the safe trajectories, in the column order of the parameter arrays
+TRAJ_PARAMS = ["start", "contact", "end"]
+
+# Default options of the search
+DEFAULT_POPULATION_SIZE = 1000
+DEFAULT_ELITE_FRACTION = 0.1
+DEFAULT_SMOOTHING = 0.7
+DEFAULT_MIN_STD_FRACTION = 0.02
+DEFAULT_MIN_FAILURE_FRACTION = 0.01
+DEFAULT_MAX_GENERATIONS = 20
+COLLISION_SEGMENTS_CHECK = 5
+
+
+@skd_core_profiling.profiled_stage("collision_simulation")
+def get_collision_scores(trajs, controller_multiplier, max_num_steps=25, random_state=None):
+    """ Runs the batched collision experiments of the (N, steps, 2) trajectories against basic car controllers
+    of the multiplier, started as in the collision experiments. Returns the score (smallest clearance to the car,
+    zero or less for the runs that collided) and the collision flag of every trajectory """
+    random_state = np.random if (random_state is None) else random_state
+    num_runs = len(trajs)
+
+    car_controller = car_controllers.BasicCarController(multiplier=float(controller_multiplier))
+    car_start_pos = traj_filters.get_batch_car_starting_pos(trajs, [car_controller])[:, 0]
+    pedestrian_batch = batch_controllers.BatchPedestrianController(trajs)
+    car_batch = batch_controllers.BatchCarController(num_runs, multiplier=float(controller_multiplier))
+    car_batch.set_car_pos(car_start_pos[:, 0], car_start_pos[:, 1])
+
+    state_log = np.empty((num_runs, max_num_steps + 1, batch_controllers.STATE_LOG_SIZE))
+    collided = batch_controllers.run_batch_collision_experiments(pedestrian_batch, car_batch, max_num_steps,
+                        COLLISION_SEGMENTS_CHECK, random_state.random_sample((max_num_steps, num_runs)), state_log)
+
+    return batch_controllers.get_collision_scores(state_log, collided, car_batch.get_car_dimensions(),
+                                                  pedestrian_batch.radius), collided
+
+
+
+class CrossEntropyFalsifier:
+    """ Searches the parametric safe trajectories that make a controller multiplier collide """
+    def __init__(self, start_point_longit_bounds, contact_point_longit_bounds, end_point_longit_bounds, controller_multiplier,
+                 steps_half1=10, steps_half2=4, max_num_steps=25, population_size=DEFAULT_POPULATION_SIZE,
+                 elite_fraction=DEFAULT_ELITE_FRACTION, smoothing=DEFAULT_SMOOTHING, min_std_fraction=DEFAULT_MIN_STD_FRACTION,
+                 min_failure_fraction=DEFAULT_MIN_FAILURE_FRACTION, random_state=None):
+        self.lower_bounds = np.array([start_point_longit_bounds[0], contact_point_longit_bounds[0], end_point_longit_bounds[0]], dtype=float)
+        self.upper_bounds = np.array([start_point_longit_bounds[1], contact_point_longit_bounds[1], end_point_longit_bounds[1]], dtype=float)
+        self.controller_multiplier = controller_multiplier
+        self.steps_half1 = steps_half1
+        self.steps_half2 = steps_half2
+        self.max_num_steps = max_num_steps
+
+        self.population_size = int(population_size)
+        self.elite_fraction = elite_fraction
+        self.min_failures = max(1, int(min_failure_fraction * self.population_size))
+        self.smoothing = smoothing
+        self.random_state = np.random.RandomState() if (random_state is None) else random_state
+
+        # Parameters with empty bounds are fixed, the distributions only cover the free ones
+        self.widths = self.upper_bounds - self.lower_bounds
+        self.free_params = self.widths > 0
+        self.min_stds = min_std_fraction * self.widths
+
+        self.num_simulations = 0
+
+
+    def get_num_simulations(self):
+        return self.num_simulations
+
+
+    def get_uniform_moments(self):
+        """ Mean and deviation of the uniform sampling of the bounds """
+        return (self.lower_bounds + self.upper_bounds) / 2.0, self.widths / np.sqrt(12.0)
+
+
+    def sample_params(self, mean, std, num_samples):
+        """ Samples (num_samples, 3) parameters from the truncated normals, or uniformly when mean is None """
+        params = np.tile(self.lower_bounds, (num_samples, 1))
+        free = self.free_params
+        if(mean is None):
+            params[:, free] = self.random_state.uniform(self.lower_bounds[free], self.upper_bounds[free], (num_samples, int(free.sum())))
+        else:
+            lower_std, upper_std = self.get_standard_bounds(mean, std)
+            params[:, free] = scipy.stats.truncnorm.rvs(lower_std, upper_std, loc=mean[free], scale=std[free],
+                                                        size=(num_samples, int(free.sum())), random_state=self.random_state)
+        return params
+
+
+    def get_standard_bounds(self, mean, std):
+        free = self.free_params
+        return (self.lower_bounds[free] - mean[free]) / std[free], (self.upper_bounds[free] - mean[free]) / std[free]
+
+
+    def get_likelihood_ratios(self, params, mean, std):
+        """ Ratios between the uniform density and the sampling density of the parameters """
+        if(mean is None):
+            return np.ones(len(params))
+        free = self.free_params
+        lower_std, upper_std = self.get_standard_bounds(mean, std)
+        log_densities = scipy.stats.truncnorm.logpdf(params[:, free], lower_std, upper_std, loc=mean[free], scale=std[free]).sum(axis=1)
+        return np.exp(-np.log(self.widths[free]).sum() - log_densities)
+
+
+    def simulate_params(self, params):
+        """ Scores and collision flags of the trajectories of the parameters """
+        trajs = traj_generators.get_safe_trajectory_array(params[:, 0], params[:, 1], params[:, 2], self.steps_half1, self.steps_half2)
+        self.num_simulations += len(params)
+        return get_collision_scores(trajs, self.controller_multiplier, self.max_num_steps, self.random_state)
+
+
+    @skd_core_profiling.profiled_stage("falsification")
+    def run(self, max_generations=DEFAULT_MAX_GENERATIONS, num_estimate_samples=None):
+        """ Refits the sampling distribution for up to max_generations, and estimates the failure probability
+        with num_estimate_samples (population_size by default) from the final distribution. Returns a summary
+        with the estimate, its 95% interval, the fitted distribution and the failure region """
+        num_estimate_samples = self.population_size if (num_estimate_samples is None) else int(num_estimate_samples)
+        mean, std = None, None
+        generations = []
+
+        for generation in range(max_generations):
+            params = self.sample_params(mean, std, self.population_size)
+            scores, collided = self.simulate_params(params)
+
+            # Elites are the runs within the score level of the generation. The level stops at the collisions,
+            # which are the elites as soon as there are min_failures of them
+            score_level = max(float(np.quantile(scores, self.elite_fraction)), 0.0)
+            if(collided.sum() >= self.min_failures):
+                score_level = 0.0
+            elites = scores <= score_level
+            elite_weights = self.get_likelihood_ratios(params[elites], mean, std)
+            generations.append({"LEVEL" : score_level, "COLLISIONS" : int(collided.sum())})
+
+            previous_mean, previous_std = self.get_uniform_moments() if (mean is None) else (mean, std)
+            elite_mean = np.average(params[elites], axis=0, weights=elite_weights)
+            elite_std = np.sqrt(np.average((params[elites] - elite_mean) ** 2, axis=0, weights=elite_weights))
+            mean = self.smoothing * elite_mean + (1 - self.smoothing) * previous_mean
+            std = np.maximum(self.smoothing * elite_std + (1 - self.smoothing) * previous_std, self.min_stds)
+
+            if(score_level <= 0.0):
+                break
+
+        # Importance sampling estimate of the failure probability under the uniform sampling
+        params = self.sample_params(mean, std, num_estimate_samples)
+        scores, collided = self.simulate_params(params)
+        failure_weights = np.where(collided, self.get_likelihood_ratios(params, mean, std), 0.0)
+        failure_probability = float(failure_weights.mean())
+        std_error = float(failure_weights.std(ddof=1) / np.sqrt(len(failure_weights))) if (len(failure_weights) > 1) else np.nan
+
+        failure_region = {}
+        for param_index in range(len(TRAJ_PARAMS)):
+            failure_values = params[collided, param_index]
+            failure_region[TRAJ_PARAMS[param_index]] = ([float(failure_values.min()), float(failure_values.max())]
+                                                        if (len(failure_values) > 0) else None)
+
+        return {"CONTROLLER_MULTIPLIER" : self.controller_multiplier,
+                "FAILURE_PROBABILITY" : failure_probability,
+                "FAILURE_PROBABILITY_STD_ERR" : std_error,
+                "FAILURE_PROBABILITY_CI" : [max(failure_probability - skd_core_stats.NORMAL_95_Z * std_error, 0.0),
+                                            failure_probability + skd_core_stats.NORMAL_95_Z * std_error],
+                "FAILURE_REGION" : failure_region,
+                "SAMPLING_MEAN" : mean.tolist(),
+                "SAMPLING_STD" : std.tolist(),
+                "NUM_ESTIMATE_FAILURES" : int(collided.sum()),
+                "NUM_SIMULATIONS" : self.num_simulations,
+                "GENERATIONS" : generations}
@@ -11,9 +11,12 @@ if(skd_python_dir not in sys.path):
 
 # Import local libraries
 import skd_collision_tests.controllers.pedestrian_controllers as pedestrian_controllers
+import skd_collision_tests.controllers.car_controllers as car_controllers
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
 
 # Import third party libs
 import numpy as np
+import json
 import copy
 
 
@@ -22,6 +25,10 @@ def get_traj_min_longitudinal_point_index(safe_traj):
     LONGIT_INDEX = 0
     HOZ_INDEX = 1
 
+    # Precomputed lookup
+    if(isinstance(safe_traj, SafeTrajectory)):
+        return safe_traj.get_min_longitudinal_point_index()
+
     min_longit = 100000
     min_point_index = 0
     # Iterate over all points and save index of the lowerst
@@ -41,6 +48,10 @@ def get_traj_hoz_index_closest_to(safe_traj, hoz_val):
     LONGIT_INDEX = 0
     HOZ_INDEX = 1
 
+    # Precomputed lookup
+    if(isinstance(safe_traj, SafeTrajectory)):
+        return safe_traj.get_hoz_index_closest_to(hoz_val)
+
     min_hoz_dist = 100000
     # Iterate over points
     closest_index = 0
@@ -71,6 +82,10 @@ def get_region_min_longit_point(safe_traj, min_hoz_val, max_hoz_val):
     # Check for bounds
     assert (max_hoz_val > min_hoz_val), "min val:%f, max_val:%f are invalid" % (min_hoz_val, max_hoz_val)
 
+    # Precomputed lookup
+    if(isinstance(safe_traj, SafeTrajectory)):
+        return safe_traj.get_region_min_longit_point(min_hoz_val, max_hoz_val)
+
     # Iterate over points in safe traj
     for loc_point in safe_traj:
         # Get point index
@@ -88,22 +103,21 @@ def get_region_min_longit_point(safe_traj, min_hoz_val, max_hoz_val):
 
 
 
-def is_trajectory_valid(safe_trajectory):
-    """ Returns if a given trajectory is valid for the assessment of the car """
-    return true
+def is_trajectory_valid(safe_trajectory, car_controller=None, **filter_options):
+    """ Returns if a given trajectory is valid for the assessment of the car (see get_trajectory_filter_masks) """
+    accepted_mask, rejection_counts = filter_trajectory_array([safe_trajectory], car_controller, **filter_options)
+    return bool(accepted_mask[0])
 
 
-def filter_trajectories(trajectories_db):
+def filter_trajectories(trajectories_db, car_controller=None, **filter_options):
     """ Checks if each of the given trajectories are valid against the car's mechanical criteria """
-    filtered_trajectories = []
+    if(len(trajectories_db) <= 0):
+        return []
 
-    # Filter valid ones
-    for trajectory in filter_trajectories:
-        if(self.is_trajectory_valid(trajectory)):
-            filtered_trajectories.append(trajectory)
+    accepted_mask, rejection_counts = filter_trajectory_array(trajectories_db, car_controller, **filter_options)
 
     # Return all accepted trajectories
-    return filtered_trajectories
+    return [trajectories_db[traj_index] for traj_index in np.flatnonzero(accepted_mask)]
 
 
 
@@ -127,3 +141,304 @@ def get_car_starting_pos(safe_trajectory, car_controller, car_lane_pos_hoz=-2):
 
     return [car_start_pos_longit, car_lane_pos_hoz]
 
+
+
+############################## PRECOMPUTED TRAJECTORY LOOKUPS #############################
+# Returned by the region queries when no point of the trajectory lies in the region
+NO_REGION_POINT_LONGIT = 1000000
+
+
+def get_padded_trajectories(safe_trajs):
+    """ Stacks a list of safe trajectories (lists of [longit, hoz] points or SafeTrajectory objects) into
+    a single (num_trajs, steps, 2) array. Shorter trajectories are padded with their last point. Arrays
+    are returned as they are """
+    if(isinstance(safe_trajs, np.ndarray)):
+        return safe_trajs
+
+    traj_points = [safe_traj.points if isinstance(safe_traj, SafeTrajectory) else np.asarray(safe_traj, dtype=float)
+                    for safe_traj in safe_trajs]
+    assert(all(len(points) > 0 for points in traj_points)), "Empty safe pedestrian trajectory given"
+
+    max_traj_len = max(len(points) for points in traj_points)
+    padded_trajs = np.empty((len(traj_points), max_traj_len, 2), dtype=float)
+    for traj_index in range(len(traj_points)):
+        traj_len = len(traj_points[traj_index])
+        padded_trajs[traj_index, :traj_len] = traj_points[traj_index][:, 0:2]
+        padded_trajs[traj_index, traj_len:] = traj_points[traj_index][-1, 0:2]
+
+    return padded_trajs
+
+
+
+class SafeTrajectory:
+    """ Safe trajectory with lookup tables built once, so the queries made for every run and cfg
+    (region minimum, closest horizontal point, starting position of the car) do not scan the
+    trajectory. The points are sorted by their horizontal position, and a sparse table holds the
+    minimum longitudinal value of every power of two range of the sorted points """
+    LONGIT_INDEX = 0
+    HOZ_INDEX = 1
+
+    def __init__(self, safe_traj):
+        assert(len(safe_traj) > 0), "No safe pedestrian trajectory given"
+        # Original points, as given to the pedestrian controllers
+        self.safe_traj = safe_traj
+        self.points = np.array(safe_traj, dtype=float).reshape(len(safe_traj), -1)[:, 0:2]
+        longit_vals = self.points[:, self.LONGIT_INDEX]
+        hoz_vals = self.points[:, self.HOZ_INDEX]
+
+        # Bounding box [[min_longit, min_hoz], [max_longit, max_hoz]]
+        self.bounding_box = np.stack([self.points.min(axis=0), self.points.max(axis=0)])
+        self.min_longit_index = int(np.argmin(longit_vals))
+
+        # Points sorted by horizontal position (stable, so equal positions keep their order)
+        self.hoz_order = np.argsort(hoz_vals, kind="mergesort")
+        self.sorted_hoz = hoz_vals[self.hoz_order]
+
+        # First (lowest) trajectory index of each group of equal horizontal positions
+        group_starts = np.concatenate([[True], self.sorted_hoz[1:] != self.sorted_hoz[:-1]])
+        self.hoz_group_first_index = self.hoz_order[np.flatnonzero(group_starts)[np.cumsum(group_starts) - 1]]
+
+        # Sparse table of the range minima of the longitudinal values sorted by horizontal position
+        self.range_min_table = [longit_vals[self.hoz_order]]
+        range_len = 1
+        while(2 * range_len <= len(self.points)):
+            prev_level = self.range_min_table[-1]
+            self.range_min_table.append(np.minimum(prev_level[:-range_len], prev_level[range_len:]))
+            range_len *= 2
+
+
+    def __len__(self):
+        return len(self.points)
+
+
+    def get_points(self):
+        """ Returns the safe trajectory as it was given """
+        return self.safe_traj
+
+
+    def get_bounding_box(self):
+        return self.bounding_box
+
+
+    def get_min_longitudinal_point_index(self):
+        """ Same as get_traj_min_longitudinal_point_index """
+        return self.min_longit_index
+
+
+    def get_hoz_index_closest_to(self, hoz_val):
+        """ Same as get_traj_hoz_index_closest_to, in O(log n) """
+        sorted_pos = int(np.searchsorted(self.sorted_hoz, hoz_val))
+
+        # Only the groups on either side of hoz_val can be the closest
+        candidates = []
+        for candidate_pos in [sorted_pos - 1, sorted_pos]:
+            if(candidate_pos >= 0 and candidate_pos < len(self.sorted_hoz)):
+                candidates.append((abs(self.sorted_hoz[candidate_pos] - hoz_val),
+                                   int(self.hoz_group_first_index[candidate_pos])))
+
+        # Ties are resolved to the first point of the trajectory
+        return min(candidates)[1]
+
+
+    def get_region_min_longit_point(self, min_hoz_val, max_hoz_val):
+        """ Same as get_region_min_longit_point, in O(log n) """
+        # Regions outside the bounding box have no points
+        if(max_hoz_val < self.bounding_box[0][self.HOZ_INDEX] or min_hoz_val > self.bounding_box[1][self.HOZ_INDEX]):
+            return NO_REGION_POINT_LONGIT
+
+        range_start = int(np.searchsorted(self.sorted_hoz, min_hoz_val, side="left"))
+        range_end = int(np.searchsorted(self.sorted_hoz, max_hoz_val, side="right"))
+        if(range_end <= range_start):
+            return NO_REGION_POINT_LONGIT
+
+        # Minimum of the two (overlapping) power of two ranges covering the region
+        level = (range_end - range_start).bit_length() - 1
+        level_min = self.range_min_table[level]
+        return float(min(level_min[range_start], level_min[range_end - (1 << level)]))
+
+
+
+def get_batch_car_starting_pos(safe_trajs, car_controller_list, car_lane_pos_hoz=-2):
+    """ Vectorized get_car_starting_pos of every safe trajectory (list of trajectories, SafeTrajectory
+    objects or a (num_trajs, steps, 2) array) for every car controller. Returns an array of shape
+    (num_trajs, num_controllers, 2) with the [longit, hoz] starting position of each pair """
+    CAR_WIDTH = 1
+    padded_trajs = get_padded_trajectories(safe_trajs)
+    longit_vals = padded_trajs[:, :, 0]
+    hoz_vals = padded_trajs[:, :, 1]
+
+    car_stop_dists = np.array([car_controller.get_car_stop_dist() for car_controller in car_controller_list], dtype=float)
+    car_widths = np.array([car_controller.get_car_dimensions()[CAR_WIDTH] for car_controller in car_controller_list], dtype=float)
+
+    car_start_pos = np.empty((len(padded_trajs), len(car_controller_list), 2), dtype=float)
+    car_start_pos[:, :, 1] = car_lane_pos_hoz
+
+    # The region only depends on the width of the car, so it is computed once per width
+    for car_width in np.unique(car_widths):
+        car_min_region = car_lane_pos_hoz - car_width/2
+        car_max_region = car_lane_pos_hoz + car_width/2
+        in_region = (hoz_vals >= car_min_region) & (hoz_vals <= car_max_region)
+        region_min_longit = np.where(in_region, longit_vals, NO_REGION_POINT_LONGIT).min(axis=1)
+
+        width_controllers = np.flatnonzero(car_widths == car_width)
+        car_start_pos[:, width_controllers, 0] = region_min_longit[:, None] - car_stop_dists[width_controllers]
+
+    return car_start_pos
+
+
+
+################################ TRAJECTORY FILTER PIPELINE ###############################
+# Filters applied to the safe trajectories, in the order used to report the rejections
+TRAJECTORY_FILTERS = ["lane_crossing", "car_stop_dist", "ped_step_speed"]
+
+# Default limits of the filters. The pedestrian speed limit is given in m/s, and the horizon is the
+# number of steps of the planner and collision experiments
+DEFAULT_MAX_PED_SPEED = 4.0
+DEFAULT_STEP_TIME = car_controllers.BasicCarController.SIMULATION_STEP_TIME
+DEFAULT_MAX_NUM_STEPS = 25
+
+
+def get_trajectory_filter_masks(safe_trajs, car_controller=None, car_lane_pos_hoz=-2, max_ped_speed=DEFAULT_MAX_PED_SPEED,
+                                step_time=DEFAULT_STEP_TIME, max_num_steps=DEFAULT_MAX_NUM_STEPS):
+    """ Evaluates every filter over a batch of safe trajectories (as accepted by get_padded_trajectories).
+    Returns a dictionary with a boolean array per filter, True where the trajectory passes it:
+    - lane_crossing: the pedestrian enters the lane of the car within the first max_num_steps steps
+    - car_stop_dist: the car can stop for the pedestrian. The car starts at get_car_starting_pos and drives
+      at its max speed until the pedestrian is within its braking distance (get_car_start_brake_dist), and
+      from then on it needs its stopping distance (get_car_stop_dist) to stop. The pedestrian must not be in
+      the lane within that stopping distance ahead of the car (and not behind it) once it brakes
+    - ped_step_speed: no step of the pedestrian is faster than max_ped_speed """
+    CAR_WIDTH = 1
+    car_controller = car_controllers.BasicCarController() if (car_controller is None) else car_controller
+    padded_trajs = get_padded_trajectories(safe_trajs)
+    longit_vals = padded_trajs[:, :, 0]
+    hoz_vals = padded_trajs[:, :, 1]
+
+    # Lane crossing window of the pedestrian
+    car_width = car_controller.get_car_dimensions()[CAR_WIDTH]
+    in_lane = (hoz_vals >= car_lane_pos_hoz - car_width/2) & (hoz_vals <= car_lane_pos_hoz + car_width/2)
+    lane_crossing = np.any(in_lane[:, :max_num_steps + 1], axis=1)
+
+    # Step where the car starts braking, driving at its max speed before it, and the points it stops between
+    horizon_steps = np.arange(max_num_steps + 1)
+    traj_steps = np.minimum(horizon_steps, padded_trajs.shape[1] - 1)
+    ped_longit = longit_vals[:, traj_steps]
+    car_start_longit = get_batch_car_starting_pos(padded_trajs, [car_controller], car_lane_pos_hoz)[:, 0, 0]
+    car_driving_longit = car_start_longit[:, None] + car_controller.car_max_speed * step_time * horizon_steps
+    brake_decisions = (ped_longit - car_driving_longit) <= car_controller.get_car_start_brake_dist()
+    braking_steps = np.where(np.any(brake_decisions, axis=1), np.argmax(brake_decisions, axis=1), len(horizon_steps))
+    car_brake_longit = car_driving_longit[np.arange(len(padded_trajs)), np.minimum(braking_steps, max_num_steps)]
+    car_rear_longit = car_brake_longit - car_controller.get_car_dimensions()[0]/2
+    car_stop_longit = car_brake_longit + car_controller.get_car_stop_dist()
+
+    # Pedestrian in the lane, between the car and the point it stops at, after the car brakes
+    blocking_steps = (in_lane[:, traj_steps] & (horizon_steps[None, :] >= braking_steps[:, None]) &
+                      (ped_longit >= car_rear_longit[:, None]) & (ped_longit < car_stop_longit[:, None]))
+    car_stop_dist = ~np.any(blocking_steps, axis=1)
+
+    # Speed of every step (padded steps do not move)
+    step_dists = np.hypot(np.diff(longit_vals, axis=1), np.diff(hoz_vals, axis=1))
+    ped_step_speed = np.all(step_dists <= max_ped_speed * step_time, axis=1)
+
+    return {"lane_crossing" : lane_crossing,
+            "car_stop_dist" : car_stop_dist,
+            "ped_step_speed" : ped_step_speed}
+
+
+@skd_core_profiling.profiled_stage("trajectory_filtering")
+def filter_trajectory_array(safe_trajs, car_controller=None, chunk_size=100000, **filter_options):
+    """ Runs the filters over the safe trajectories, chunk_size trajectories at a time so that large packed
+    corpora (see trajectories_generators.load_safe_trajectory_corpus) are not loaded at once. Returns the
+    accepted mask of the trajectories and the rejection counts of every filter. A trajectory failing
+    several filters is counted by each of them """
+    num_trajs = len(safe_trajs)
+    accepted_mask = np.zeros(num_trajs, dtype=bool)
+    rejection_counts = {"TOTAL" : num_trajs}
+    for filter_name in TRAJECTORY_FILTERS:
+        rejection_counts["REJECTED_%s" % (filter_name.upper())] = 0
+
+    for chunk_start in range(0, num_trajs, chunk_size):
+        filter_masks = get_trajectory_filter_masks(safe_trajs[chunk_start:chunk_start + chunk_size], car_controller,
+                                                   **filter_options)
+        chunk_accepted = accepted_mask[chunk_start:chunk_start + chunk_size]
+        chunk_accepted[:] = True
+        for filter_name in TRAJECTORY_FILTERS:
+            rejection_counts["REJECTED_%s" % (filter_name.upper())] += int(np.count_nonzero(~filter_masks[filter_name]))
+            chunk_accepted &= filter_masks[filter_name]
+
+    rejection_counts["ACCEPTED"] = int(np.count_nonzero(accepted_mask))
+    rejection_counts["REJECTED"] = num_trajs - rejection_counts["ACCEPTED"]
+    return accepted_mask, rejection_counts
+
+
+def get_weights_filepath(safe_traj_path):
+    """ Weights of a deduplicated safe trajectory file (see trajectories_clustering) are kept next to it """
+    return os.path.splitext(safe_traj_path)[0] + "_weights.json"
+
+
+def get_safe_traj_weights(safe_traj_path):
+    """ Returns the weight of each trajectory of a safe trajectory file (one if it was not deduplicated) """
+    weights_path = get_weights_filepath(safe_traj_path)
+    if(os.path.isfile(weights_path)):
+        with open(weights_path) as weights_file:
+            weights_data = json.load(weights_file)
+        return [weights_data[str(traj_index)] for traj_index in range(len(weights_data))]
+
+    with open(safe_traj_path) as safe_traj_file:
+        return [1] * len(json.load(safe_traj_file))
+
+
+def filter_safe_traj_file(safe_traj_path, outpath, car_controller=None, **filter_options):
+    """ Filters the trajectories of a safe trajectory file (as written by the safe traj generator) into a new
+    file at outpath, renumbered from 0. Returns the rejection counts, along with the source index of each
+    of the accepted trajectories """
+    with open(safe_traj_path) as safe_traj_file:
+        safe_traj_data = json.load(safe_traj_file)
+    safe_trajs = [safe_traj_data[str(traj_index)] for traj_index in range(len(safe_traj_data))]
+
+    # Empty files get the same (zero) rejection counts
+    accepted_mask, rejection_counts = filter_trajectory_array(safe_trajs, car_controller, **filter_options)
+
+    source_indices = np.flatnonzero(accepted_mask).tolist()
+    filtered_trajs = {str(traj_num) : safe_trajs[source_indices[traj_num]] for traj_num in range(len(source_indices))}
+    with open(outpath, "w+") as filtered_file:
+        json.dump(filtered_trajs, filtered_file, indent = 4)
+
+    # Keep the weights of the accepted trajectories of deduplicated files
+    if(os.path.isfile(get_weights_filepath(safe_traj_path))):
+        source_weights = get_safe_traj_weights(safe_traj_path)
+        with open(get_weights_filepath(outpath), "w+") as weights_file:
+            json.dump({str(traj_num) : source_weights[source_indices[traj_num]] for traj_num in range(len(source_indices))},
+                      weights_file)
+
+    filter_summary = copy.deepcopy(rejection_counts)
+    filter_summary["SAFE_TRAJ_FILE"] = safe_traj_path
+    filter_summary["FILTERED_TRAJ_FILE"] = outpath
+    filter_summary["SOURCE_INDICES"] = source_indices
+    return filter_summary
+
+
+def filter_safe_traj_files(safe_traj_files, outdir, car_controller=None, **filter_options):
+    """ Filter stage between the safe and the kamikaze trajectory generators. Every safe trajectory file is
+    filtered into outdir (keeping its goal dir name), and a filter_summary.json with the rejection counts is
+    saved. Returns the filtered files that kept at least one trajectory """
+    filtered_files = []
+    filter_summaries = []
+    for safe_traj_path in safe_traj_files:
+        # Safe files are named safe_trajs.json inside a dir per goal
+        file_outdir = outdir + "/" + os.path.basename(os.path.dirname(os.path.abspath(safe_traj_path)))
+        try:
+            os.makedirs(file_outdir)
+        except OSError as error:
+            pass
+
+        filter_summary = filter_safe_traj_file(safe_traj_path, file_outdir + "/" + os.path.basename(safe_traj_path),
+                                               car_controller, **filter_options)
+        filter_summaries.append(filter_summary)
+        if(filter_summary["ACCEPTED"] > 0):
+            filtered_files.append(filter_summary["FILTERED_TRAJ_FILE"])
+
+    with open(outdir + "/filter_summary.json", "w+") as summary_file:
+        json.dump({"FILTER_OPTIONS" : filter_options, "FILES" : filter_summaries}, summary_file, indent = 4)
+
+    return filtered_files
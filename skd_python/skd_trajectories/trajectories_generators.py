@@ -1,21 +1,21 @@
 import os, sys
 
-# Import parent dir
-cwd = os.getcwd()
-skd_python_dir = os.path.dirname(cwd)
-skd_collision_experiments_dir = skd_python_dir + "/skd_collision_experiments"
-# Append to python path
-if(skd_collision_experiments_dir not in sys.path):
-    sys.path.append(skd_collision_experiments_dir)
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_trajectories_dir = os.path.dirname(source_path)
+skd_python_dir = os.path.dirname(skd_trajectories_dir)
+
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
 
 # # Import local libraries
 # import controllers.pedestrian_controllers as pedestrian_controllers
+import skd_core.skd_core_utils.skd_plot_renderer as skd_plot_renderer
 
 # # Import third party libs
 import numpy as np
 import json
 import copy
-import matplotlib.pyplot as plt
 
 ################################# GLOBAL FUNCTIONS ##################################
 """ Clamps a value """
@@ -45,32 +45,89 @@ def sample_safe_trajectory_set(
 
     """ Returns a set of sampled trajectories as defined by the given options"""
 
+    # Sampled as an array and converted to lists of [longit, hoz] points
+    return sample_safe_trajectory_array(start_point_longit_bounds, contact_point_longit_bounds,
+        end_point_longit_bounds, num_trajs, steps_half1, steps_half2).tolist()
+
+
+def sample_safe_trajectory_array(
+    start_point_longit_bounds, contact_point_longit_bounds, end_point_longit_bounds, 
+    num_trajs = 10, steps_half1=10, steps_half2=4, random_state=None):
+
+    """ Vectorized sample_safe_trajectory_set. Returns a (num_trajs, steps_half1 + steps_half2, 2) array of
+    [longit, hoz] points, built by broadcasting the sampled points against the step fractions. The points
+    are the same as the ones of sample_safe_trajectory for the same random draws. random_state is an optional
+    np.random.RandomState (the global numpy generator is used by default) """
+
     # Ensure input is of correct format
     assert(len(start_point_longit_bounds) == 2 ), "Starting Point Bounds Incorrect Format"
     assert(len(contact_point_longit_bounds) == 2), "Contact Point Bounds Incorrect Format"
     assert(len(end_point_longit_bounds) == 2), "End Point Bounds Incorrect Format"  
 
-    trajectories_db = []
+    random_state = np.random if (random_state is None) else random_state
+    start_points = random_state.uniform(start_point_longit_bounds[0], start_point_longit_bounds[1], num_trajs)
+    contact_points = random_state.uniform(contact_point_longit_bounds[0], contact_point_longit_bounds[1], num_trajs)
+    end_points = random_state.uniform(end_point_longit_bounds[0], end_point_longit_bounds[1], num_trajs)
+
+    return get_safe_trajectory_array(start_points, contact_points, end_points, steps_half1, steps_half2)
+
 
-    start_points = np.random.uniform(start_point_longit_bounds[0], start_point_longit_bounds[1], num_trajs)
-    contact_points = np.random.uniform(contact_point_longit_bounds[0], contact_point_longit_bounds[1], num_trajs)
-    end_points = np.random.uniform(end_point_longit_bounds[0], end_point_longit_bounds[1], num_trajs)
+def get_safe_trajectory_array(start_points, contact_points, end_points, steps_half1=10, steps_half2=4):
+    """ Returns the (num_trajs, steps_half1 + steps_half2, 2) array of the trajectories defined by arrays of
+    start, contact and end longitudinal points (as sample_safe_trajectory does for single points) """
+    start_points = np.asarray(start_points, dtype=float)
+    contact_points = np.asarray(contact_points, dtype=float)
+    end_points = np.asarray(end_points, dtype=float)
+    num_trajs = len(start_points)
 
-    # Sample num_trajs samples
-    for sample_num in range(num_trajs):
-        sampled_traj = sample_safe_trajectory(start_points[sample_num], contact_points[sample_num], end_points[sample_num], steps_half1, steps_half2)
-        trajectories_db.append(sampled_traj)
+    trajectories = np.empty((num_trajs, steps_half1 + steps_half2, 2), dtype=float)
+    first_half = trajectories[:, :steps_half1]
+    second_half = trajectories[:, steps_half1:]
+
+    # Longitudinal points as computed by np.linspace (step index * step size + start)
+    first_half_steps = np.arange(steps_half1, dtype=float)
+    first_half[:, :, 0] = first_half_steps * ((contact_points - start_points) / steps_half1)[:, None]
+    first_half[:, :, 0] += start_points[:, None]
+
+    second_half_steps = np.arange(steps_half2, dtype=float)
+    second_half[:, :, 0] = second_half_steps * ((end_points - contact_points) / max(steps_half2 - 1, 1))[:, None]
+    second_half[:, :, 0] += contact_points[:, None]
+    if(steps_half2 > 1):
+        second_half[:, -1, 0] = end_points
+
+    # Horizontal points are the same for every trajectory
+    first_half[:, :, 1] = np.linspace(3, -2, steps_half1, endpoint = False)
+    second_half[:, :, 1] = np.linspace(-2, -4.5, steps_half2, endpoint = True)
+
+    return trajectories
+
+
+def stream_safe_trajectory_arrays(
+    start_point_longit_bounds, contact_point_longit_bounds, end_point_longit_bounds, 
+    num_trajs = 10, steps_half1=10, steps_half2=4, chunk_size=100000, random_state=None):
 
-    # Return the whole database
-    return trajectories_db
+    """ Yields the sampled trajectories in (chunk_size, steps, 2) arrays, so that large sets never have
+    to be held in memory at once. The random points are drawn chunk by chunk """
+    for chunk_start in range(0, num_trajs, chunk_size):
+        yield sample_safe_trajectory_array(start_point_longit_bounds, contact_point_longit_bounds,
+            end_point_longit_bounds, min(chunk_size, num_trajs - chunk_start), steps_half1, steps_half2, random_state)
 
 
-def plot_safe_trajectories(trajectories, plots_outdir, plots_title):
-    # Plot every trajectory
+def plot_safe_trajectories(trajectories, plots_outdir, plots_title, num_workers=None):
+    # Plot every trajectory as a batch
+    plot_jobs = []
     for traj_num in range(len(trajectories)):
         traj_plot_title = plots_title + " # %d" % (traj_num)
         traj_plot_path = plots_outdir + "/plot_%d" % (traj_num)
-        plot_2D_traj(trajectories[traj_num], traj_plot_title, traj_plot_path)
+        plot_jobs.append(get_2D_traj_plot_job(trajectories[traj_num], traj_plot_title, traj_plot_path))
+
+    skd_plot_renderer.render_plot_jobs(plot_jobs, num_workers)
+
+
+def get_2D_traj_plot_job(trajectory, plot_title, save_path):
+    return skd_plot_renderer.get_plot_job(plot_title, save_path,
+                [(skd_plot_renderer.get_scene_points(trajectory), skd_plot_renderer.BLUE, True)],
+                xlim=(-5, 5), ylim=(110, 130))
 
 
 def plot_2D_traj(trajectory, plot_title, save_path = None):
@@ -81,6 +138,11 @@ def plot_2D_traj(trajectory, plot_title, save_path = None):
     traj_hoz = []
     traj_longit = []
 
+    # Saved plots are drawn by the headless renderer
+    if(save_path != None):
+        skd_plot_renderer.render_plot_job(get_2D_traj_plot_job(trajectory, plot_title, save_path))
+        return
+
     # Separate axis values to plot
     for traj_point_index in range(traj_len):
         traj_point = trajectory[traj_point_index]
@@ -89,7 +151,8 @@ def plot_2D_traj(trajectory, plot_title, save_path = None):
         traj_longit.append(traj_point[TRAJ_LONGIT])
 
 
-    # Plot data here
+    # Plot data here (pyplot is only loaded when plotting)
+    import matplotlib.pyplot as plt
     fig = plt.figure()
     axes = plt.axes()
 
@@ -115,12 +178,8 @@ def plot_2D_traj(trajectory, plot_title, save_path = None):
     plt.xlim(-5, 5)
     plt.ylim(110,130)
 
-    # Save plot
-    if(save_path != None):
-        # Save plot
-        plt.savefig(save_path, transparent=False, facecolor='white')
-    else:
-        plt.show()
+    # Show plot
+    plt.show()
 
     # Close figure
     plt.close()
@@ -156,7 +215,7 @@ def save_trajs_to_json(trajectories_db, save_path):
     json_trajs = {}
 
     for traj_num in range(len(trajectories_db)):
-        json_trajs[str(traj_num)] = trajectories_db[traj_num]
+        json_trajs[str(traj_num)] = np.asarray(trajectories_db[traj_num]).tolist()
         
 
     # Save trajectories into a json file
@@ -164,6 +223,33 @@ def save_trajs_to_json(trajectories_db, save_path):
         json.dump(json_trajs, trajs_save_file, indent = 4)
 
 
+def save_safe_trajectory_corpus(save_path, 
+    start_point_longit_bounds, contact_point_longit_bounds, end_point_longit_bounds, 
+    num_trajs = 10, steps_half1=10, steps_half2=4, chunk_size=100000, dtype=np.float32, seed=None):
+
+    """ Samples num_trajs safe trajectories and streams them, chunk by chunk, into a packed (num_trajs, steps, 2)
+    .npy file of the given dtype. The file is read back with load_safe_trajectory_corpus """
+    random_state = np.random.RandomState(seed)
+    corpus = np.lib.format.open_memmap(save_path, mode="w+", dtype=dtype,
+                                       shape=(num_trajs, steps_half1 + steps_half2, 2))
+
+    chunk_start = 0
+    for trajs_chunk in stream_safe_trajectory_arrays(start_point_longit_bounds, contact_point_longit_bounds,
+            end_point_longit_bounds, num_trajs, steps_half1, steps_half2, chunk_size, random_state):
+        corpus[chunk_start:chunk_start + len(trajs_chunk)] = trajs_chunk
+        chunk_start += len(trajs_chunk)
+
+    corpus.flush()
+    del corpus
+    return save_path
+
+
+def load_safe_trajectory_corpus(load_path, mmap=True):
+    """ Loads a packed trajectory corpus. With mmap the trajectories are only read from disk when used,
+    so slices of the corpus can be given to the batch controllers or filters without loading all of it """
+    return np.load(load_path, mmap_mode=("r" if mmap else None))
+
+
 
 
 
@@ -0,0 +1,257 @@
+import os, sys
+
+# Add parent dir to package
+source_path = os.path.abspath(__file__)
+skd_trajectories_dir = os.path.dirname(source_path)
+skd_python_dir = os.path.dirname(skd_trajectories_dir)
+
+if(skd_python_dir not in sys.path):
+    sys.path.append(skd_python_dir)
+
+
+# Import local libraries
+import skd_trajectories.trajectories_filters as traj_filters
+import skd_core.skd_core_metrics.Fretchet as Fretchet
+import skd_core.skd_core_utils.skd_core_profiling as skd_core_profiling
+
+# Import third party libs
+import numpy as np
+import scipy.spatial
+import json
+
+
+""" Nearest neighbour index of trajectory sets under the discrete frechet distance. A KD-tree over
+fixed length (arc length resampled) embeddings of the trajectories gives approximate neighbours, which
+bound the search radius of a vantage point tree built over the exact frechet distances. The members of
+the visited leaves are filtered with cheap lower bounds of the frechet distance before the exact distances
+are computed """
+
+# Default options of the index
+DEFAULT_NUM_EMBEDDING_POINTS = 8
+DEFAULT_LEAF_SIZE = 32
+DEFAULT_NUM_SEED_NEIGHBOURS = 4
+
+# Slack of the tree pruning, covers the rounding of the triangle inequality between computed distances
+DIST_TOLERANCE = 1e-9
+
+# Columns of the bounding boxes
+BOX_MIN_LONGIT = 0
+BOX_MIN_HOZ = 1
+BOX_MAX_LONGIT = 2
+BOX_MAX_HOZ = 3
+
+
+def get_resampled_embeddings(padded_trajs, num_points=DEFAULT_NUM_EMBEDDING_POINTS):
+    """ Returns the (num_trajs, 2 * num_points) embedding of a (num_trajs, steps, 2) array, with the
+    points placed evenly along the length of each trajectory (first and last included). The padding of
+    the trajectories has no length, so it does not change their embedding """
+    segment_lengths = np.hypot(*np.moveaxis(np.diff(padded_trajs, axis=1), -1, 0))
+    cumulative_lengths = np.concatenate([np.zeros((len(padded_trajs), 1)), np.cumsum(segment_lengths, axis=1)], axis=1)
+    total_lengths = cumulative_lengths[:, -1:]
+
+    # Length along the trajectory of each embedding point. Trajectories with no length keep their first point
+    sample_lengths = np.linspace(0.0, 1.0, num_points)[None, :] * total_lengths
+    segment_indices = np.count_nonzero(cumulative_lengths[:, None, 1:] < sample_lengths[:, :, None], axis=2)
+    segment_indices = np.minimum(segment_indices, padded_trajs.shape[1] - 2)
+
+    row_indices = np.arange(len(padded_trajs))[:, None]
+    segment_starts = cumulative_lengths[row_indices, segment_indices]
+    segment_fracs = np.zeros(sample_lengths.shape)
+    np.divide(sample_lengths - segment_starts, segment_lengths[row_indices, segment_indices], out=segment_fracs,
+              where=segment_lengths[row_indices, segment_indices] > 0)
+    segment_fracs = np.clip(segment_fracs, 0.0, 1.0)[:, :, None]
+
+    embedding_points = ((1.0 - segment_fracs) * padded_trajs[row_indices, segment_indices]
+                        + segment_fracs * padded_trajs[row_indices, segment_indices + 1])
+    return embedding_points.reshape(len(padded_trajs), -1)
+
+
+def get_point_dists(longit_diffs, hoz_diffs):
+    """ Euclidean norms of the differences, computed as frechetDistBatch does so that the lower bounds are
+    never above the exact distances by rounding """
+    return np.sqrt(longit_diffs * longit_diffs + hoz_diffs * hoz_diffs)
+
+
+def get_bounding_boxes(padded_trajs):
+    """ Returns the (num_trajs, 4) bounding boxes [min_longit, min_hoz, max_longit, max_hoz] of the trajectories """
+    return np.concatenate([padded_trajs.min(axis=1), padded_trajs.max(axis=1)], axis=1)
+
+
+def get_frechet_lower_bounds(traj, padded_trajs, bounding_boxes=None):
+    """ Returns lower bounds of the frechet distances between traj and each trajectory of padded_trajs.
+    Every coupling matches the first points and the last points together, and matches each point of a
+    trajectory to some point of the other one, which lies within the other trajectory's bounding box """
+    traj = np.asarray(traj, dtype=float)
+    if(bounding_boxes is None):
+        bounding_boxes = get_bounding_boxes(padded_trajs)
+
+    lower_bounds = np.maximum(get_point_dists(*(padded_trajs[:, 0] - traj[0]).T),
+                              get_point_dists(*(padded_trajs[:, -1] - traj[-1]).T))
+
+    # Distance from the points of traj to the boxes of the trajectories
+    longit_gaps = np.maximum(bounding_boxes[:, None, BOX_MIN_LONGIT] - traj[None, :, 0],
+                             traj[None, :, 0] - bounding_boxes[:, None, BOX_MAX_LONGIT]).clip(min=0)
+    hoz_gaps = np.maximum(bounding_boxes[:, None, BOX_MIN_HOZ] - traj[None, :, 1],
+                          traj[None, :, 1] - bounding_boxes[:, None, BOX_MAX_HOZ]).clip(min=0)
+    lower_bounds = np.maximum(lower_bounds, get_point_dists(longit_gaps, hoz_gaps).max(axis=1))
+
+    # Distance from the points of the trajectories to the box of traj
+    traj_min = traj.min(axis=0)
+    traj_max = traj.max(axis=0)
+    point_gaps = np.maximum(traj_min - padded_trajs, padded_trajs - traj_max).clip(min=0)
+    lower_bounds = np.maximum(lower_bounds, get_point_dists(point_gaps[..., 0], point_gaps[..., 1]).max(axis=1))
+
+    return lower_bounds
+
+
+
+""" Index of a set of trajectories for radius and k nearest queries under the discrete frechet distance """
+class TrajectoryIndex:
+    """ Constructor. trajs is any set accepted by traj_filters.get_padded_trajectories """
+    @skd_core_profiling.profiled_stage("trajectory_index")
+    def __init__(self, trajs, num_embedding_points=DEFAULT_NUM_EMBEDDING_POINTS, leaf_size=DEFAULT_LEAF_SIZE,
+                 random_state=None):
+        self.padded_trajs = traj_filters.get_padded_trajectories(trajs)
+        self.bounding_boxes = get_bounding_boxes(self.padded_trajs)
+        self.leaf_size = max(1, int(leaf_size))
+
+        # KD-tree of the embeddings, searched with the max norm (the largest coordinate distance)
+        self.num_embedding_points = num_embedding_points
+        self.embedding_tree = scipy.spatial.cKDTree(get_resampled_embeddings(self.padded_trajs, num_embedding_points))
+
+        # Number of exact frechet distances computed by the queries
+        self.num_exact_evaluations = 0
+
+        if(random_state is None):
+            random_state = np.random.RandomState(0)
+        self.vp_nodes = []
+        self.vp_root = self.build_vp_tree(np.arange(len(self.padded_trajs)), random_state)
+
+
+    def build_vp_tree(self, members, random_state):
+        """ Builds the vantage point tree of the members and returns its root node index. Each internal node
+        splits the remaining members around the median frechet distance to its (random) vantage point. Nodes
+        are (vantage, radius, max_dist, inside_node, outside_node, members), members is None but in the leaves """
+        if(len(members) <= self.leaf_size):
+            self.vp_nodes.append((-1, 0.0, 0.0, -1, -1, members))
+            return len(self.vp_nodes) - 1
+
+        vantage_pos = random_state.randint(len(members))
+        vantage = members[vantage_pos]
+        members = np.delete(members, vantage_pos)
+        vantage_dists = Fretchet.frechetDistBatch(self.padded_trajs[vantage], self.padded_trajs[members])
+        radius = float(np.median(vantage_dists))
+
+        # Reserve the node, the children are appended after it
+        node_index = len(self.vp_nodes)
+        self.vp_nodes.append(None)
+        inside_node = self.build_vp_tree(members[vantage_dists <= radius], random_state)
+        outside_node = self.build_vp_tree(members[vantage_dists > radius], random_state)
+        self.vp_nodes[node_index] = (vantage, radius, float(vantage_dists.max()), inside_node, outside_node, None)
+        return node_index
+
+
+    """ Getters """
+    def get_num_trajectories(self):
+        return len(self.padded_trajs)
+
+    def get_trajectory(self, traj_index):
+        """ Returns the (padded) trajectory of the index as a list of points """
+        return self.padded_trajs[traj_index].tolist()
+
+    def get_num_exact_evaluations(self):
+        return self.num_exact_evaluations
+
+
+    def get_exact_dists(self, traj, traj_indices):
+        """ Exact frechet distances between traj and the indexed trajectories """
+        self.num_exact_evaluations += len(traj_indices)
+        if(len(traj_indices) <= 0):
+            return np.zeros(0)
+        return Fretchet.frechetDistBatch(traj, self.padded_trajs[traj_indices])
+
+
+    @skd_core_profiling.profiled_stage("trajectory_index")
+    def query_radius(self, traj, radius):
+        """ Returns the indices of the trajectories within the frechet radius of traj and their distances,
+        sorted by distance (ties by index) """
+        return self._query_radius(np.asarray(traj, dtype=float)[:, 0:2], radius)
+
+
+    def _query_radius(self, traj, radius):
+        # The tree is searched one depth at a time, so that the exact distances to the vantage points of
+        # a depth, and then to the candidates of every reached leaf, are computed as a single batch
+        result_indices = []
+        result_dists = []
+        leaf_candidates = []
+
+        depth_nodes = [self.vp_root]
+        while(len(depth_nodes) > 0):
+            internal_nodes = []
+            for node_index in depth_nodes:
+                vantage, node_radius, max_dist, inside_node, outside_node, members = self.vp_nodes[node_index]
+                if(members is None):
+                    internal_nodes.append(self.vp_nodes[node_index])
+                else:
+                    # Leaves filter their members with the lower bounds
+                    leaf_candidates.append(members[get_frechet_lower_bounds(traj, self.padded_trajs[members],
+                                                                            self.bounding_boxes[members]) <= radius])
+
+            vantages = np.array([node[0] for node in internal_nodes], dtype=int)
+            vantage_dists = self.get_exact_dists(traj, vantages)
+            result_indices.extend(vantages[vantage_dists <= radius].tolist())
+            result_dists.extend(vantage_dists[vantage_dists <= radius].tolist())
+
+            # Triangle inequality, the members of the inside node are within node_radius of the vantage point
+            # and the members of the outside node between node_radius and max_dist
+            depth_nodes = []
+            for (vantage, node_radius, max_dist, inside_node, outside_node, members), vantage_dist in zip(internal_nodes, vantage_dists):
+                if(vantage_dist - radius <= node_radius + DIST_TOLERANCE):
+                    depth_nodes.append(inside_node)
+                if(vantage_dist + radius + DIST_TOLERANCE > node_radius and vantage_dist - radius <= max_dist + DIST_TOLERANCE):
+                    depth_nodes.append(outside_node)
+
+        candidates = np.concatenate(leaf_candidates + [np.zeros(0, dtype=int)])
+        candidate_dists = self.get_exact_dists(traj, candidates)
+        result_indices.extend(candidates[candidate_dists <= radius].tolist())
+        result_dists.extend(candidate_dists[candidate_dists <= radius].tolist())
+
+        result_indices = np.array(result_indices, dtype=int)
+        result_dists = np.array(result_dists, dtype=float)
+        result_order = np.lexsort((result_indices, result_dists))
+        return result_indices[result_order], result_dists[result_order]
+
+
+    @skd_core_profiling.profiled_stage("trajectory_index")
+    def query_nearest(self, traj, k=1, num_seed_neighbours=DEFAULT_NUM_SEED_NEIGHBOURS):
+        """ Returns the indices of the k nearest trajectories to traj under the frechet distance and their
+        distances, sorted by distance (ties by index). The exact distances to the nearest embeddings bound
+        the radius of the search """
+        traj = np.asarray(traj, dtype=float)[:, 0:2]
+        k = min(int(k), self.get_num_trajectories())
+        if(k <= 0):
+            return np.zeros(0, dtype=int), np.zeros(0)
+
+        traj_embedding = get_resampled_embeddings(traj[None, :, :], self.num_embedding_points)[0]
+        num_seeds = min(max(k, num_seed_neighbours * k), self.get_num_trajectories())
+        seed_dists, seed_indices = self.embedding_tree.query(traj_embedding, k=num_seeds, p=np.inf)
+        seed_indices = np.atleast_1d(seed_indices)
+
+        # The k-th smallest exact distance of the seeds bounds the distance of the k-th nearest trajectory. The
+        # seeds are merged into the results, so there are always k of them
+        seed_exact_dists = self.get_exact_dists(traj, seed_indices)
+        search_radius = np.sort(seed_exact_dists)[k - 1]
+        result_indices, result_dists = self._query_radius(traj, search_radius)
+        merged_indices, merged_positions = np.unique(np.concatenate([result_indices, seed_indices]), return_index=True)
+        merged_dists = np.concatenate([result_dists, seed_exact_dists])[merged_positions]
+        result_order = np.lexsort((merged_indices, merged_dists))[0:k]
+        return merged_indices[result_order], merged_dists[result_order]
+
+
+
+def load_safe_traj_file_index(safe_traj_path, **index_options):
+    """ Returns the TrajectoryIndex of the trajectories of a safe trajectory file, indexed by their key """
+    with open(safe_traj_path) as safe_traj_file:
+        safe_traj_data = json.load(safe_traj_file)
+    return TrajectoryIndex([safe_traj_data[str(traj_index)] for traj_index in range(len(safe_traj_data))],
+                           **index_options)